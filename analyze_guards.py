@@ -7,72 +7,82 @@
 # ./analyze_guards.py slowratio50kb.extradata slowratio1mb50kb.extradata
 #
 # It should then print out ranking stats one per file. Use your brain to
-# determine if these stats make sense for the run you selected.
+# determine if these stats make sense for the run you selected.  Files are
+# read line by line, together with the segments that extra_stats.py
+# rotated them into, and segments of files that are given too are skipped.
+#
+# With --index, guards are instead ranked in the consensus that was valid
+# when each circuit was launched, using an index of archived consensuses
+# and descriptors written by torperf_consensus.py.  --archive adds files or
+# directories of consensuses and descriptors to the index first, and
+# --jobs files are analyzed at a time (default: one per CPU):
+#
+# ./analyze_guards.py --index=consensus-index \
+#     --archive=consensuses-2013-03 --archive=server-descriptors-2013-03 \
+#     slowratio50kb.extradata slowratio1mb50kb.extradata
+#
+# Circuits launched when none of the indexed consensuses was valid are
+# counted separately.
 
+import re
 import sys
 import math
+import multiprocessing
 
-import TorCtl.TorCtl
-import TorCtl.TorUtil
+from torperf_segments import segment_lines, without_segments
 
-TorCtl.TorUtil.loglevel = "NOTICE"
 HOST="127.0.0.1"
 PORT=9051
 
-def analyze_list(router_map, idhex_list):
-  min_rank = len(router_map)
-  tot_rank = 0
-  max_rank = 0
-  absent = 0
-  for idhex in idhex_list:
-    if idhex not in router_map:
-      absent += 1
-      continue
-
-    rank = router_map[idhex].list_rank
-    tot_rank += rank
-    if rank < min_rank: min_rank = rank
-    if rank > max_rank: max_rank = rank
-
-  avg = float(tot_rank)/(len(idhex_list)-absent)
+def rank_stats(ranks, absent):
+  """(min, avg, dev, max, absent) of guard ranks."""
+  if not ranks:
+    return (None, None, None, None, absent)
+  avg = float(sum(ranks))/len(ranks)
   varience = 0
-
-  for idhex in idhex_list:
-    if idhex not in router_map: continue
-    rank = router_map[idhex].list_rank
+  for rank in ranks:
     varience += (rank-avg)*(rank-avg)
 
-  return (min_rank, avg, math.sqrt(varience/(len(idhex_list)-absent-1)), max_rank, absent)
+  return (min(ranks), avg, math.sqrt(varience/max(len(ranks)-1, 1)),
+          max(ranks), absent)
 
-def process_file(router_map, file_name):
-  f = file(file_name, "r")
-  idhex_list = f.readlines()
-  guard_list = []
-
-  for i in xrange(len(idhex_list)):
-    line = idhex_list[i].split()
+def analyze_list(router_map, idhex_list):
+  ranks = [router_map[idhex].list_rank for idhex in idhex_list
+           if idhex in router_map]
+  return rank_stats(ranks, len(idhex_list)-len(ranks))
+
+def used_guards(lines):
+  """(LAUNCH, guard) of the circuits in .extradata lines that carried a
+  stream, with LAUNCH None if it's missing."""
+  for line in lines:
+    launch = None
     path = None
     used = False
-    for word in line:
+    for word in line.split():
+      if word.startswith("LAUNCH="): launch = float(word[7:])
       if word.startswith("PATH="): path = word[5:]
       if word.startswith("USED_BY"): used = True
 
     if path and used:
-      guard = path.split(",")
-      guard_list.append(guard[0])
+      yield launch, path.split(",")[0]
+
+def process_file(router_map, file_name):
+  guard_list = [guard for _, guard in used_guards(segment_lines(file_name))]
 
   print "Guard rank stats (min, avg, dev, total, absent): "
   print file_name + ": " + str(analyze_list(router_map, guard_list))
 
+def live_rankings(ratio):
+  import TorCtl.TorCtl
+  import TorCtl.TorUtil
 
-def main():
+  TorCtl.TorUtil.loglevel = "NOTICE"
   c = TorCtl.TorCtl.connect(HOST, PORT)
   sorted_rlist = filter(lambda r: r.desc_bw > 0, c.read_routers(c.get_network_status()))
   router_map = {}
   for r in sorted_rlist: router_map["$"+r.idhex] = r
 
-  if "ratio" in sys.argv[1]:
-    print "Using ratio rankings"
+  if ratio:
     def ratio_cmp(r1, r2):
       if r1.bw/float(r1.desc_bw) > r2.bw/float(r2.desc_bw):
         return -1
@@ -82,15 +92,93 @@ def main():
         return 0
     sorted_rlist.sort(ratio_cmp)
   else:
-    print "Using consensus bw rankings"
     sorted_rlist.sort(lambda x, y: cmp(y.bw, x.bw))
 
   for i in xrange(len(sorted_rlist)): sorted_rlist[i].list_rank = i
+  return router_map
+
+# The index of each worker process, opened once by open_index().
+_index = None
+
+def open_index(index_path):
+  global _index
+  from torperf_consensus import ConsensusIndex
+  _index = ConsensusIndex(index_path)
+
+def archived_ranks(args):
+  """Ranks of the guards in an .extradata file and its segments in the
+  consensus valid at each LAUNCH, how many guards weren't ranked in it,
+  and how many circuits were launched when no consensus was valid."""
+  file_name, ratio = args
+  ranks = []
+  absent = 0
+  outside = 0
+  for launch, guard in used_guards(segment_lines(file_name)):
+    consensus = None
+    if launch is not None:
+      consensus = _index.at(launch)
+    if consensus is None:
+      outside += 1
+      continue
+    fingerprint = re.split("[~=]", guard, 1)[0].lstrip("$").upper()
+    rank = _index.rank(consensus, fingerprint, ratio)
+    if rank is None:
+      absent += 1
+    else:
+      ranks.append(rank)
+  return ranks, absent, outside
+
+def process_archived_files(index_path, archives, jobs, ratio, file_names):
+  if archives:
+    from torperf_consensus import build_index
+    build_index(index_path, archives, jobs)
+  workers = multiprocessing.Pool(jobs, open_index, (index_path, ))
+  try:
+    results = workers.imap(archived_ranks,
+                           [(file_name, ratio) for file_name in file_names])
+    for file_name, (ranks, absent, outside) in zip(file_names, results):
+      print "Guard rank stats (min, avg, dev, total, absent): "
+      print file_name + ": " + str(rank_stats(ranks, absent))
+      if outside:
+        print "%s: %d circuits launched outside of indexed consensuses" % (
+            file_name, outside)
+  finally:
+    workers.close()
 
-  for file_name in sys.argv[1:]:
+def main():
+  options = [arg for arg in sys.argv[1:] if arg.startswith("--")]
+  file_names = without_segments([arg for arg in sys.argv[1:]
+                                 if not arg.startswith("--")])
+  index_path = None
+  archives = []
+  jobs = None
+  for option in options:
+    if option.startswith("--index="):
+      index_path = option[len("--index="):]
+    elif option.startswith("--archive="):
+      archives.append(option[len("--archive="):])
+    elif option.startswith("--jobs="):
+      jobs = int(option[len("--jobs="):])
+    else:
+      file_names = []
+  if not file_names or (archives and not index_path):
+    print("See script header for usage")
+    sys.exit(1)
+
+  ratio = "ratio" in file_names[0]
+  if ratio:
+    print "Using ratio rankings"
+  else:
+    print "Using consensus bw rankings"
+
+  if index_path:
+    process_archived_files(index_path, archives, jobs, ratio, file_names)
+    return
+
+  router_map = live_rankings(ratio)
+  for file_name in file_names:
     process_file(router_map, file_name)
 
 
 if __name__ == '__main__':
   main()
-
@@ -0,0 +1,87 @@
+#!/usr/bin/python
+#
+# This script writes a synthetic .data file with a year of 50 KiB
+# measurements (one every 5 minutes) to a temporary directory, converts it
+# into a columnar archive with torperf_archive.py, and compares how long
+# it takes to compute median download times from the text file and from
+# the archive.
+#
+# Usage:
+#   ./benchmark-archive.py [number of days]
+###
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+import numpy
+
+from torperf_archive import Archive, convert_data
+
+def timestamp(t):
+  return "%d %d " % (int(t), int((t - int(t)) * 1000000))
+
+def write_data(path, requests):
+  data = open(path, "w")
+  started = 1262304000.0
+  for i in xrange(requests):
+    start = started + i * 300.0
+    complete = start + 2.0 + (i % 7) * 0.25
+    line = [timestamp(start + offset * 0.1) for offset in range(8)]
+    line.append(timestamp(complete))
+    line.append("75 51375 0 ")
+    line.extend([timestamp(start + 1.0 + perc / 100.0)
+                 for perc in range(10, 100, 10)])
+    data.write("".join(line) + "\n")
+  data.close()
+
+def median_from_text(path):
+  times = []
+  for line in open(path):
+    values = line.split()
+    start = int(values[0]) + int(values[1]) / 1000000.0
+    complete = int(values[16]) + int(values[17]) / 1000000.0
+    if complete:
+      times.append(complete - start)
+  times.sort()
+  return times[len(times) / 2]
+
+def median_from_archive(path):
+  archive = Archive(path)
+  complete = archive["DATACOMPLETE"]
+  times = (complete - archive["START"])[complete > 0] / 1e6
+  return numpy.median(times)
+
+def main():
+  if len(sys.argv) > 2:
+    print("See script header for usage")
+    sys.exit(1)
+  days = 365
+  if len(sys.argv) > 1:
+    days = int(sys.argv[1])
+
+  directory = tempfile.mkdtemp()
+  try:
+    data_path = os.path.join(directory, "50kb.data")
+    archive_path = os.path.join(directory, "50kb.archive")
+    write_data(data_path, days * 288)
+    print "%d days, %d requests, %.1f MiB .data" % \
+        (days, days * 288, os.path.getsize(data_path) / 1048576.0)
+
+    started = time.time()
+    convert_data(data_path, archive_path)
+    print "convert once:         %10.1f ms" % ((time.time() - started) * 1000)
+
+    for label, median in (("text", median_from_text),
+                          ("archive", median_from_archive)):
+      started = time.time()
+      result = median(data_path if label == "text" else archive_path)
+      print "median from %-8s  %10.1f ms (%.3f s)" % \
+          (label + ":", (time.time() - started) * 1000, result)
+  finally:
+    shutil.rmtree(directory)
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,88 @@
+#!/usr/bin/python
+#
+# This script writes a synthetic .data file and a matching .extradata file
+# with the given number of requests to a temporary directory, runs each
+# given consolidate-stats script on them, and reports run time, peak
+# memory, and the number of lines written.
+#
+# The .data lines have 21 fields, without DATAPERC timestamps, so that
+# versions of consolidate_stats.py that only know those fields can read
+# them, too.  For example, to compare against the version before the
+# streaming rewrite:
+#
+#   git show <commit>:consolidate_stats.py > /tmp/consolidate_old.py
+#   ./benchmark-consolidate.py 1000000 /tmp/consolidate_old.py \
+#       ./consolidate_stats.py
+#
+# Usage:
+#   ./benchmark-consolidate.py [number of requests] [script ...]
+###
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import subprocess
+
+def timestamp(t):
+  return "%d %d " % (int(t), int((t - int(t)) * 1000000))
+
+def write_files(requests, data_path, extra_path):
+  data = open(data_path, "w")
+  extra = open(extra_path, "w")
+  started = 1262304000.0
+  for i in xrange(requests):
+    start = started + i * 300.0
+    complete = start + 2.0 + (i % 7) * 0.25
+    line = [timestamp(start + offset * 0.1) for offset in range(8)]
+    line.append(timestamp(complete))
+    line.append("75 51375 0\n")
+    data.write("".join(line))
+    if i % 50 == 0:
+      # A circuit that was never used.
+      extra.write("CIRC_ID=%d LAUNCH=%.2f PATH=$A,$B,$C BUILDTIMES=0.5,0.9,1.2 "
+                  "FAIL_REASONS=TIMEOUT\n" % (i * 2 + 1, start))
+    if i % 100 != 0:
+      # Every 100th request has no circuit.
+      extra.write("CIRC_ID=%d LAUNCH=%.2f PATH=$A,$B,$C BUILDTIMES=0.5,0.9,1.2 "
+                  "USED_AT=%.2f USED_BY=%d TIMEOUT=60000 QUANTILE=0.8\n" %
+                  (i * 2, start - 60, complete + 0.01, i))
+  data.close()
+  extra.close()
+
+def run(script, data_path, extra_path, merge_path):
+  started = time.time()
+  process = subprocess.Popen([sys.executable, script, data_path, extra_path,
+                              merge_path], stdout=open(os.devnull, "w"))
+  _, status, usage = os.wait4(process.pid, 0)
+  elapsed = time.time() - started
+  lines = sum(1 for line in open(merge_path))
+  return "%-40s %8.2f s %8.1f MiB %10d lines%s" % \
+      (script, elapsed, usage.ru_maxrss / 1024.0, lines,
+       status and " (exit status %d)" % (status >> 8) or "")
+
+def main():
+  requests = 1000000
+  scripts = ["./consolidate_stats.py"]
+  if len(sys.argv) > 1:
+    requests = int(sys.argv[1])
+  if len(sys.argv) > 2:
+    scripts = sys.argv[2:]
+
+  directory = tempfile.mkdtemp()
+  try:
+    data_path = os.path.join(directory, "bench.data")
+    extra_path = os.path.join(directory, "bench.extradata")
+    merge_path = os.path.join(directory, "bench.mergedata")
+    write_files(requests, data_path, extra_path)
+    print "%d requests, %.1f MiB .data, %.1f MiB .extradata" % \
+        (requests, os.path.getsize(data_path) / 1048576.0,
+         os.path.getsize(extra_path) / 1048576.0)
+    for script in scripts:
+      print run(script, data_path, extra_path, merge_path)
+  finally:
+    shutil.rmtree(directory)
+
+if __name__ == "__main__":
+  main()
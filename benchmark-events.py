@@ -0,0 +1,228 @@
+#!/usr/bin/python
+#
+# This script replays a trace of control port events, as recorded with
+# "python perfdreplay.py record", to one of the programs that follow
+# events, and reports how many events per second it handles, how long its
+# handlers take per event, and how much its memory grows:
+#
+#   perfd        perfd's CircuitTracker, via txtorcon
+#   extra_stats  extra_stats.py's WriteStats, via TorCtl
+#   entrycons    entrycons.py's EntryTracker, via TorCtl, which needs a
+#                trace with ns/all and desc/all-recent answers
+#
+# perfdreplay.py serves the trace from a separate process, as fast as
+# possible or at the given speed relative to the recording.  "synthetic"
+# writes a trace of the given number of circuits, every third of which
+# carries a stream, for the circuit trackers.
+#
+# Usage:
+#   ./benchmark-events.py perfd|extra_stats|entrycons <trace> [speed]
+#   ./benchmark-events.py synthetic <number of circuits> <trace>
+###
+
+import os
+import sys
+import json
+import time
+import shutil
+import resource
+import tempfile
+import threading
+import subprocess
+
+CIRCUIT_EVENTS = ["CIRC", "STREAM", "BUILDTIMEOUT_SET"]
+GUARD_EVENTS = ["NEWCONSENSUS", "NEWDESC", "NS", "GUARD"]
+
+# Give up once no event arrived for this many seconds, after setting up.
+STALL_SECONDS = 10
+
+class Timings:
+  """Handler times of events, until expected events were handled."""
+
+  def __init__(self, expected):
+    self.expected = expected
+    self.latencies = []
+    self.first = None
+    self.last = None
+    self.waiting_since = None
+    self.done = threading.Event()
+
+  def timed(self, handler):
+    def timed_handler(*args):
+      started = time.time()
+      try:
+        return handler(*args)
+      finally:
+        finished = time.time()
+        if self.first is None:
+          self.first = started
+        self.last = finished
+        self.latencies.append(finished - started)
+        if len(self.latencies) >= self.expected:
+          self.done.set()
+    return timed_handler
+
+  def stalled(self):
+    since = self.last or self.waiting_since
+    return since is not None and time.time() > since + STALL_SECONDS
+
+  def wait(self):
+    self.waiting_since = time.time()
+    while not self.done.is_set() and not self.stalled():
+      self.done.wait(1)
+
+  def report(self, setup_seconds, rss_before):
+    handled = len(self.latencies)
+    print "%d of %d events handled" % (handled, self.expected)
+    if not handled:
+      return
+    elapsed = self.last - self.first
+    print "setup %.3f s, events %.3f s, %.0f events/s" % (
+        setup_seconds, elapsed, handled / max(elapsed, 1e-6))
+    latencies = sorted(self.latencies)
+    print "handler time per event: median %.1f us, 99th %.1f us, " \
+          "max %.1f us" % (
+              latencies[handled / 2] * 1e6,
+              latencies[min(handled - 1, handled * 99 / 100)] * 1e6,
+              latencies[-1] * 1e6)
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print "max RSS %d KiB, %d KiB more than before loading the consumer" % (
+        rss, rss - rss_before)
+
+def run_perfd(port, timings):
+  from twisted.internet import endpoints, reactor, task
+  import txtorcon
+  from perfdcircuits import CircuitTracker
+
+  tracker = CircuitTracker("benchmark")
+  for name in ("circ_status_event", "stream_status_event",
+               "buildtimeout_set_event"):
+    setattr(tracker, name, timings.timed(getattr(tracker, name)))
+  def check():
+    if timings.done.is_set() or timings.stalled():
+      reactor.stop()
+  def failed(failure):
+    print failure.getErrorMessage()
+    reactor.stop()
+  d = txtorcon.build_tor_connection(
+      endpoints.TCP4ClientEndpoint(reactor, "127.0.0.1", port),
+      build_state=False)
+  d.addCallback(tracker.listen)
+  d.addCallback(lambda ignored: setattr(timings, "waiting_since", time.time()))
+  d.addErrback(failed)
+  task.LoopingCall(check).start(0.1)
+  reactor.run()
+
+def run_extra_stats(port, timings):
+  from extra_stats import WriteStats
+
+  class TimedWriteStats(WriteStats):
+    circ_status_event = timings.timed(WriteStats.circ_status_event)
+    stream_status_event = timings.timed(WriteStats.stream_status_event)
+    buildtimeout_set_event = timings.timed(WriteStats.buildtimeout_set_event)
+
+  directory = tempfile.mkdtemp()
+  try:
+    stats = TimedWriteStats(port, os.path.join(directory,
+                                               "benchmark.extradata"), False)
+    stats.connect()
+    stats.setup_listener()
+    timings.wait()
+    stats.close_statsfile()
+    stats._conn.close()
+  finally:
+    shutil.rmtree(directory)
+
+def run_entrycons(port, timings):
+  import TorCtl.TorCtl as TorCtl
+  from entrycons import EntryTracker, HOST
+
+  class TimedEntryTracker(EntryTracker):
+    new_consensus_event = timings.timed(EntryTracker.new_consensus_event)
+    new_desc_event = timings.timed(EntryTracker.new_desc_event)
+    ns_event = timings.timed(EntryTracker.ns_event)
+    guard_event = timings.timed(EntryTracker.guard_event)
+
+  conn = TorCtl.connect(HOST, port)
+  conn.set_option("StrictEntryNodes", "1")
+  conn.set_option("UseEntryNodes", "1")
+  TimedEntryTracker(conn, "fast")
+  conn.set_events(GUARD_EVENTS)
+  timings.wait()
+  conn.close()
+
+CONSUMERS = {"perfd": (run_perfd, CIRCUIT_EVENTS),
+             "extra_stats": (run_extra_stats, CIRCUIT_EVENTS),
+             "entrycons": (run_entrycons, GUARD_EVENTS)}
+
+def synthetic_events(circuits):
+  now = 1362528000.0
+  path = ",".join(["$%040X~relay%d" % (hop, hop) for hop in range(3)])
+  for circ_id in xrange(1, circuits + 1):
+    yield now, "CIRC", "%d LAUNCHED PURPOSE=GENERAL" % circ_id
+    for hop in range(3):
+      yield now + 0.3 * (hop + 1), "CIRC", "%d EXTENDED %s PURPOSE=GENERAL" \
+          % (circ_id, ",".join(path.split(",")[:hop + 1]))
+    yield now + 0.9, "CIRC", "%d BUILT %s PURPOSE=GENERAL" % (circ_id, path)
+    if circ_id % 3 == 0:
+      strm_id = circ_id * 2
+      yield now + 1.0, "STREAM", "%d NEW 0 10.0.0.1:80 " \
+          "SOURCE_ADDR=127.0.0.1:%d PURPOSE=USER" % (strm_id,
+                                                    1024 + strm_id % 60000)
+      for status in ("SENTCONNECT", "SUCCEEDED", "CLOSED"):
+        yield now + 1.0, "STREAM", "%d %s %d 10.0.0.1:80 REASON=DONE" % (
+            strm_id, status, circ_id)
+    else:
+      yield now + 1.0, "CIRC", "%d CLOSED %s PURPOSE=GENERAL REASON=FINISHED" \
+          % (circ_id, path)
+    if circ_id % 100 == 0:
+      yield now + 1.0, "BUILDTIMEOUT_SET", "COMPUTED TOTAL_TIMES=1000 " \
+          "TIMEOUT_MS=1500 XM=1000 ALPHA=1.5 CUTOFF_QUANTILE=0.800000"
+    now += 1.0
+
+def serve(trace, speed):
+  """Starts perfdreplay.py and returns the process and its port."""
+  script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        "perfdreplay.py")
+  server = subprocess.Popen([sys.executable, script, "serve", "0", trace,
+                             str(speed)], stdout=subprocess.PIPE,
+                            stderr=open(os.devnull, "w"))
+  line = server.stdout.readline()
+  if not line.startswith("Listening on port "):
+    server.wait()
+    print "perfdreplay.py failed to start"
+    sys.exit(1)
+  return server, int(line.split()[-1])
+
+def main():
+  if len(sys.argv) == 4 and sys.argv[1] == "synthetic":
+    with open(sys.argv[3], "w") as trace:
+      for now, event, text in synthetic_events(int(sys.argv[2])):
+        trace.write(json.dumps({"time": now, "event": event,
+                                "text": text}) + "\n")
+    return
+  if len(sys.argv) not in (3, 4) or sys.argv[1] not in CONSUMERS:
+    print("See script header for usage")
+    sys.exit(1)
+  run, events = CONSUMERS[sys.argv[1]]
+  trace = sys.argv[2]
+  speed = len(sys.argv) == 4 and float(sys.argv[3]) or 0
+  expected = 0
+  with open(trace) as f:
+    # One line at a time, so that the trace doesn't count as memory used.
+    for line in f:
+      if line.strip() and json.loads(line).get("event") in events:
+        expected += 1
+  timings = Timings(expected)
+  rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  server, port = serve(trace, speed)
+  started = time.time()
+  try:
+    run(port, timings)
+  finally:
+    server.terminate()
+    server.wait()
+  timings.report((timings.first or time.time()) - started, rss_before)
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,123 @@
+#!/usr/bin/python
+#
+# This script replays control port events into extra_stats.py's WriteStats
+# as fast as possible and reports how long writing the .extradata file
+# takes with different writer settings, including opening and closing the
+# file for every line like extra_stats.py used to.
+#
+# Events are read from a recording with one JSON object per line, holding
+# the event type as "event" and the event attributes that WriteStats uses,
+# e.g.
+#   {"event": "CIRC", "status": "LAUNCHED", "circ_id": 7,
+#    "arrived_at": 1362528000.25, "path": [], "reason": null,
+#    "remote_reason": null}
+# Without a recording, events of the given number of synthetic circuits
+# are replayed; "record" writes those to a file instead.
+#
+# Usage:
+#   ./benchmark-extra-stats.py [number of circuits | recording]
+#   ./benchmark-extra-stats.py record <number of circuits> <recording>
+###
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+
+from extra_stats import WriteStats
+
+SETTINGS = [("open+close per line", None, "never"),
+            ("write-through", 0, "never"),
+            ("buffered 1s", 1, "never"),
+            ("buffered 1s, fsync", 1, "flush"),
+            ("write-through, fsync", 0, "flush")]
+
+class Event:
+  def __init__(self, attributes):
+    self.__dict__.update(attributes)
+
+class LegacyWriteStats(WriteStats):
+  def write_result(self, result):
+    statsfile = open(self._filename, 'a')
+    statsfile.write(result+"\n")
+    statsfile.close()
+
+def synthetic_events(circuits):
+  now = 1362528000.0
+  path = ["$%040X" % hop for hop in range(3)]
+  for circ_id in xrange(1, circuits + 1):
+    yield {"event": "CIRC", "status": "LAUNCHED", "circ_id": circ_id,
+           "arrived_at": now, "path": [], "reason": None,
+           "remote_reason": None}
+    for hop in range(3):
+      yield {"event": "CIRC", "status": "EXTENDED", "circ_id": circ_id,
+             "arrived_at": now + 0.3 * (hop + 1), "path": path[:hop + 1],
+             "reason": None, "remote_reason": None}
+    yield {"event": "CIRC", "status": "BUILT", "circ_id": circ_id,
+           "arrived_at": now + 0.9, "path": path, "reason": None,
+           "remote_reason": None}
+    if circ_id % 3 == 0:
+      # Every third circuit carries a Torperf stream.
+      strm_id = circ_id * 2
+      for status in ("NEW", "SENTCONNECT", "SUCCEEDED", "CLOSED"):
+        yield {"event": "STREAM", "status": status, "strm_id": strm_id,
+               "circ_id": status != "NEW" and circ_id or 0,
+               "purpose": "USER", "arrived_at": now + 3.0, "reason": None,
+               "remote_reason": None}
+    else:
+      yield {"event": "CIRC", "status": "CLOSED", "circ_id": circ_id,
+             "arrived_at": now + 60.0, "path": path, "reason": "FINISHED",
+             "remote_reason": None}
+    if circ_id % 100 == 0:
+      yield {"event": "BUILDTIMEOUT_SET", "event_name": "BUILDTIMEOUT_SET",
+             "body": "COMPUTED TOTAL_TIMES=1000 TIMEOUT_MS=1500 "
+                     "XM=1000 ALPHA=1.5 CUTOFF_QUANTILE=0.800000",
+             "timeout_ms": 1500, "cutoff_quantile": 0.8}
+    now += 1.0
+
+def replay(stats, events):
+  handlers = {"CIRC": stats.circ_status_event,
+              "STREAM": stats.stream_status_event,
+              "BUILDTIMEOUT_SET": stats.buildtimeout_set_event}
+  for event in events:
+    handlers[event.event](event)
+
+def main():
+  if len(sys.argv) == 4 and sys.argv[1] == "record":
+    with open(sys.argv[3], "w") as recording:
+      for event in synthetic_events(int(sys.argv[2])):
+        recording.write(json.dumps(event) + "\n")
+    return
+  if len(sys.argv) > 2:
+    print("See script header for usage")
+    sys.exit(1)
+  source = len(sys.argv) > 1 and sys.argv[1] or "20000"
+  if os.path.isfile(source):
+    events = [json.loads(line) for line in open(source)]
+  else:
+    events = list(synthetic_events(int(source)))
+  events = [Event(event) for event in events]
+
+  directory = tempfile.mkdtemp()
+  try:
+    print "%d events" % len(events)
+    for label, flush_seconds, fsync in SETTINGS:
+      path = os.path.join(directory, "%s.extradata" % len(os.listdir(
+          directory)))
+      if flush_seconds is None:
+        stats = LegacyWriteStats(0, path, False)
+      else:
+        stats = WriteStats(0, path, False, flush_seconds, fsync)
+      started = time.time()
+      replay(stats, events)
+      stats.close_statsfile()
+      elapsed = time.time() - started
+      print "%-24s %8.3f s %8d lines" % (label, elapsed,
+                                         sum(1 for line in open(path)))
+  finally:
+    shutil.rmtree(directory)
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,116 @@
+#!/usr/bin/python
+#
+# This script writes synthetic hourly consensuses, a file of server
+# descriptors per day, and four .extradata files with a circuit every 5
+# minutes to a temporary directory, and reports how long it takes to index
+# the archives with torperf_consensus.py, to add one more day to the index,
+# and to rank the guards of all circuits with analyze_guards.py --index.
+#
+# Usage:
+#   ./benchmark-guards.py [number of days] [relays per consensus]
+###
+
+import os
+import sys
+import time
+import base64
+import shutil
+import hashlib
+import tempfile
+import subprocess
+
+from torperf_consensus import build_index
+
+STARTED = 1362096000
+HOUR = 60 * 60
+FILES = 4
+
+def descriptor(relay, day):
+  fingerprint = "%040X" % relay
+  return ("router relay%d 10.0.0.1 9001 0 0\n"
+          "published %s\n"
+          "fingerprint %s\n"
+          "bandwidth %d %d %d\n"
+          "router-signature\n"
+          "-----BEGIN SIGNATURE-----\nAAAA\n-----END SIGNATURE-----\n" % (
+              relay, time.strftime("%Y-%m-%d %H:%M:%S",
+                                   time.gmtime(STARTED + day * 24 * HOUR)),
+              " ".join(fingerprint[i:i + 4] for i in range(0, 40, 4)),
+              1000 + (relay * 7919 + day) % 100000, 200000,
+              1000 + (relay * 104729 + day) % 100000))
+
+def b64(data):
+  return base64.b64encode(data).rstrip("=")
+
+def write_day(archives, day, relays):
+  descriptors = [descriptor(relay, day) for relay in xrange(1, relays + 1)]
+  with open(os.path.join(archives, "descriptors-%d" % day), "w") as f:
+    f.write("".join(descriptors))
+  digests = [b64(hashlib.sha1(d).digest()) for d in descriptors]
+  for hour in xrange(24):
+    valid_after = STARTED + (day * 24 + hour) * HOUR
+    lines = ["network-status-version 3", "vote-status consensus"]
+    for keyword, offset in (("valid-after", 0), ("fresh-until", HOUR),
+                            ("valid-until", 3 * HOUR)):
+      lines.append("%s %s" % (keyword, time.strftime(
+          "%Y-%m-%d %H:%M:%S", time.gmtime(valid_after + offset))))
+    for relay in xrange(1, relays + 1):
+      lines.append("r relay%d %s %s 2013-03-01 00:00:00 10.0.0.1 9001 0" % (
+          relay, b64(("%040X" % relay).decode("hex")), digests[relay - 1]))
+      lines.append("s Fast Guard Running Valid")
+      lines.append("w Bandwidth=%d" % ((relay * 31 + hour) % 5000 + 1))
+    lines.append("directory-footer")
+    with open(os.path.join(archives, "consensus-%d-%02d" % (day, hour)),
+              "w") as f:
+      f.write("\n".join(lines) + "\n")
+
+def write_extradata(path, days, relays):
+  with open(path, "w") as f:
+    for i in xrange(days * 288):
+      launch = STARTED + i * 300 + 0.5
+      path = ",".join("$%040X~relay%d" % (relay, relay) for relay in
+                      (i % relays + 1, (i * 3) % relays + 1,
+                       (i * 7) % relays + 1))
+      f.write("CIRC_ID=%d LAUNCH=%s PATH=%s BUILDTIMES=0.3,0.6,0.9 "
+              "USED_AT=%s USED_BY=%d\n" % (i, launch, path, launch + 1, i))
+
+def main():
+  if len(sys.argv) > 3:
+    print("See script header for usage")
+    sys.exit(1)
+  days = len(sys.argv) > 1 and int(sys.argv[1]) or 7
+  relays = len(sys.argv) > 2 and int(sys.argv[2]) or 2000
+
+  directory = tempfile.mkdtemp()
+  try:
+    archives = os.path.join(directory, "archives")
+    index = os.path.join(directory, "index")
+    os.makedirs(archives)
+    for day in xrange(days):
+      write_day(archives, day, relays)
+    extradata = []
+    for i in range(FILES):
+      extradata.append(os.path.join(directory, "ratio%d.extradata" % i))
+      write_extradata(extradata[-1], days, relays)
+    print "%d days, %d consensuses of %d relays, %d .extradata files of " \
+        "%d circuits" % (days, days * 24, relays, FILES, days * 288)
+
+    started = time.time()
+    build_index(index, [archives])
+    print "index:                %10.1f ms" % ((time.time() - started) * 1000)
+    write_day(archives, days, relays)
+    started = time.time()
+    build_index(index, [archives])
+    print "index one more day:   %10.1f ms" % ((time.time() - started) * 1000)
+
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          "analyze_guards.py")
+    started = time.time()
+    subprocess.check_call([sys.executable, script, "--index=" + index] +
+                          extradata, stdout=open(os.devnull, "w"))
+    print "analyze_guards.py:    %10.1f ms" % ((time.time() - started) * 1000)
+  finally:
+    shutil.rmtree(directory)
+
+if __name__ == "__main__":
+  main()
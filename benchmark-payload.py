@@ -0,0 +1,76 @@
+#!/usr/bin/python
+#
+# This script compares the throughput and CPU cost of perfd's
+# RandomDataProducer when reading from os.urandom for every chunk and when
+# slicing a pre-generated RandomDataPool.
+#
+# Usage:
+#   ./benchmark-payload.py [file size in bytes] [number of requests]
+###
+
+import os
+import sys
+import time
+
+from twisted.internet import reactor
+
+from perfd import RandomDataPool, RandomDataProducer
+
+
+class NullConsumer(object):
+  def __init__(self):
+    self.producer = None
+    self.written = 0
+
+  def registerProducer(self, producer, streaming):
+    self.producer = producer
+
+  def unregisterProducer(self):
+    self.producer = None
+
+  def write(self, data):
+    self.written += len(data)
+
+
+def run(label, file_size, requests, pool):
+  written = 0
+  started_cpu = sum(os.times()[:2])
+  started = time.time()
+  for i in xrange(requests):
+    consumer = NullConsumer()
+    RandomDataProducer(file_size, {}, reactor, pool).beginProducing(consumer)
+    while consumer.producer is not None:
+      consumer.producer.resumeProducing()
+    written += consumer.written
+  elapsed = time.time() - started
+  cpu = sum(os.times()[:2]) - started_cpu
+  return "%-8s %10.1f MiB/s %10.3f ms CPU/request" % \
+      (label, written / elapsed / 2 ** 20, cpu * 1000.0 / requests)
+
+def main():
+  if len(sys.argv) > 3:
+    print("See script header for usage")
+    sys.exit(1)
+  file_size = 5242880
+  requests = 50
+  if len(sys.argv) > 1:
+    file_size = int(sys.argv[1])
+  if len(sys.argv) > 2:
+    requests = int(sys.argv[2])
+
+  pool = RandomDataPool(2 ** 24)
+  results = []
+  # The producer prints a line whenever it passes 50%, keep that quiet.
+  stdout = sys.stdout
+  sys.stdout = open(os.devnull, "w")
+  try:
+    for label, p in (("urandom", None), ("pool", pool)):
+      results.append(run(label, file_size, requests, p))
+  finally:
+    sys.stdout = stdout
+  print "%d requests of %d bytes" % (requests, file_size)
+  for result in results:
+    print result
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,74 @@
+#!/usr/bin/python
+#
+# This script measures how many request records per second perfd's
+# ResultStore can insert, and how long a "last 24 hours of 5 MiB results"
+# query takes afterwards.  For comparison, the default perfd setup with
+# 50 KiB, 1 MiB, and 5 MiB downloads makes 288 + 48 + 24 = 360 requests
+# per day.
+#
+# Usage:
+#   ./benchmark-store.py [number of records]
+###
+
+import os
+import sys
+import time
+import tempfile
+
+from perfdstore import ResultStore
+
+SOURCES = ["ec2", "torperf", "siv"]
+FILESIZES = [51200, 1048576, 5242880]
+
+def record(i, now):
+  started = now - 90 * 24 * 60 * 60 + i * 10.0
+  r = {'SOURCE': SOURCES[i % len(SOURCES)],
+       'FILESIZE': FILESIZES[(i / len(SOURCES)) % len(FILESIZES)],
+       'START': started, 'DIDTIMEOUT': 0, 'WRITEBYTES': 80,
+       'READBYTES': 51400}
+  for offset, key in enumerate(['SOCKET', 'CONNECT', 'NEGOTIATE', 'REQUEST',
+                                'RESPONSE', 'DATAREQUEST', 'DATARESPONSE']):
+    r[key] = started + offset * 0.1
+  for perc in range(10, 100, 10):
+    r['DATAPERC%d' % perc] = started + 1 + perc / 100.0
+  r['DATACOMPLETE'] = started + 2.0
+  return r
+
+def main():
+  if len(sys.argv) > 2:
+    print("See script header for usage")
+    sys.exit(1)
+  count = 200000
+  if len(sys.argv) > 1:
+    count = int(sys.argv[1])
+
+  db_fd, db_path = tempfile.mkstemp(suffix=".sqlite")
+  os.close(db_fd)
+  try:
+    store = ResultStore(db_path)
+    now = time.time()
+    records = [record(i, now) for i in xrange(count)]
+    store.start()
+    started = time.time()
+    for r in records:
+      store.add_request(r)
+    queued = time.time() - started
+    store.stop()
+    elapsed = time.time() - started
+    print "%d records: %.0f records/s queued, %.0f records/s committed" % \
+        (count, count / queued, count / elapsed)
+    print "(real measurement rate: 360 records/day = %.4f records/s)" % \
+        (360 / 86400.0)
+
+    started = time.time()
+    results = list(store.requests(source="ec2", filesize=5242880,
+                                  start=records[-1]['START'] - 86400))
+    print "last 24h of 5 MiB results from ec2: %d records in %.2f ms" % \
+        (len(results), (time.time() - started) * 1000)
+  finally:
+    for suffix in ("", "-wal", "-shm"):
+      if os.path.exists(db_path + suffix):
+        os.unlink(db_path + suffix)
+
+if __name__ == "__main__":
+  main()
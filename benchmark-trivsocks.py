@@ -0,0 +1,115 @@
+#!/usr/bin/python
+#
+# This script measures how much trivsocks-client itself adds to download
+# times, by downloading a file over loopback from a SOCKS 5 server in this
+# process that answers every request with the file right away.  Each
+# command is run the given number of times, and the script reports the
+# median time from DATARESPONSE to DATACOMPLETE, the client's median CPU
+# time per download, and how much it wrote to stderr.
+#
+# To compare with an older trivsocks-client, build it elsewhere and pass
+# both, optionally with flags, e.g.:
+#   git show HEAD~1:trivsocks-client.c > /tmp/old/trivsocks-client.c
+#   ./benchmark-trivsocks.py 5242880 20 /tmp/old/trivsocks-client \
+#       ./trivsocks-client "./trivsocks-client -q" "./trivsocks-client -q -d"
+#
+# Usage:
+#   ./benchmark-trivsocks.py <file size> <runs> <command> [command ...]
+###
+
+import os
+import sys
+import resource
+import socket
+import threading
+import subprocess
+
+def read_until(conn, end):
+  data = ""
+  while not data.endswith(end):
+    chunk = conn.recv(1)
+    if not chunk:
+      break
+    data += chunk
+  return data
+
+def read_exactly(conn, count):
+  data = ""
+  while len(data) < count:
+    chunk = conn.recv(count - len(data))
+    if not chunk:
+      break
+    data += chunk
+  return data
+
+def serve(listener, response):
+  while True:
+    conn, address = listener.accept()
+    try:
+      read_exactly(conn, 3)
+      conn.sendall("\x05\x00")
+      request = read_exactly(conn, 4)
+      if request[3:] == "\x03":
+        read_exactly(conn, ord(read_exactly(conn, 1)) + 2)
+      else:
+        read_exactly(conn, 4 + 2)
+      conn.sendall("\x05\x00\x00\x01" + "\x00" * 6)
+      read_until(conn, "\r\n\r\n")
+      conn.sendall(response)
+    finally:
+      conn.close()
+
+def children_cpu():
+  usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+  return usage.ru_utime + usage.ru_stime
+
+def download(command, port, file_size):
+  """Returns seconds from DATARESPONSE to DATACOMPLETE, CPU seconds, bytes
+  written to stderr, and bytes read."""
+  cpu_before = children_cpu()
+  client = subprocess.Popen(command.split() + [
+      "localhost", "127.0.0.1:%d" % port, "/file", str(file_size)],
+      stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+  out, err = client.communicate()
+  cpu = children_cpu() - cpu_before
+  fields = out.split()
+  if client.returncode or len(fields) < 21:
+    print "%s failed: %s" % (command, err.strip().split("\n")[-1])
+    sys.exit(1)
+  response = int(fields[14]) + int(fields[15]) / 1e6
+  complete = int(fields[16]) + int(fields[17]) / 1e6
+  return complete - response, cpu, len(err), int(fields[19])
+
+def median(values):
+  return sorted(values)[len(values) / 2]
+
+def main():
+  if len(sys.argv) < 4:
+    print("See script header for usage")
+    sys.exit(1)
+  file_size = int(sys.argv[1])
+  runs = int(sys.argv[2])
+  response = "HTTP/1.0 200 OK\r\nContent-Length: %d\r\n\r\n%s" % (
+      file_size, os.urandom(file_size))
+  listener = socket.socket()
+  listener.bind(("127.0.0.1", 0))
+  listener.listen(5)
+  server = threading.Thread(target=serve, args=(listener, response))
+  server.daemon = True
+  server.start()
+  port = listener.getsockname()[1]
+  print "%-40s %12s %12s %12s" % ("command", "transfer ms", "CPU ms",
+                                  "stderr KiB")
+  for command in sys.argv[3:]:
+    results = [download(command, port, file_size) for run in range(runs)]
+    for result in results:
+      if result[3] != len(response):
+        print "%s read %d of %d bytes" % (command, result[3], len(response))
+        sys.exit(1)
+    print "%-40s %12.2f %12.2f %12.1f" % (
+        command, median([r[0] for r in results]) * 1000,
+        median([r[1] for r in results]) * 1000,
+        median([r[2] for r in results]) / 1024.0)
+
+if __name__ == "__main__":
+  main()
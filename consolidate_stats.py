@@ -5,140 +5,216 @@
 #
 # The resulting output will be the union of both files. It will match lines
 # where possible, and include unmatched lines from both files as well.
+# Failed requests (DATACOMPLETE of 0) are left out, and circuits that were
+# never used are passed through unmatched.
+#
+# Both files are read and the output is written line by line, so memory
+# use does not grow with the size of the files.  Lines only need to be
+# roughly sorted by DATACOMPLETE and USED_AT: up to [reorder buffer size]
+# lines (default 1000) are held back and passed on in order.  Lines that
+# are out of order by more than that are still merged where possible, and
+# counted as late in the summary that is printed at the end.
+#
+# Files that truncate-data.py or extra_stats.py rotated are read together
+# with their segments, oldest first, so give the names of the files, not
+# of their segments.
 #
 # Usage:
 #   ./consolidate-stats.py <.data file> <.extradata file> <.mergedata file>
+#       [reorder buffer size]
 ###
 
 import sys
+import bisect
+import collections
+import operator
 
-class Data:
-  def __init__(self, filename, mode="r"):
-    self._filename = filename
-    self._file = open(filename, mode)
-    self._curData = None
-    self._retCurrent = False
-
-  def prepline(self):
-    if self._retCurrent:
-      self._retCurrent = False
-      return self._curData
-    line = self._file.readline()
-    if line == "" or line == "\n":
-      raise StopIteration
-    line = line.strip()
-    self._curData = line.split(" ")
-    return self._curData
-
-  def keepCurrent(self):
-    self._retCurrent = True
-
-class TorperfData(Data):
-  def __init__(self, filename):
-    Data.__init__(self, filename)
-    self.fields = "STARTSEC STARTUSEC SOCKETSEC SOCKETUSEC CONNECTSEC CONNECTUSEC NEGOTIATESEC NEGOTIATEUSEC REQUESTSEC REQUESTUSEC RESPONSESEC RESPONSEUSEC DATAREQUESTSEC DATAREQUESTUSEC DATARESPONSESEC DATARESPONSEUSEC DATACOMPLETESEC DATACOMPLETEUSEC WRITEBYTES READBYTES DIDTIMEOUT".split(" ")
+from torperf_segments import segment_lines
+
+DATA_FIELDS = "STARTSEC STARTUSEC SOCKETSEC SOCKETUSEC CONNECTSEC CONNECTUSEC NEGOTIATESEC NEGOTIATEUSEC REQUESTSEC REQUESTUSEC RESPONSESEC RESPONSEUSEC DATAREQUESTSEC DATAREQUESTUSEC DATARESPONSESEC DATARESPONSEUSEC DATACOMPLETESEC DATACOMPLETEUSEC WRITEBYTES READBYTES DIDTIMEOUT".split(" ")
+for perc in range(10, 100, 10):
+  DATA_FIELDS.append("DATAPERC%dSEC" % perc)
+  DATA_FIELDS.append("DATAPERC%dUSEC" % perc)
+
+DATACOMPLETE = DATA_FIELDS.index("DATACOMPLETESEC")
+DATA_KEYS = set(DATA_FIELDS)
+DATA_PREFIXES = [field + "=" for field in DATA_FIELDS]
 
-  def next(self):
-    ret = {}
-    values = self.prepline()
-    for i in xrange(len(values)):
-      ret[self.fields[i]] = values[i]
-    return ret
+class ReorderBuffer:
+  """Passes on (key, line) pairs from an almost sorted iterable in key
+  order, holding back at most size pairs.  Pairs that are out of order by
+  more than that are passed on when they come out of the buffer, and
+  counted in late."""
+
+  def __init__(self, pairs, size):
+    self._pairs = pairs
+    self._size = size
+    self.late = 0
 
   def __iter__(self):
-    return self
+    # Lines are kept sorted in a deque, which for sorted input only ever
+    # appends on the right and takes from the left.  The sequence number
+    # keeps lines with the same key in input order and keeps bisect from
+    # comparing lines.
+    held = collections.deque()
+    last = None
+    seq = 0
+    for key, line in self._pairs:
+      seq += 1
+      if not held or key >= held[-1][0]:
+        held.append((key, seq, line))
+      else:
+        position = bisect.bisect(held, (key, seq))
+        held.rotate(-position)
+        held.appendleft((key, seq, line))
+        held.rotate(position)
+      if len(held) > self._size:
+        key, _, line = held.popleft()
+        if last is not None and key < last:
+          self.late += 1
+        else:
+          last = key
+        yield key, line
+    for key, _, line in held:
+      if last is not None and key < last:
+        self.late += 1
+      yield key, line
 
-class ExtraData(Data):
-  def __init__(self, filename):
-    Data.__init__(self, filename)
+class TorperfData:
+  """Successful requests from a .data file as (DATACOMPLETE, values)."""
 
-  def next(self):
-    cont = self.prepline()
+  def __init__(self, filename):
+    self._lines = segment_lines(filename)
+    self.lineno = 0
 
-    ret = {}
-    for i in cont:
-      if not "=" in i:
-        ret[i] = ""
+  def __iter__(self):
+    for line in self._lines:
+      self.lineno += 1
+      values = line.split()
+      if len(values) <= DATACOMPLETE + 1:
+        if values:
+          print >>sys.stderr, "Skipping short .data line %d" % self.lineno
         continue
-      pair = i.split("=")
-      ret[pair[0]] = pair[1]
+      end = int(values[DATACOMPLETE]) + \
+            int(values[DATACOMPLETE + 1]) / 1000000.0
+      if not end:
+        # Skip failures
+        continue
+      yield end, values
+
+class ExtraData:
+  """Used circuits from an .extradata file as (USED_AT, (key=value tokens,
+  keys that are also .data fields)).  Circuits that were never used are
+  written to unused right away, lines without CIRC_ID are ignored."""
 
-    if not "CIRC_ID" in ret:
-      #print('Ignoring line "' + " ".join(cont) + '"')
-      return self.next()
-    return ret
+  def __init__(self, filename, unused):
+    self._lines = segment_lines(filename)
+    self._unused = unused
 
   def __iter__(self):
-    return self
+    for line in self._lines:
+      if "CIRC_ID" not in line:
+        continue
+      tokens = line.split()
+      keys = [token.partition("=")[0] for token in tokens]
+      circ = "CIRC_ID" in keys
+      used_at = None
+      if "USED_AT" in keys:
+        used_at = tokens[keys.index("USED_AT")][8:]
+      overrides = DATA_KEYS.intersection(keys) or None
+      if len(keys) != line.count("="):
+        tokens = [token if "=" in token else token + "=" for token in tokens]
+      if not circ:
+        continue
+      if not used_at:
+        self._unused.writeTokens(tokens)
+        continue
+      yield float(used_at), (tokens, overrides)
 
-class MergeData(Data):
+class MergeData:
   def __init__(self, filename):
-    Data.__init__(self, filename, "w")
-
-  def writeLine(self, data):
-    line = []
-    for key in data.iterkeys():
-      line.append(key+"="+data[key])
-    line.sort()
-    self._file.write(" ".join(line) + "\n")
+    self._file = open(filename, "w")
+    # .data fields in output order, by number of fields in the line.
+    self._orders = {}
+
+  def writeTokens(self, tokens):
+    tokens.sort()
+    self._file.write(" ".join(tokens) + "\n")
+
+  def writeData(self, values, extra=None):
+    count = min(len(values), len(DATA_FIELDS))
+    if count not in self._orders:
+      order = sorted(range(count), key=DATA_FIELDS.__getitem__)
+      self._orders[count] = ([DATA_PREFIXES[i] for i in order],
+                             operator.itemgetter(*order))
+    prefixes, getter = self._orders[count]
+    tokens = map(operator.add, prefixes, getter(values))
+    if not extra:
+      self._file.write(" ".join(tokens) + "\n")
+      return
+    extra_tokens, overrides = extra
+    if overrides:
+      # Values from the .extradata file win, like they always did.
+      tokens = [token for token in tokens
+                if token.split("=", 1)[0] not in overrides]
+    self.writeTokens(tokens + extra_tokens)
+
+  def close(self):
+    self._file.close()
+
+def merge(data, extra, out, slack):
+  """Merge-joins two streams of (time, line) pairs sorted by time.  Lines
+  that are at most slack seconds apart are written as one line, everything
+  else on its own."""
+  counts = {"merged": 0, "data": 0, "extra": 0}
+  data = iter(data)
+  extra = iter(extra)
+  d = next(data, None)
+  e = next(extra, None)
+  while d is not None and e is not None:
+    if abs(d[0] - e[0]) <= slack:
+      out.writeData(d[1], e[1])
+      counts["merged"] += 1
+      d = next(data, None)
+      e = next(extra, None)
+    elif d[0] < e[0]:
+      out.writeData(d[1])
+      counts["data"] += 1
+      d = next(data, None)
+    else:
+      out.writeTokens(e[1][0])
+      counts["extra"] += 1
+      e = next(extra, None)
+  while d is not None:
+    out.writeData(d[1])
+    counts["data"] += 1
+    d = next(data, None)
+  while e is not None:
+    out.writeTokens(e[1][0])
+    counts["extra"] += 1
+    e = next(extra, None)
+  return counts
 
 def main():
-  if len(sys.argv) != 4:
+  if len(sys.argv) not in (4, 5):
     print("See script header for usage")
     sys.exit(1)
+  buffer_size = 1000
+  if len(sys.argv) == 5:
+    buffer_size = int(sys.argv[4])
 
-  torperfdata = TorperfData(sys.argv[1])
-  extradata = ExtraData(sys.argv[2])
   mergedata = MergeData(sys.argv[3])
+  torperfdata = ReorderBuffer(TorperfData(sys.argv[1]), buffer_size)
+  extradata = ReorderBuffer(ExtraData(sys.argv[2], mergedata), buffer_size)
   slack = 1.0 # More than 1s means something is really, really wrong
-  lastDataTime = 0
-  lastExtraTime = 0
-  dataLine = 0
-  extraLine = 0
-  mergedYet = False
-  for data in torperfdata:
-    dataLine += 1
-    dataEndTime = int(data["DATACOMPLETESEC"])
-    dataEndTime += int(data["DATACOMPLETEUSEC"])/1000000.0
-    if not dataEndTime:
-      # Skip failures
-      continue
-
-    if lastDataTime > dataEndTime:
-      print "Torperf .data is not monotonic! Sort it by completion time!"
-      print "Line "+str(dataLine)+" "+str(lastDataTime)+" > "+str(dataEndTime)
-      sys.exit(0)
-    lastDataTime = dataEndTime
-    for extra in extradata:
-      extraLine += 1
-      if not "USED_AT" in extra or not extra["USED_AT"]:
-        mergedata.writeLine(extra)
-        continue # Failed circ
-
-      extraEndTime = float(extra["USED_AT"])
-      if lastExtraTime > extraEndTime:
-        print "The .extradata is not monotonic! Sort it by USED_AT!"
-        print "Line "+str(extraLine)+" "+str(lastExtraTime)+" > "+str(extraEndTime)
-        sys.exit(0)
-      lastExtraTime = extraEndTime
-      if abs(dataEndTime - extraEndTime) > slack:
-        if dataEndTime < extraEndTime:
-          if mergedYet:
-            print("Got a data line at "+str(dataLine)+ " without extradata (line "+str(extraLine)+")")
-          extradata.keepCurrent()
-          extraLine -= 1
-          mergedata.writeLine(data)
-        else:
-          torperfdata.keepCurrent()
-          dataLine -= 1
-          mergedata.writeLine(extra)
-        break
-
-      mergedYet = True
-      data.update(extra)
-      mergedata.writeLine(data)
-      break
-
+  counts = merge(torperfdata, extradata, mergedata, slack)
+  mergedata.close()
+  print("Merged %d lines, %d .data lines without extradata, %d .extradata "
+        "lines without data" % (counts["merged"], counts["data"],
+                                counts["extra"]))
+  if torperfdata.late or extradata.late:
+    print("%d .data and %d .extradata lines were out of order by more than "
+          "%d lines" % (torperfdata.late, extradata.late, buffer_size))
 
 if __name__ == "__main__":
   main()
@@ -2,7 +2,8 @@
 import sys, time
 import TorCtl.TorCtl as TorCtl
 import TorCtl.TorUtil as TorUtil
-import copy
+
+from torperf_guards import GuardRanking, SPEED_KEYS, ratio
 
 HOST = "127.0.0.1"
 
@@ -10,12 +11,14 @@ SAMPLE_SIZE = 3
 DESCRIPTORS_NEEDED = 0.99 # 99% of descriptors must be downloaded
 
 class EntryTracker(TorCtl.ConsensusTracker):
-  used_entries = []
+  used_entries = set()
 
   def __init__(self, conn, speed):
     TorCtl.ConsensusTracker.__init__(self, conn, consensus_only=False)
     self.speed = speed
-    self.used_entries = []
+    self.ranking = GuardRanking(speed)
+    self.ranking.rebuild(self.current_consensus().sorted_r)
+    self.used_entries = self.ranking.used
     if self.consensus_count < DESCRIPTORS_NEEDED*len(self.ns_map):
       TorUtil.plog("NOTICE",
          "Insufficient routers to choose new guard. Waiting for more..")
@@ -24,15 +27,32 @@ class EntryTracker(TorCtl.ConsensusTracker):
       self.set_entries()
       self.need_guards = False
 
+  def current_routers(self):
+    return dict((idhex, r) for idhex, r in self.routers.iteritems()
+                if idhex in self.ns_map)
+
+  def update_ranking(self, idhexes):
+    for idhex in idhexes:
+      if idhex in self.ns_map:
+        self.ranking.update(idhex, self.routers.get(idhex))
+      else:
+        self.ranking.update(idhex, None)
+
   def new_consensus_event(self, n):
     TorCtl.ConsensusTracker.new_consensus_event(self, n)
+    self.ranking.rebuild(self.current_consensus().sorted_r)
     self.need_guards = True
 
+  def ns_event(self, n):
+    TorCtl.ConsensusTracker.ns_event(self, n)
+    self.update_ranking([ns.idhex for ns in n.nslist])
+
   def new_desc_event(self, n):
     TorCtl.ConsensusTracker.new_desc_event(self, n)
+    self.update_ranking(n.idlist)
     if self.need_guards and self.consensus_count >= DESCRIPTORS_NEEDED*len(self.ns_map):
       TorUtil.plog("INFO", "We have enough routers. Rejoice!")
-      self.used_entries = []
+      self.ranking.reset(self.current_routers())
       self.set_entries()
       self.need_guards = False
     else:
@@ -54,7 +74,12 @@ class EntryTracker(TorCtl.ConsensusTracker):
       nodes_list = nodes_tuple[0][1].split(",")
       try: 
         nodes_list.remove(event.idhex)
-        nodes_list.append(self.get_next_guard())
+        next_guard = self.get_next_guard()
+        if next_guard is None:
+          TorUtil.plog("WARN", "No unused guard left to replace " +
+                       event.nick + ":" + event.idhex + " with!")
+          return
+        nodes_list.append(next_guard)
         self.c.set_option("EntryNodes", ",".join(nodes_list))
         TorUtil.plog("NOTICE", "Entry: " + event.nick + ":" + event.idhex +
                      " died, and we replaced it with: " + nodes_list[-1] + "!")
@@ -66,61 +91,23 @@ class EntryTracker(TorCtl.ConsensusTracker):
                      "is not in nodes_list! Mysterioush!")
         TorUtil.plog("INFO", "It was: " + event.nick + " : " + event.idhex)
 
-  def sort_routers(self, sorted_routers):
-    routers = copy.copy(sorted_routers)
-    def ratio_cmp(r1, r2):
-      if r1.bw/float(r1.desc_bw) > r2.bw/float(r2.desc_bw):
-        return -1
-      elif r1.bw/float(r1.desc_bw) < r2.bw/float(r2.desc_bw):
-        return 1
-      else:
-        return 0
-
-    if self.speed == "fast":
-      pass # no action needed
-    elif self.speed == "slow":
-      routers.reverse()
-    elif self.speed == "fastratio":
-      routers.sort(ratio_cmp)
-    elif self.speed == "slowratio":
-      routers.sort(lambda x,y: ratio_cmp(y,x))
-
-    # Print top 3 routers + ratios
-    if len(routers) < SAMPLE_SIZE:
-      TorUtil.plog("WARN", "Only "+str(len(routers))+" in our list!")
-    else:
-      for i in xrange(SAMPLE_SIZE):
-        TorUtil.plog("INFO", self.speed+" router "+routers[i].nickname+" #"+str(i)+": "
-                      +str(routers[i].bw)+"/"+str(routers[i].desc_bw)+" = "
-                      +str(routers[i].bw/float(routers[i].desc_bw)))
-
-    return routers
+  def log_entry(self, i, idhex):
+    r = self.routers[idhex]
+    TorUtil.plog("INFO", self.speed+" router "+r.nickname+" #"+str(i)+": "
+                  +str(r.bw)+"/"+str(r.desc_bw)+" = "+str(ratio(r)))
 
   def get_next_guard(self):
-    # XXX: This is inefficient, but if we do it now, we're sure that
-    # we're always using the very latest networkstatus and descriptor data
-    sorted_routers = self.sort_routers(self.current_consensus().sorted_r)
-
-    i = 0
-    while (1):
-      if ((sorted_routers[i].idhex not in self.used_entries) and
-          (not sorted_routers[i].down
-           and "Guard" in sorted_routers[i].flags)):
-        self.used_entries.append(sorted_routers[i].idhex)
-        return sorted_routers[i].idhex
-      i += 1
+    return self.ranking.next_unused()
 
   def set_entries(self):
-    # XXX: This is inefficient, but if we do it now, we're sure that
-    # we're always using the very latest networkstatus and descriptor data
-    sorted_routers = self.sort_routers(self.current_consensus().sorted_r)
-
     entry_nodes = []
-    for i in xrange(len(sorted_routers)):
-      if len(entry_nodes) >= SAMPLE_SIZE: break
-      if (not sorted_routers[i].down and "Guard" in sorted_routers[i].flags):
-        entry_nodes.append(sorted_routers[i].idhex)
-        self.used_entries.append(sorted_routers[i].idhex)
+    while len(entry_nodes) < SAMPLE_SIZE:
+      idhex = self.ranking.next_unused()
+      if idhex is None:
+        TorUtil.plog("WARN", "Only "+str(len(entry_nodes))+" in our list!")
+        break
+      self.log_entry(len(entry_nodes), idhex)
+      entry_nodes.append(idhex)
     self.c.set_option("EntryNodes", ",".join(entry_nodes))
     TorUtil.plog("NOTICE", self.speed+": Changed EntryNodes to: " +
                    ",".join(map(lambda x: self.ns_map[x].nickname+"="+x,
@@ -137,7 +124,7 @@ def main():
   port = int(sys.argv[1])
   speed = sys.argv[2]
 
-  if not speed in ("fast", "slow", "fastratio", "slowratio"):
+  if not speed in SPEED_KEYS:
     TorUtil.plog("ERROR",
         "Second parameter must be 'fast', 'slow', 'fastratio', or 'slowratio'")
     return
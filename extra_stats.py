@@ -1,36 +1,33 @@
 #!/usr/bin/python
 
-import os, re, sys, time
+import os, re, sys, time, signal
 import TorCtl.TorUtil as TorUtil
 import TorCtl.TorCtl as TorCtl
 
-HOST = "127.0.0.1"
+from torperf_segments import SegmentedFile, extradata_timestamp
+from torperf_segments import SEGMENT_SECONDS, FSYNC_POLICIES
+from torperf_circuits import Circuit, InFlightTable
+from torperf_circuits import CIRCUIT_MAX_AGE, STREAM_MAX_AGE
 
-class Circuit:
-  def __init__(self, launch_time, circ_id):
-    self.circ_id = circ_id
-    self.launch_time = launch_time
-    self.close_time = launch_time
-    self.stream_end_time = 0
-    self.path = []
-    self.build_times = []
-    self.failed = False
-    self.fail_reason = None
-    self.used = False
-    self.strm_id = 0
-    self.stream_failed = False
-    self.stream_fail_reason = None
+HOST = "127.0.0.1"
 
 class WriteStats(TorCtl.PostEventListener):
-  def __init__(self, port, filename, truncate):
+  def __init__(self, port, filename, truncate, flush_seconds=0,
+               fsync="never"):
     TorCtl.PostEventListener.__init__(self)
     self._port = int(port)
     self._filename = filename
     self.truncate = truncate
-    self.first_launched = None
+    # Stays open, and is only rotated with truncate.
+    self._statsfile = SegmentedFile(filename, extradata_timestamp,
+                                    truncate and SEGMENT_SECONDS or None,
+                                    flush_seconds=flush_seconds, fsync=fsync)
     self._conn = None
-    self.all_circs = {}
-    self.ignore_streams = {}
+    # Circuits and streams that Tor never reports as closed are evicted
+    # after a day, see torperf_circuits.py.
+    self.all_circs = InFlightTable(CIRCUIT_MAX_AGE)
+    self.ignore_streams = InFlightTable(STREAM_MAX_AGE)
+    self._logged_evictions = (0, 0)
     self.current_timeout = None
     self.current_quantile = None
     self.truncate_statsfile()
@@ -55,11 +52,11 @@ class WriteStats(TorCtl.PostEventListener):
     self.current_quantile = b.cutoff_quantile
     result = b.event_name + " " +b.body
     self.write_result(result)
-    self.truncate_statsfile()
 
   def circ_status_event(self, c):
     if c.status == "LAUNCHED":
-      self.all_circs[c.circ_id] = Circuit(c.arrived_at, c.circ_id)
+      self.all_circs.add(c.circ_id, Circuit(c.arrived_at, c.circ_id),
+                         c.arrived_at)
     elif c.circ_id not in self.all_circs:
       return
 
@@ -67,19 +64,19 @@ class WriteStats(TorCtl.PostEventListener):
     if c.status == "EXTENDED":
       circ.build_times.append(c.arrived_at-circ.launch_time)
     elif c.status == "BUILT":
-      circ.path = c.path
+      circ.path = tuple(c.path)
     elif c.status == "FAILED":
       circ.fail_reason = c.reason
       if c.remote_reason: circ.fail_reason += ":"+c.remote_reason
-      circ.path = c.path
+      circ.path = tuple(c.path)
       circ.close_time = c.arrived_at
       circ.failed = True
       self.write_circ(circ)
-      del self.all_circs[c.circ_id]
+      self.all_circs.pop(c.circ_id)
     elif c.status == "CLOSED":
       circ.close_time = c.arrived_at
       self.write_circ(circ)
-      del self.all_circs[c.circ_id]
+      self.all_circs.pop(c.circ_id)
 
   def write_circ(self, circ):
     result = "CIRC_ID=%d LAUNCH=%s PATH=%s BUILDTIMES=%s " \
@@ -98,16 +95,15 @@ class WriteStats(TorCtl.PostEventListener):
          (self.current_timeout, self.current_quantile)
 
     self.write_result(result)
-    self.truncate_statsfile()
 
   def stream_status_event(self, event):
     if event.status == "NEW":
       if event.purpose != "USER":
-        self.ignore_streams[event.strm_id] = True
+        self.ignore_streams.add(event.strm_id, True, event.arrived_at)
       return
     if event.strm_id in self.ignore_streams:
       if event.status == "CLOSED":
-        del self.ignore_streams[event.strm_id]
+        self.ignore_streams.pop(event.strm_id)
       return
     if event.circ_id not in self.all_circs:
       if event.circ_id:
@@ -131,82 +127,88 @@ class WriteStats(TorCtl.PostEventListener):
       # We have no explicit assurance here that tor will not
       # try to reuse this circuit later... But we should
       # print out a warn above if that happens.
-      del self.all_circs[event.circ_id]
+      self.all_circs.pop(event.circ_id)
       # Some STREAM FAILED events are paired with a CLOSED, some are not :(
       if event.status == "FAILED":
-        self.ignore_streams[event.strm_id] = True
+        self.ignore_streams.add(event.strm_id, True, event.arrived_at)
     if event.status == 'CLOSED':
       assert not circ.strm_id or circ.stream_failed
       circ.used = True
       circ.strm_id = event.strm_id
       circ.stream_end_time = event.arrived_at
       self.write_circ(circ)
-      del self.all_circs[event.circ_id]
+      self.all_circs.pop(event.circ_id)
+
+  def log_evictions(self):
+    evicted = (self.all_circs.evicted, self.ignore_streams.evicted)
+    if evicted != self._logged_evictions:
+      TorUtil.plog("NOTICE",
+           "Evicted %d circuits and %d streams that were never closed, "
+           "%d and %d in flight" % (evicted + (len(self.all_circs),
+                                               len(self.ignore_streams))))
+      self._logged_evictions = evicted
 
   def write_result(self, result):
-    # XXX: hrmm. seems wasteful to keep opening+closing..
-    # XXX: When changing this, also change truncated_statsfile().
-    statsfile = open(self._filename, 'a')
-    statsfile.write(result+"\n")
-    statsfile.close()
+    self._statsfile.write(result+"\n")
 
   def truncate_statsfile(self):
-    if not self.truncate:
-      return
-    launched_str = "^.*LAUNCH=([\\d]*).*$"
-    if not self.first_launched:
-      if os.path.isfile(self._filename):
-        launched_re = re.compile(launched_str)
-        with open(self._filename) as statsfile:
-          for line in statsfile:
-            m = launched_re.match(line)
-            if m:
-              self.first_launched = int(m.group(1))
-              break
-      if not self.first_launched:
-        self.first_launched = time.time()
-    now = time.time()
-    if self.first_launched < now - 7 * 24 * 60 * 60:
-      copylines = False
-      statsfilebak_path = self._filename + ".bak"
-      statsfilebak_file = open(statsfilebak_path, "w")
-      launched_re = re.compile(launched_str)
-      with open(self._filename) as statsfile:
-        for line in statsfile:
-          if copylines:
-            statsfilebak_file.write(line)
-          else:
-            m = launched_re.match(line)
-            if m and int(m.group(1)) >= now - 4 * 24 * 60 * 60:
-              statsfilebak_file.write(line)
-              copylines = True
-      statsfilebak_file.close()
-      os.rename(statsfilebak_path, self._filename)
+    # Rotates the stats file into daily segments and deletes those older
+    # than 4 days, see torperf_segments.py.  write_result() does the same
+    # before each write.
+    self._statsfile.maintain()
+
+  def flush_statsfile(self, due_only=False):
+    self._statsfile.flush(due_only=due_only)
+
+  def close_statsfile(self):
+    self._statsfile.close()
+
+class Stop(Exception):
+  pass
+
+def stop(signum, frame):
+  raise Stop()
 
 def main():
-  if len(sys.argv) < 3 or len(sys.argv) > 4:
+  options = [arg for arg in sys.argv[1:] if arg.startswith("--")]
+  args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+  if len(args) != 2:
     print "Bad arguments"
     sys.exit(1)
+  port, filename = args
 
   truncate = False
-  if (sys.argv[1] == "--truncate"):
-    truncate = True
-    port = sys.argv[2]
-    filename = sys.argv[3]
-  else:
-    port = sys.argv[1]
-    filename = sys.argv[2]
-
-  stats = WriteStats(port, filename, truncate)
+  flush_seconds = 0
+  fsync = "never"
+  for option in options:
+    if option == "--truncate":
+      truncate = True
+    elif option.startswith("--flush-seconds="):
+      flush_seconds = float(option[len("--flush-seconds="):])
+    elif option.startswith("--fsync=") and \
+         option[len("--fsync="):] in FSYNC_POLICIES:
+      fsync = option[len("--fsync="):]
+    else:
+      print "Bad arguments"
+      sys.exit(1)
+
+  stats = WriteStats(port, filename, truncate, flush_seconds, fsync)
+  signal.signal(signal.SIGTERM, stop)
+  signal.signal(signal.SIGINT, stop)
   stats.connect()
   stats.setup_listener()
   try:
     # XXX: join instead
     while True:
-      time.sleep(500)
-  except:
+      # Events arrive in TorCtl's thread, so buffered lines that no new
+      # event flushes are flushed from here.
+      time.sleep(flush_seconds or 500)
+      stats.flush_statsfile(due_only=True)
+      stats.log_evictions()
+  except Stop:
     pass
+  finally:
+    stats.close_statsfile()
 
 if __name__ == '__main__':
   main()
-
@@ -0,0 +1,105 @@
+#!/usr/bin/python
+#
+# This script starts perfd's UrandomResourceDispatcher on a local port,
+# lets a number of concurrent client processes download payloads from it,
+# and reports how many bytes per second the server sent.
+#
+# Modes are "pull" (RandomDataProducer), "push" (StreamingDataProducer)
+# and "sendfile" (SendfileDataProducer with a file-backed payload pool).
+#
+# Usage:
+#   ./loadtest-payload.py <pull|push|sendfile> [clients] [requests per
+#       client] [file size in bytes]
+###
+
+import os
+import sys
+import time
+import socket
+import tempfile
+import multiprocessing
+
+from twisted.internet import reactor, task
+from twisted.web import server
+
+from perfd import RandomDataPool, UrandomResourceDispatcher
+
+
+class CountingSite(server.Site):
+  def __init__(self, resource):
+    server.Site.__init__(self, resource)
+    self.sent_bytes = 0
+    self.finished_requests = 0
+
+  def log(self, request):
+    self.sent_bytes += request.sentLength
+    self.finished_requests += 1
+
+
+def fetch(args):
+  port, file_size, requests = args
+  buf = bytearray(2 ** 16)
+  received = 0
+  for i in xrange(requests):
+    s = socket.create_connection(("127.0.0.1", port))
+    s.sendall("GET /%d HTTP/1.0\r\n\r\n" % file_size)
+    while True:
+      n = s.recv_into(buf)
+      if not n:
+        break
+      received += n
+    s.close()
+  return received
+
+def main():
+  if len(sys.argv) < 2 or len(sys.argv) > 5 or \
+     sys.argv[1] not in ("pull", "push", "sendfile"):
+    print("See script header for usage")
+    sys.exit(1)
+  mode = sys.argv[1]
+  clients = 24
+  requests = 10
+  file_size = 5242880
+  if len(sys.argv) > 2:
+    clients = int(sys.argv[2])
+  if len(sys.argv) > 3:
+    requests = int(sys.argv[3])
+  if len(sys.argv) > 4:
+    file_size = int(sys.argv[4])
+
+  payload_path = None
+  if mode == "sendfile":
+    payload_fd, payload_path = tempfile.mkstemp(suffix=".payload")
+    os.close(payload_fd)
+  pool = RandomDataPool(2 ** 24, payload_path)
+  site = CountingSite(UrandomResourceDispatcher(pool, mode != "pull"))
+  site.noisy = False
+  port = reactor.listenTCP(0, site, interface="127.0.0.1").getHost().port
+
+  # Fork the clients before the reactor runs, and keep stdout quiet while
+  # the server prints its per-request progress lines.
+  workers = multiprocessing.Pool(clients)
+  started = time.time()
+  result = workers.map_async(fetch, [(port, file_size, requests)] * clients)
+  stdout = sys.stdout
+  sys.stdout = open(os.devnull, "w")
+
+  def check_done():
+    if result.ready():
+      reactor.stop()
+  task.LoopingCall(check_done).start(0.05)
+  reactor.run()
+  elapsed = time.time() - started
+  sys.stdout = stdout
+  workers.close()
+  if payload_path:
+    os.unlink(payload_path)
+
+  print "%s: %d clients, %d requests of %d bytes" % \
+      (mode, clients, site.finished_requests, file_size)
+  print "server sent %.1f MiB/s, clients received %.1f MiB/s" % \
+      (site.sent_bytes / elapsed / 2 ** 20,
+       sum(result.get()) / elapsed / 2 ** 20)
+
+if __name__ == "__main__":
+  main()
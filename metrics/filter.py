@@ -0,0 +1,351 @@
+#!/usr/bin/python
+#
+# A NumPy version of filter.R that reads Torperf files as specified on the
+# command line and writes a filtered version to filtered.csv for later
+# processing, see HOWTO.  The output has the same columns and formatting
+# as the output of filter.R, so timematrix.R can read either one.
+#
+# Files are parsed in a pool of worker processes, one file per task, and
+# every column is derived for a whole file at once.  The results are
+# concatenated once at the end instead of growing a data frame per file.
+#
+# .data files that truncate-data.py rotated are read together with their
+# segments, oldest first, and segments of files that are given too are
+# skipped, so that *.data* reads every line once.
+#
+# Files may also be .data archives written by ../torperf_archive.py, which
+# saves parsing them again.  They are named like .data files, e.g.
+# torperf-50kb.archive, and can be mixed with .data files.  With
+# -archive=DIR the output is written as an archive to DIR instead of to
+# filtered.csv.
+#
+# With -state=FILE only lines that were appended to the .data files since
+# the last run are read, and their rows are appended to filtered.csv.
+# FILE keeps a checkpoint of each .data file, see ../torperf_ingest.py for
+# how files that truncate-data.py rewrote are handled.  Start times are
+# then always printed with seconds, so that all rows have the same format.
+# If filtered.csv doesn't exist, all lines are read again.
+#
+# completemillis is the time from START to DATACOMPLETE.  filter.R takes
+# the microseconds of START from WRITEBYTES instead of STARTUSEC, which
+# made its times up to a second too long; this script uses STARTUSEC.
+#
+# Usage:
+#   ./filter.py [-start=DATE] [-end=DATE] [-processes=N]
+#       [-archive=DIR | -state=FILE] FILENAME(S)
+#
+# filenames must be of the form guardname-basesizeSUFFIX.data where SUFFIX
+# is one of kb, mb, gb, tb, and dates are YYYY-MM-DD[ HH:MM[:SS]] in local
+# time, like in filter.R.
+#
+# eg: ./filter.py -start=2011-02-01 -end=2099-12-31 *.data
+# eg: ./filter.py -processes=4 torperf-50kb.data torperf-1mb.archive
+# eg: ./filter.py -state=filtered.state torperf-50kb.data
+###
+
+import os
+import sys
+import time
+import calendar
+import unittest
+import tempfile
+import shutil
+import multiprocessing
+
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                ".."))
+from torperf_archive import Archive, ArchiveWriter, convert_data, load_data
+from torperf_archive import TorperfFile, load_data_lines
+from torperf_ingest import Checkpoints, IncrementalFile
+from torperf_segments import without_segments
+
+DEFAULT_START = "2011-02-01"
+DEFAULT_END = "2099-12-31"
+
+COLUMNS = ["started", "timeout", "failure", "completemillis", "guards",
+           "filesize"]
+
+DATE_FORMATS = ["%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%d"]
+
+def parse_date(text):
+  """Seconds since the epoch of a date in local time."""
+  for date_format in DATE_FORMATS:
+    try:
+      return int(time.mktime(time.strptime(text, date_format)))
+    except ValueError:
+      pass
+  raise ValueError("dates must be of the form YYYY-MM-DD[ HH:MM[:SS]], you "
+                   "said \"%s\"" % text)
+
+def filter_file(task):
+  """Reads one file and derives the filter.R columns for requests that were
+  started between start and end, both in seconds, and only reads new lines
+  if given an IncrementalFile.  Runs in a worker process, so it returns the
+  IncrementalFile with its new checkpoint, too."""
+  torperf_file, start, end, incremental = task
+  names = ["START", "DATACOMPLETE", "READBYTES"]
+  if incremental:
+    columns = load_data_lines(incremental.lines(), names)
+  else:
+    columns = load_data(torperf_file.filename, names)
+  started = columns["START"] // 1000000
+  keep = (started >= start) & (started <= end)
+  started = started[keep]
+  begun = columns["START"][keep]
+  completed = columns["DATACOMPLETE"][keep]
+  read = columns["READBYTES"][keep]
+  complete = completed // 1000000 > 0
+  enough = read >= torperf_file.filesize
+  millis = numpy.round((completed - begun) / 1000.0)
+  return ({"started": started,
+           "timeout": ~complete,
+           "failure": complete & ~enough,
+           "completemillis": numpy.where(complete & enough, millis,
+                                         numpy.nan)}, incremental)
+
+class Filtered:
+  """The filtered requests of all files.  Labels are kept once per file,
+  the other columns are concatenated."""
+
+  def __init__(self, torperf_files, results):
+    self.labels = [(torperf_file.guard_label, torperf_file.filesize_label,
+                    len(result["started"]))
+                   for torperf_file, result in zip(torperf_files, results)]
+    self.columns = {}
+    for name in COLUMNS[:4]:
+      self.columns[name] = numpy.concatenate([result[name]
+                                              for result in results])
+
+  def __len__(self):
+    return len(self.columns["started"])
+
+  def _label_column(self, index):
+    column = []
+    for labels in self.labels:
+      column.extend([labels[index]] * labels[2])
+    return column
+
+  def _started_strings(self, seconds):
+    # Like R, print seconds only if any start time has them, and times only
+    # if any start time isn't at midnight, unless told to print seconds.
+    started = self.columns["started"]
+    hours, inverse = numpy.unique(started // 3600, return_inverse=True)
+    offsets = numpy.array([calendar.timegm(time.localtime(hour * 3600)) -
+                           hour * 3600 for hour in hours], dtype=numpy.int64)
+    local = started + offsets[inverse]
+    strings = numpy.datetime_as_string(local.astype("datetime64[s]"))
+    if seconds or (local % 60).any():
+      length = 19
+    elif (local % 86400).any():
+      length = 16
+    else:
+      length = 10
+    return [string[:length].replace("T", " ") for string in strings.tolist()]
+
+  def write_csv(self, filename, append=False, seconds=False):
+    millis = self.columns["completemillis"]
+    missing = numpy.isnan(millis)
+    millis_strings = numpy.where(missing, 0, millis).astype(numpy.int64)
+    millis_strings = millis_strings.astype(str).astype(object)
+    millis_strings[missing] = "NA"
+    logical = numpy.array(["FALSE", "TRUE"], dtype=object)
+    rows = zip(self._started_strings(seconds),
+               logical[self.columns["timeout"].astype(int)].tolist(),
+               logical[self.columns["failure"].astype(int)].tolist(),
+               millis_strings.tolist(),
+               self._label_column(0), self._label_column(1))
+    with open(filename, append and "a" or "w") as out:
+      if not append:
+        out.write(",".join(COLUMNS) + "\n")
+      out.writelines(["%s,%s,%s,%s,%s,%s\n" % row for row in rows])
+      out.flush()
+      os.fsync(out.fileno())
+
+  def write_archive(self, path):
+    writer = ArchiveWriter(path, "filtered", len(self))
+    for name in COLUMNS[:4]:
+      column = writer.create(name, self.columns[name].dtype)
+      column[:] = self.columns[name]
+      column.flush()
+    for index, name in enumerate(COLUMNS[4:]):
+      strings = self._label_column(index)
+      data, offsets = writer.create_string(name, sum(map(len, strings)))
+      offsets[0] = 0
+      offsets[1:] = numpy.cumsum(map(len, strings))
+      data[:] = numpy.fromstring("".join(strings), dtype=numpy.uint8)
+      data.flush()
+      offsets.flush()
+    writer.close()
+    return Archive(path)
+
+def filter_files(torperf_files, start, end, processes=None, checkpoints=None):
+  """Filters the given files, or only their lines after the given
+  checkpoints, which are then updated but not saved."""
+  tasks = []
+  for torperf_file in torperf_files:
+    incremental = None
+    if checkpoints:
+      incremental = IncrementalFile(torperf_file.filename,
+                                    checkpoints.get(torperf_file.filename))
+    tasks.append((torperf_file, start, end, incremental))
+  if processes == 1 or len(tasks) == 1:
+    results = map(filter_file, tasks)
+  else:
+    pool = multiprocessing.Pool(processes)
+    try:
+      results = pool.map(filter_file, tasks)
+    finally:
+      pool.close()
+      pool.join()
+  for torperf_file, (_, incremental) in zip(torperf_files, results):
+    if not incremental:
+      continue
+    if incremental.rewritten and not incremental.resumed:
+      print >>sys.stderr, "%s was rewritten past the last line read, some " \
+                          "lines may have been missed" % torperf_file.filename
+    checkpoints.set(torperf_file.filename, incremental.checkpoint)
+  return Filtered(torperf_files, [columns for columns, _ in results])
+
+class TestFilter(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def _write(self, name, lines):
+    path = os.path.join(self.directory, name)
+    with open(path, "w") as f:
+      for start, complete, read in lines:
+        f.write(" ".join(["%d %d" % divmod(start, 1000000)] + ["0 0"] * 7 +
+                         ["%d %d" % divmod(complete, 1000000),
+                          "75 %d 0" % read]) + "\n")
+    return path
+
+  def test_torperf_file(self):
+    torperf_file = TorperfFile("/tmp/torperffast-5MB.data")
+    self.assertEqual(torperf_file.guard_label, "torperffast")
+    self.assertEqual(torperf_file.filesize_label, "5mb")
+    self.assertEqual(torperf_file.filesize, 5 * 1024 * 1024)
+    self.assertRaises(ValueError, TorperfFile, "torperf.data")
+    self.assertRaises(ValueError, TorperfFile, "torperf-50kb")
+    self.assertEqual(TorperfFile("torperf-50kb.data.2013-03-05").filesize,
+                     50 * 1024)
+
+  def test_filter(self):
+    day = parse_date("2013-03-06") * 1000000
+    paths = [self._write("torperf-50kb.data", [
+                 (day - 1000000, day + 2000000, 51200),
+                 (day + 250000, day + 2999999, 51200),
+                 (day + 60000000, day + 64000000, 100),
+                 (day + 120000000, 0, 0)]),
+             self._write("torperffast-1mb.data", [
+                 (day + 180000000, day + 190000000, 1048576)])]
+    archive = os.path.join(self.directory, "torperffast-1mb.archive")
+    convert_data(paths[1], archive)
+    # The first lines of torperf-50kb.data were rotated into a segment.
+    segment = paths[0] + ".2013-03-05-235959"
+    with open(paths[0]) as data_file:
+      rotated = data_file.readline() + data_file.readline()
+      rest = data_file.read()
+    with open(segment, "w") as segment_file:
+      segment_file.write(rotated)
+    with open(paths[0], "w") as data_file:
+      data_file.write(rest)
+    torperf_files = [TorperfFile(paths[0]), TorperfFile(archive)]
+    filtered = filter_files(torperf_files, day / 1000000,
+                            parse_date("2099-12-31"), processes=2)
+    self.assertEqual(len(filtered), 4)
+    self.assertEqual(list(filtered.columns["completemillis"][[0, 3]]),
+                     [2750.0, 10000.0])
+    csv = os.path.join(self.directory, "filtered.csv")
+    filtered.write_csv(csv)
+    self.assertEqual(open(csv).read().splitlines(), [
+        "started,timeout,failure,completemillis,guards,filesize",
+        "2013-03-06 00:00,FALSE,FALSE,2750,torperf,50kb",
+        "2013-03-06 00:01,FALSE,TRUE,NA,torperf,50kb",
+        "2013-03-06 00:02,TRUE,FALSE,NA,torperf,50kb",
+        "2013-03-06 00:03,FALSE,FALSE,10000,torperffast,1mb"])
+    result = filtered.write_archive(os.path.join(self.directory, "out"))
+    self.assertEqual(list(result["timeout"]), [False, False, True, False])
+    self.assertEqual(result["guards"].tolist(),
+                     ["torperf"] * 3 + ["torperffast"])
+
+  def test_incremental(self):
+    day = parse_date("2013-03-06") * 1000000
+    lines = [(day + i * 300000000, day + i * 300000000 + 1500000, 51200)
+             for i in range(4)]
+    path = self._write("torperf-50kb.data", lines[:2])
+    torperf_file = TorperfFile(path)
+    checkpoints = Checkpoints(os.path.join(self.directory, "state"))
+    csv = os.path.join(self.directory, "filtered.csv")
+    filter_files([torperf_file], 0, day, checkpoints=checkpoints).write_csv(
+        csv, seconds=True)
+    # truncate-data.py drops the first line, and two lines are appended.
+    rewritten = self._write("new", lines[1:])
+    os.rename(rewritten, path)
+    filtered = filter_files([torperf_file], 0, day, checkpoints=checkpoints)
+    self.assertEqual(len(filtered), 2)
+    filtered.write_csv(csv, append=True, seconds=True)
+    self.assertEqual(open(csv).read().splitlines()[1:], [
+        "2013-03-06 00:%02d:00,FALSE,FALSE,1500,torperf,50kb" % (i * 5)
+        for i in range(4)])
+    self.assertEqual(len(filter_files([torperf_file], 0, day,
+                                      checkpoints=checkpoints)), 0)
+
+def main():
+  start = parse_date(DEFAULT_START)
+  end = parse_date(DEFAULT_END)
+  processes = None
+  archive = None
+  state = None
+  paths = []
+  try:
+    for arg in sys.argv[1:]:
+      if arg.startswith("-start="):
+        start = parse_date(arg[len("-start="):])
+      elif arg.startswith("-end="):
+        end = parse_date(arg[len("-end="):])
+      elif arg.startswith("-processes="):
+        processes = int(arg[len("-processes="):])
+      elif arg.startswith("-archive="):
+        archive = arg[len("-archive="):]
+      elif arg.startswith("-state="):
+        state = arg[len("-state="):]
+      else:
+        paths.append(arg)
+    torperf_files = [TorperfFile(path) for path in without_segments(paths)]
+  except ValueError, e:
+    print("error: %s" % e)
+    sys.exit(1)
+  if start >= end:
+    print("error: start date must be before end date")
+    sys.exit(1)
+  if not torperf_files:
+    print("error: input files must be specified as arguments")
+    sys.exit(1)
+  if state and (archive or [torperf_file for torperf_file in torperf_files
+                            if os.path.isdir(torperf_file.filename)]):
+    print("error: -state only works with .data files and filtered.csv")
+    sys.exit(1)
+
+  if state:
+    append = os.path.exists("filtered.csv")
+    if not append and os.path.exists(state):
+      os.remove(state)
+    checkpoints = Checkpoints(state)
+    filtered = filter_files(torperf_files, start, end, processes, checkpoints)
+    filtered.write_csv("filtered.csv", append, seconds=True)
+    checkpoints.save()
+  else:
+    filtered = filter_files(torperf_files, start, end, processes)
+    if archive:
+      filtered.write_archive(archive)
+    else:
+      filtered.write_csv("filtered.csv")
+
+if __name__ == "__main__":
+  main()
@@ -10,63 +10,115 @@ Proof-of-concept implementation of Torperf using Twisted:
 
 server_config = {
     'public-host': '23.22.45.179',  # Public IP address or hostname the server will be reachable at.
-    'http-port': 80,  # Port to contact on the server.
+    'http-port': 80,  # Port to contact on the server, or 0 to listen on any free port for clients on this host.
     'debug-txtorcon': False,  # Turn on txtorcon's debug log.
+    'payload-pool-size': 16777216,  # Bytes of random payload to generate once at startup.
+    'payload-file': None,  # File to memory-map the random payload from, or None to keep it in memory.
+    'streaming-payload': True,  # Serve payload with a push producer, and with sendfile() if 'payload-file' is set.
+    'database': 'perfd.sqlite',  # SQLite database to store results in, or None to only log them.
+    'max-requests-per-tor': 1,  # Maximum number of concurrent requests via the same Tor process.
+    'tor-data-directory': 'tor-data',  # Directory with a DataDirectory per launched Tor process, kept for warm starts.
+    'tor-bootstrap-timeout': 300,  # Seconds for a launched Tor process to bootstrap before it's restarted.
 }
 
 client_configs = [
     {
         'source': 'ec2',  # Source name.
-        'launch-tor': True,  # Launch a Tor process.
+        'launch-tor': True,  # Launch a Tor process, or False to connect to a running one at control-port.
         'tor-binary': '/usr/local/bin/tor',  # Tor binary to launch.
+        'tor-options': {'MaxCircuitDirtiness': '1 minute'},  # Extra torrc options of a launched Tor process.
         'start-delay': 0,  # Seconds before first request, after web server and Tor process are available.
         'request-delay': 300,  # Seconds between requests.
+        'request-jitter': 30,  # Maximum random number of seconds to add to every request's start time.
         'socks-port': 9020,  # SOCKS port of the Tor process.
         'control-port': 10020,  # Control port of the Tor process.
         'file-size': 51200,  # Request size in bytes.
+        'direction': 'download',  # 'download' file-size bytes from our web server, or 'upload' them to it.
         'request-timeout': 295,  # Request timeout in seconds.
+        'data-file': None,  # Append results in trivsocks-client's .data format to this file, or None.
+        'extradata-file': None,  # Append circuits in extra_stats.py's .extradata format to this file, or None.
+        'series-length': 1,  # Number of requests per measurement via the same SOCKS port.
+        'series-shape': 'serial',  # 'serial' or 'pipelined' requests over one HTTP/1.1 connection, or 'parallel' streams.
     },
     {
         'source': 'ec2',  # Source name.
-        'launch-tor': True,  # Launch a Tor process.
+        'launch-tor': True,  # Launch a Tor process, or False to connect to a running one at control-port.
         'tor-binary': '/usr/local/bin/tor',  # Tor binary to launch.
+        'tor-options': {'MaxCircuitDirtiness': '1 minute'},  # Extra torrc options of a launched Tor process.
         'start-delay': 120,  # Seconds before first request, after web server and Tor process are available.
         'request-delay': 1800,  # Seconds between requests.
+        'request-jitter': 60,  # Maximum random number of seconds to add to every request's start time.
         'socks-port': 9021,  # SOCKS port of the Tor process.
         'control-port': 10021,  # Control port of the Tor process.
         'file-size': 1048576,  # Request size in bytes.
+        'direction': 'download',  # 'download' file-size bytes from our web server, or 'upload' them to it.
         'request-timeout': 1795,  # Request timeout in seconds.
+        'data-file': None,  # Append results in trivsocks-client's .data format to this file, or None.
+        'extradata-file': None,  # Append circuits in extra_stats.py's .extradata format to this file, or None.
+        'series-length': 1,  # Number of requests per measurement via the same SOCKS port.
+        'series-shape': 'serial',  # 'serial' or 'pipelined' requests over one HTTP/1.1 connection, or 'parallel' streams.
     },
 #    {
 #        'source': 'ec2',  # Source name.
-#        'launch-tor': True,  # Launch a Tor process.
+#        'launch-tor': True,  # Launch a Tor process, or False to connect to a running one at control-port.
 #        'tor-binary': '/usr/local/bin/tor',  # Tor binary to launch.
+#        'tor-options': {'MaxCircuitDirtiness': '1 minute'},  # Extra torrc options of a launched Tor process.
 #        'start-delay': 480,  # Seconds before first request, after web server and Tor process are available.
 #        'request-delay': 3600,  # Seconds between requests.
+#        'request-jitter': 60,  # Maximum random number of seconds to add to every request's start time.
 #        'socks-port': 9022,  # SOCKS port of the Tor process.
 #        'control-port': 10022,  # Control port of the Tor process.
 #        'file-size': 5242880,  # Request size in bytes.
+#        'direction': 'download',  # 'download' file-size bytes from our web server, or 'upload' them to it.
 #        'request-timeout': 3595,  # Request timeout in seconds.
+#        'data-file': None,  # Append results in trivsocks-client's .data format to this file, or None.
+#        'extradata-file': None,  # Append circuits in extra_stats.py's .extradata format to this file, or None.
+#        'series-length': 1,  # Number of requests per measurement via the same SOCKS port.
+#        'series-shape': 'serial',  # 'serial' or 'pipelined' requests over one HTTP/1.1 connection, or 'parallel' streams.
 #    },
 ]
 
 import os
 import sys
 import time
-import functools
-
-from socksclient import SOCKSWrapper
+import mmap
+import errno
+import socket
+import ctypes
+import ctypes.util
+import heapq
+import random
+import itertools
+import collections
+import json
+import StringIO
+
+from perfdcircuits import CircuitTracker
+from perfdnetwork import CHUNK_SIZE, EmulatedTorFactory
+from perfdreplay import ReplayControlPortFactory, trace_events
+from perfdsocks import SOCKSClientEndpoint, SOCKSServerFactory
+from perfdsocks import SOCKSServerProtocol
+from perfdstore import ResultStore
+from perfdtor import TorPool, fake_tor_binary, free_port
 
 import txtorcon
 
 from twisted.application import service
-from twisted.internet import defer, endpoints, reactor, task, interfaces
-from twisted.web import client, resource, server
-from twisted.python import log, usage
+from twisted.internet import defer, endpoints, reactor, task, interfaces, tcp
+from twisted.internet import error, protocol
+from twisted.web import client, http, resource, server
+from twisted.web import http_headers
+from twisted.web.test.requesthelper import DummyChannel
+from twisted.python import failure, log, usage
 from twisted.plugin import IPlugin
 from twisted.trial import unittest
 
-from zope.interface import implements
+from zope.interface import implements, directlyProvides
+
+try:
+    from twisted.web.iweb import INonQueuedRequestFactory
+except ImportError:
+    INonQueuedRequestFactory = None
 
 
 class Options(usage.Options):
@@ -77,13 +129,231 @@ class Options(usage.Options):
     optParameters = []
 
 
+def _load_sendfile():
+    """ Return a sendfile(out_fd, in_fd, offset, count) function, or None
+        if this platform does not have one. """
+    if hasattr(os, 'sendfile'):
+        return os.sendfile
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        c_sendfile = libc.sendfile64
+    except (OSError, AttributeError, TypeError):
+        return None
+    c_sendfile.argtypes = [ctypes.c_int, ctypes.c_int,
+                           ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t]
+    c_sendfile.restype = ctypes.c_ssize_t
+
+    def sendfile(out_fd, in_fd, offset, count):
+        c_offset = ctypes.c_int64(offset)
+        sent = c_sendfile(out_fd, in_fd, ctypes.byref(c_offset), count)
+        if sent < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        return sent
+    return sendfile
+
+sendfile = _load_sendfile()
+
+
+def _load_monotonic():
+    """ Return a function that reads a monotonic clock in seconds, or
+        time.time if this platform does not have one. """
+    if hasattr(time, 'monotonic'):
+        return time.monotonic
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        clock_gettime = libc.clock_gettime
+    except (OSError, AttributeError, TypeError):
+        return time.time
+
+    class timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+    clock_monotonic = 6 if sys.platform == 'darwin' else 1
+
+    def monotonic():
+        ts = timespec()
+        if clock_gettime(clock_monotonic, ctypes.byref(ts)) != 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        return ts.tv_sec + ts.tv_nsec * 1e-9
+    return monotonic
+
+monotonic = _load_monotonic()
+
+
+class MonotonicClock(object):
+    """ IReactorTime provider that reads the monotonic clock, anchored to
+        the wall clock once at startup.  Timestamps are still comparable
+        to Torperf's epoch timestamps, but they don't jump when the system
+        clock is adjusted during a measurement. """
+    implements(interfaces.IReactorTime)
+
+    def __init__(self, ireactortime):
+        self._reactor = ireactortime
+        self._offset = time.time() - monotonic()
+
+    def seconds(self):
+        return monotonic() + self._offset
+
+    def callLater(self, *args, **kw):
+        return self._reactor.callLater(*args, **kw)
+
+    def getDelayedCalls(self):
+        return self._reactor.getDelayedCalls()
+
+monotonic_clock = MonotonicClock(reactor)
+
+
+class Measurement(dict):
+    """ Timestamps and byte counts of a single request.  The SOCKS client,
+        the HTTP client protocol, and (if we're requesting from our own web
+        server) the server-side data producer all write into the same
+        instance, which is emitted exactly once by firing its deferred
+        when the request finishes. """
+
+    # HTTP request header that tells our web server which measurement a
+    # request belongs to.
+    header = 'X-Perfd-Measurement'
+
+    # Unfinished measurements by id.
+    pending = {}
+
+    # Unfinished measurements by the local port of their SOCKS connection,
+    # for joining them to the circuit that Tor attached their stream to.
+    by_source_port = {}
+
+    _ids = itertools.count(1)
+
+    # Timestamps in the order in which trivsocks-client writes them to
+    # .data files, before the byte counts and DIDTIMEOUT.
+    data_timestamps = ['START', 'SOCKET', 'CONNECT', 'NEGOTIATE', 'REQUEST',
+                       'RESPONSE', 'DATAREQUEST', 'DATARESPONSE',
+                       'DATACOMPLETE']
+
+    def __init__(self, source, file_size, timer=monotonic_clock):
+        dict.__init__(self)
+        self.timer = timer
+        self.id = '%d-%d' % (os.getpid(), next(self._ids))
+        self['SOURCE'] = source
+        self['FILESIZE'] = file_size
+        self.deferred = defer.Deferred()
+        self._deciles = 0
+        self.source_port = None
+        Measurement.pending[self.id] = self
+
+    def stamp(self, key):
+        self[key] = self.timer.seconds()
+
+    def connected(self, address):
+        self.source_port = address.port
+        Measurement.by_source_port[address.port] = self
+
+    def received(self, count):
+        """ Count count more bytes read for this request, and stamp the
+            first byte and every tenth of the expected file size. """
+        if count == 0:
+            return
+        read = self.get('READBYTES', 0)
+        if read == 0:
+            self.stamp('DATARESPONSE')
+        read += count
+        self['READBYTES'] = read
+        expected = self['FILESIZE']
+        while read < expected and (read * 10) / expected > self._deciles:
+            self._deciles += 1
+            self.stamp('DATAPERC%d' % (self._deciles * 10, ))
+
+    def finish(self):
+        if Measurement.pending.pop(self.id, None) is None:
+            return
+        if Measurement.by_source_port.get(self.source_port) is self:
+            del Measurement.by_source_port[self.source_port]
+        self.deferred.callback(self)
+
+    def _data_time(self, key):
+        seconds = self.get(key, 0)
+        sec = int(seconds)
+        usec = int(round((seconds - sec) * 1000000))
+        if usec == 1000000:
+            sec, usec = sec + 1, 0
+        return '%d %d ' % (sec, usec)
+
+    def data_line(self):
+        """ This measurement in the same format that trivsocks-client's
+            output_status_information() writes to .data files, with
+            timestamps that we don't have written as 0 0. """
+        line = [self._data_time(key) for key in self.data_timestamps]
+        line.append('%d %d %d ' % (self.get('WRITEBYTES', 0),
+                                   self.get('READBYTES', 0),
+                                   self.get('DIDTIMEOUT', 0)))
+        line.extend([self._data_time('DATAPERC%d' % perc)
+                     for perc in range(10, 100, 10)])
+        return ''.join(line) + '\n'
+
+
+class RandomDataPool(object):
+    """ Pseudo-random payload that is generated only once, either in
+        memory or in a file that we memory-map, and that is handed out in
+        slices instead of calling os.urandom for every chunk.  Each
+        response starts reading at a different offset, so that no two
+        responses are byte-identical. """
+
+    # Offset increment between two responses; odd, so that we walk
+    # through all offsets of a pool whose size is a power of two.
+    offset_stride = 4099
+
+    def __init__(self, size, path=None):
+        if size < 2 ** 16:
+            raise ValueError("Payload pool must hold at least 64 KiB.")
+        self.size = size
+        self._file = None
+        if path is None:
+            self._data = os.urandom(size)
+        else:
+            self._data = self._map_file(path, size)
+        self._next_offset = 0
+
+    def _map_file(self, path, size):
+        if not os.path.isfile(path) or os.path.getsize(path) < size:
+            with open(path, 'wb') as payload_file:
+                remaining = size
+                while remaining > 0:
+                    chunk = os.urandom(min(remaining, 2 ** 20))
+                    payload_file.write(chunk)
+                    remaining -= len(chunk)
+        self._file = open(path, 'rb')
+        return mmap.mmap(self._file.fileno(), size, access=mmap.ACCESS_READ)
+
+    def fileno(self):
+        """ File descriptor of the payload file, or None if the payload
+            only exists in memory. """
+        if self._file is None:
+            return None
+        return self._file.fileno()
+
+    def next_offset(self):
+        offset = self._next_offset
+        self._next_offset = (offset + self.offset_stride) % self.size
+        return offset
+
+    def read(self, offset, length):
+        end = offset + length
+        if end <= self.size:
+            return self._data[offset:end]
+        return self._data[offset:] + self._data[:end - self.size]
+
+
 class RandomDataProducer(object):
     implements(interfaces.IPullProducer)
 
-    def __init__(self, size, stats, ireactortime):
+    def __init__(self, size, stats, ireactortime, pool=None):
         self.size = size
         self.stats = stats
         self.timer = interfaces.IReactorTime(ireactortime)
+        self.pool = pool
+        if pool is not None:
+            self.offset = pool.next_offset()
 
     def beginProducing(self, consumer):
         self.remaining = self.size
@@ -94,20 +364,33 @@ class RandomDataProducer(object):
 
     def resumeProducing(self):
         if self.remaining <= 0:
-            self.consumer.unregisterProducer()
-            if self.deferred:
-                self.deferred.callback('o')
-                self.deferred = None
+            self._finish()
             return
-        chunk_size = min(self.remaining, 2 ** 16)
+        self._write_chunk(min(self.remaining, 2 ** 16))
+
+    def _write_chunk(self, chunk_size):
+        if self.pool is None:
+            data = os.urandom(chunk_size)
+        else:
+            data = self.pool.read(self.offset, chunk_size)
+            self.offset = (self.offset + chunk_size) % self.pool.size
+        self.consumer.write(data)
+        self._sent(chunk_size)
+
+    def _sent(self, sent_bytes):
         percentBefore = float(self.remaining) / float(self.size)
-        self.remaining -= chunk_size
+        self.remaining -= sent_bytes
         percentAfter = float(self.remaining) / float(self.size)
-        self.consumer.write(os.urandom(chunk_size))
         if percentBefore > 0.50 and percentAfter < 0.50:
             self.stats['SERVER_PERC50'] = self.timer.seconds()
             print "sent 50% of content from server", self.timer.seconds()
 
+    def _finish(self):
+        self.consumer.unregisterProducer()
+        if self.deferred:
+            self.deferred.callback('o')
+            self.deferred = None
+
     def stopProducing(self):
         if self.deferred:
             self.consumer.unregisterProducer()
@@ -116,32 +399,208 @@ class RandomDataProducer(object):
             self.deferred = None
 
 
+class StreamingDataProducer(RandomDataProducer):
+    """ Push producer that keeps writing chunks in the same reactor turn
+        until the consumer pauses it, rather than waiting for the
+        consumer to ask for every single chunk. """
+    implements(interfaces.IPushProducer)
+
+    def beginProducing(self, consumer):
+        self.remaining = self.size
+        self.consumer = consumer
+        self.paused = False
+        # Small payloads are written and finished right away, which
+        # forgets self.deferred.
+        d = self.deferred = defer.Deferred()
+        self.consumer.registerProducer(self, True)
+        self.resumeProducing()
+        return d
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+        while not self.paused and self.deferred is not None:
+            if self.remaining <= 0:
+                self._finish()
+                return
+            self._write_chunk(min(self.remaining, 2 ** 16))
+
+
+class SendfileTransport(object):
+    """ The internals of a Twisted TCP transport and of the request that
+        writes to it, which we need to send past the transport's write
+        buffer.  supports() tells whether this version of Twisted has all
+        of them; they are not part of its public API. """
+
+    transport_attributes = ('dataBuffer', 'offset', '_tempDataLen',
+                            'producerPaused', 'startWriting', 'fileno')
+
+    def __init__(self, request):
+        self.request = request
+        self.transport = request.transport
+
+    @classmethod
+    def supports(cls, request):
+        return (isinstance(request.transport, tcp.Connection) and
+                not interfaces.ISSLTransport.providedBy(request.transport) and
+                hasattr(request, 'sentLength') and
+                all([hasattr(request.transport, name)
+                     for name in cls.transport_attributes]))
+
+    def flush_headers(self):
+        """ Have the request queue its response headers in the
+            transport, so that they go out before anything we send. """
+        self.request.write('')
+
+    def buffered(self):
+        """ Bytes that the transport still has to write. """
+        transport = self.transport
+        return (len(transport.dataBuffer) - transport.offset +
+                transport._tempDataLen)
+
+    def fileno(self):
+        return self.transport.fileno()
+
+    def sent(self, count):
+        """ Count bytes that we sent ourselves as part of the body. """
+        self.request.sentLength += count
+
+    def wait_for_writable(self):
+        """ Have the transport resume its paused producer as soon as it
+            has nothing left to write and the socket is writable again. """
+        self.transport.producerPaused = True
+        self.transport.startWriting()
+
+    def close(self):
+        self.transport.loseConnection()
+
+
+class SendfileDataProducer(StreamingDataProducer):
+    """ Push producer that hands the payload file to the kernel with
+        sendfile(), bypassing the transport's write buffer.  Only works
+        for transports that SendfileTransport supports and file-backed
+        payload pools. """
+
+    def __init__(self, size, stats, ireactortime, pool, transport):
+        StreamingDataProducer.__init__(self, size, stats, ireactortime, pool)
+        self.transport = transport
+
+    def beginProducing(self, consumer):
+        self.transport.flush_headers()
+        return StreamingDataProducer.beginProducing(self, consumer)
+
+    def resumeProducing(self):
+        self.paused = False
+        if self.deferred is None:
+            return
+        transport = self.transport
+        if transport.buffered():
+            transport.wait_for_writable()
+            return
+        while self.remaining > 0:
+            count = min(self.remaining, self.pool.size - self.offset)
+            try:
+                sent = sendfile(transport.fileno(), self.pool.fileno(),
+                                self.offset, count)
+            except OSError, e:
+                if e.errno != errno.EAGAIN:
+                    transport.close()
+                    return
+                sent = 0
+            if not sent:
+                transport.wait_for_writable()
+                return
+            self.offset = (self.offset + sent) % self.pool.size
+            transport.sent(sent)
+            self._sent(sent)
+        self._finish()
+
+
+class UploadDataProducer(StreamingDataProducer):
+    """ Push producer for the body of an upload, which stamps DATAPERC10 to
+        DATAPERC90 into stats whenever another tenth of the body has been
+        handed to the transport, and counts WRITEBYTES. """
+
+    def __init__(self, size, stats, ireactortime, pool=None):
+        StreamingDataProducer.__init__(self, size, stats, ireactortime, pool)
+        self._deciles = 0
+
+    def _sent(self, sent_bytes):
+        self.remaining -= sent_bytes
+        self.stats['WRITEBYTES'] = self.stats.get('WRITEBYTES', 0) + sent_bytes
+        sent = self.size - self.remaining
+        while sent < self.size and (sent * 10) / self.size > self._deciles:
+            self._deciles += 1
+            self.stats['DATAPERC%d' % (self._deciles * 10, )] = \
+                self.timer.seconds()
+
+
 class UrandomResource(resource.Resource):
     """ Pseudo-random data resource to be served via our web server.
-        Maybe this code is overly complex, and we can instead write
-        pseudo-random files to disk once and serve them with some
-        standard Twisted foo. """
+        Data comes from a RandomDataPool that is shared by all
+        resources. """
 
-    def __init__(self, size):
+    def __init__(self, size, pool, streaming=False):
         self.size = size;
+        self.pool = pool
+        self.streaming = streaming
         print "created resource of size", self.size
 
+    def _can_sendfile(self, request):
+        # Only request.write() knows not to send a body for HEAD.
+        return (sendfile is not None and self.pool.fileno() is not None and
+                request.method != 'HEAD' and
+                SendfileTransport.supports(request))
+
     def render_GET(self, request):
         request.setHeader('Content-Type', 'application/octet-stream')
-        ## fixme, pass a real stats object (i.e. same hashtable as the others)
-        dataProducer = RandomDataProducer(self.size, {}, reactor)
+        request.setHeader('Content-Length', str(self.size))
+        # Pipelined requests are rendered as soon as they arrive, but the
+        # channel only takes one producer at a time, so wait until the
+        # request before this one is finished.
+        queued = request.channel.requests.index(request)
+        if queued:
+            previous = request.channel.requests[queued - 1].notifyFinish()
+            previous.addCallbacks(lambda ignored: self._produce(request),
+                                  lambda failure: None)
+        else:
+            self._produce(request)
+        return server.NOT_DONE_YET
+
+    def _produce(self, request):
+        # Requests sent by our own clients belong to a measurement that we
+        # add server-side statistics to; other requests get a throwaway
+        # dict.
+        stats = Measurement.pending.get(request.getHeader(Measurement.header),
+                                        {})
+        if not self.streaming:
+            dataProducer = RandomDataProducer(self.size, stats,
+                                              monotonic_clock, self.pool)
+        elif self._can_sendfile(request):
+            dataProducer = SendfileDataProducer(self.size, stats,
+                                                monotonic_clock, self.pool,
+                                                SendfileTransport(request))
+        else:
+            dataProducer = StreamingDataProducer(self.size, stats,
+                                                 monotonic_clock, self.pool)
         d = dataProducer.beginProducing(request)
         def err(ignored):
             Exception("Error")
         def cbFinished(ignored):
             request.finish()
         d.addErrback(err).addCallback(cbFinished)
-        return server.NOT_DONE_YET
 
 
 class UrandomResourceDispatcher(resource.Resource):
     children = {}
 
+    def __init__(self, pool, streaming=False):
+        resource.Resource.__init__(self)
+        self.pool = pool
+        self.streaming = streaming
+
     def getChild(self, name, request):
         try:
             size = int(name)
@@ -150,26 +609,246 @@ class UrandomResourceDispatcher(resource.Resource):
             try:
                 return self.children[size]
             except KeyError:
-                self.children[size] = UrandomResource(size)
+                self.children[size] = UrandomResource(size, self.pool,
+                                                     self.streaming)
                 return self.children[size]
         except ValueError:
             return resource.NoResource()
 
 
+class SinkContent(object):
+    """ Stands in for the temporary file that holds the body of a POST
+        request to /sink.  The body is counted and thrown away while it
+        arrives, and SERVER_PERC10 to SERVER_PERC90 are stamped into stats
+        whenever another tenth of the announced length has arrived. """
+
+    def __init__(self, length, stats, ireactortime):
+        self.length = length
+        self.stats = stats
+        self.timer = interfaces.IReactorTime(ireactortime)
+        self.received = 0
+        self._deciles = 0
+
+    def write(self, data):
+        self.received += len(data)
+        while (self.length and self.received < self.length and
+               (self.received * 10) / self.length > self._deciles):
+            self._deciles += 1
+            self.stats['SERVER_PERC%d' % (self._deciles * 10, )] = \
+                self.timer.seconds()
+
+    def seek(self, offset, whence=0):
+        pass
+
+    def tell(self):
+        return self.received
+
+    def read(self, size=-1):
+        return ''
+
+    def close(self):
+        pass
+
+
+class PerfdRequest(server.Request):
+    """ Request of our web server, which doesn't keep the bodies of
+        uploads to /sink. """
+
+    def gotLength(self, length):
+        # Resources are only looked up once the whole body has arrived,
+        # but the channel already knows the path.
+        path = getattr(self.channel, '_path', '').split('?', 1)[0]
+        if path == '/sink':
+            stats = Measurement.pending.get(
+                    self.requestHeaders.getRawHeaders(Measurement.header,
+                                                      [None])[-1], {})
+            self.content = SinkContent(length, stats, monotonic_clock)
+        else:
+            server.Request.gotLength(self, length)
+
+if INonQueuedRequestFactory is not None:
+    directlyProvides(PerfdRequest, INonQueuedRequestFactory)
+
+
+class PerfdSite(server.Site):
+    """ Our web server.  Twisted versions that stopped queueing requests
+        still create a request that is pipelined right behind a request
+        without body as queued, and a queued request never tells the
+        channel that it is finished, which stalls all further requests on
+        that connection.  So create all requests as non-queued ones, and
+        let UrandomResource take care of the order of responses. """
+
+    requestFactory = PerfdRequest
+
+
+class SinkResource(resource.Resource):
+    """ Accepts uploads of any size via POST and replies with the number of
+        bytes received.  PerfdSite discards the body while it arrives. """
+    isLeaf = True
+
+    def render_POST(self, request):
+        request.content.seek(0, 2)
+        request.setHeader('Content-Type', 'text/plain')
+        return '%d\n' % request.content.tell()
+
+
+class ResultsProducer(object):
+    """ Push producer that writes lines to its consumer in batches, one
+        batch per reactor turn, so that large result sets never need to be
+        held in memory. """
+    implements(interfaces.IPushProducer)
+
+    batch_size = 500
+
+    def __init__(self, lines):
+        self._lines = lines
+        self._paused = False
+        self._stopped = False
+
+    def beginProducing(self, consumer):
+        self.consumer = consumer
+        self._task = task.cooperate(self._produce())
+        self.consumer.registerProducer(self, True)
+        d = self._task.whenDone()
+        d.addBoth(self._done)
+        return d
+
+    def _produce(self):
+        batch = []
+        for line in self._lines:
+            batch.append(line)
+            if len(batch) >= self.batch_size:
+                self.consumer.write(''.join(batch))
+                batch = []
+                yield None
+        if batch:
+            self.consumer.write(''.join(batch))
+
+    def _done(self, result):
+        # A consumer that stopped us is gone already.
+        if not self._stopped:
+            self.consumer.unregisterProducer()
+        return result
+
+    def pauseProducing(self):
+        if not self._paused:
+            self._paused = True
+            self._task.pause()
+
+    def resumeProducing(self):
+        if self._paused:
+            self._paused = False
+            self._task.resume()
+
+    def stopProducing(self):
+        # The transport and the request may both stop us.
+        self._stopped = True
+        try:
+            self._task.stop()
+        except task.TaskFinished:
+            pass
+
+
+class ResultsResource(resource.Resource):
+    """ Measurement results from our result store, either in Torperf's
+        key=value format (the default) or in JSON.  Supported query
+        arguments are source, filesize, start, and end (seconds since the
+        epoch), and format (keyvalue or json).  Responses are streamed
+        with chunked encoding and support conditional GET requests. """
+    isLeaf = True
+
+    def __init__(self, store=None):
+        resource.Resource.__init__(self)
+        self.store = store
+
+    def _arg(self, request, name, convert):
+        values = request.args.get(name)
+        if not values:
+            return None
+        return convert(values[0])
+
+    def _format_value(self, value):
+        if isinstance(value, float):
+            return '%.6f' % value
+        return str(value)
+
+    def _keyvalue_lines(self, records):
+        for record in records:
+            yield ' '.join(sorted(['%s=%s' % (key, self._format_value(value))
+                                   for key, value in record.iteritems()])) + \
+                  '\n'
+
+    def _json_lines(self, records):
+        separator = '[\n'
+        for record in records:
+            yield separator + json.dumps(record, sort_keys=True)
+            separator = ',\n'
+        yield '[]\n' if separator == '[\n' else '\n]\n'
+
+    def render_GET(self, request):
+        if self.store is None:
+            request.setResponseCode(http.SERVICE_UNAVAILABLE)
+            return 'No result store configured.\n'
+        try:
+            source = self._arg(request, 'source', str)
+            filesize = self._arg(request, 'filesize', int)
+            start = self._arg(request, 'start', float)
+            end = self._arg(request, 'end', float)
+            format = self._arg(request, 'format', str) or 'keyvalue'
+        except ValueError:
+            format = None
+        if format not in ('keyvalue', 'json'):
+            request.setResponseCode(http.BAD_REQUEST)
+            return 'Invalid query arguments.\n'
+
+        # If-None-Match takes precedence over If-Modified-Since, so only
+        # let Twisted compare modification times if there's no ETag to
+        # compare.
+        etag = '"%d"' % self.store.last_request_id
+        last_modified = self.store.last_modified
+        if request.getHeader('if-none-match') is not None:
+            request.setHeader('Last-Modified',
+                              http.datetimeToString(int(last_modified)))
+            cached = request.setETag(etag)
+        else:
+            request.setETag(etag)
+            cached = request.setLastModified(last_modified)
+        if cached == http.CACHED:
+            return ''
+
+        records = self.store.requests(source, filesize, start, end)
+        if format == 'json':
+            request.setHeader('Content-Type', 'application/json')
+            lines = self._json_lines(records)
+        else:
+            request.setHeader('Content-Type', 'text/plain')
+            lines = self._keyvalue_lines(records)
+        producer = ResultsProducer(lines)
+        disconnected = []
+        def lost(reason):
+            disconnected.append(reason)
+            producer.stopProducing()
+        request.notifyFinish().addErrback(lost)
+        d = producer.beginProducing(request)
+        def err(failure):
+            failure.trap(task.TaskStopped)
+        def cbFinished(ignored):
+            if not disconnected:
+                request.finish()
+        d.addCallbacks(cbFinished, err)
+        return server.NOT_DONE_YET
+
+
 class MeasuringHTTPPageGetter(client.HTTPPageGetter):
 
     def __init__(self):
-        self.times = {}
-        self.timer = interfaces.IReactorTime(reactor)
         self.sentBytes = 0
-        self.receivedBytes = 0
-        # TODO Learn expected bytes from PerfdWebRequest instance
-        self.expectedBytes = 51200
-        self.decileLogged = 0
 
     def connectionMade(self):
+        self.times = self.factory.measurement
+        self.factory.page_getter = self
         client.HTTPPageGetter.connectionMade(self)
-        self.times['DATAREQUEST'] = self.timer.seconds()
+        self.times.stamp('DATAREQUEST')
 
     def sendCommand(self, command, path):
         self.sentBytes += len('%s %s HTTP/1.0\r\n' % (command, path))
@@ -184,134 +863,603 @@ class MeasuringHTTPPageGetter(client.HTTPPageGetter):
         client.HTTPPageGetter.endHeaders(self)
 
     def dataReceived(self, data):
-        if self.receivedBytes == 0 and len(data) > 0:
-            self.times['DATARESPONSE'] = self.timer.seconds()
-        self.receivedBytes += len(data)
-        while (self.receivedBytes < self.expectedBytes and
-              (self.receivedBytes * 10) / self.expectedBytes >
-               self.decileLogged):
-            self.decileLogged += 1
-            self.times['DATAPERC%d' % (self.decileLogged * 10, )] = \
-                       self.timer.seconds()
+        self.times.received(len(data))
         client.HTTPPageGetter.dataReceived(self, data)
 
     def handleResponse(self, response):
         self.times['WRITEBYTES'] = self.sentBytes
-        self.times['READBYTES'] = self.receivedBytes
-        self.times['DATACOMPLETE'] = self.timer.seconds()
+        self.times.setdefault('READBYTES', 0)
+        self.times.stamp('DATACOMPLETE')
         self.times['DIDTIMEOUT'] = 0
-        log.msg(self.times) # TODO How can we link these timestamps and
-                            # other data to the PerfdWebRequest instance
-                            # and store them in the database together with
-                            # other request data, e.g., SOCKS timestamps?
         client.HTTPPageGetter.handleResponse(self, response)
 
     def timeout(self):
+        self.times['WRITEBYTES'] = self.sentBytes
+        self.times.setdefault('READBYTES', 0)
+        self.times.stamp('DATACOMPLETE')
         self.times['DIDTIMEOUT'] = 1
-        log.msg(self.times) # TODO How can we link these timestamps and
-                            # other data to the PerfdWebRequest instance
-                            # and store them in the database together with
-                            # other request data, e.g., SOCKS timestamps?
         client.HTTPPageGetter.timeout(self)
 
 
 class PerfdWebRequest(object):
+    """ A single request via SOCKS to our web server.  The request timeout
+        covers the whole request including the SOCKS handshake, and the
+        measurement is emitted exactly once, no matter whether the request
+        succeeds, fails, or times out. """
+
     def __init__(self, host, http_port, socks_port, file_size,
-                 request_timeout):
-        self.times = {}
-        self.timer = interfaces.IReactorTime(reactor)
-        endpoint = endpoints.TCP4ClientEndpoint(reactor, host, http_port)
-        wrapper = SOCKSWrapper(reactor, 'localhost', socks_port, endpoint,
-                               self.times)
+                 request_timeout, source, scheduled=None):
+        self.measurement = Measurement(source, file_size)
+        self.measurement.stamp('START')
+        if scheduled is not None:
+            self.measurement['SCHEDULED'] = scheduled
+            self.measurement['SCHEDULE_LAG'] = \
+                self.measurement['START'] - scheduled
+        endpoint = SOCKSClientEndpoint(reactor, 'localhost', socks_port, host,
+                                       http_port, self.measurement)
         url = 'http://%s:%d/urandom/%d' % (host, http_port, file_size, )
-        factory = client.HTTPClientFactory(url, timeout=request_timeout)
-        factory.protocol = MeasuringHTTPPageGetter
-        factory.deferred.addCallbacks(self._request_finished)
-        deferred = wrapper.connect(factory)  # TODO use timeout, and use
-                                             # remaining timeout for HTTP
-                                             # request
-        deferred.addCallbacks(self._request_finished)
+        self.factory = client.HTTPClientFactory(url, timeout=request_timeout,
+                headers={Measurement.header: self.measurement.id})
+        self.factory.protocol = MeasuringHTTPPageGetter
+        self.factory.measurement = self.measurement
+        self.factory.page_getter = None
+        self.factory.deferred.addBoth(self._request_finished)
+        self._timeout_call = reactor.callLater(request_timeout,
+                                               self._timed_out)
+        self._connecting = endpoint.connect(self.factory)
+        self._connecting.addErrback(self._request_finished)
+
+    def _timed_out(self):
+        if self.factory.page_getter is not None:
+            # Let the HTTP protocol record its byte counts and drop the
+            # connection, which also fails the factory's deferred.
+            self.factory.page_getter.timeout()
+        else:
+            # Still in the SOCKS handshake: give up on it, so that Tor
+            # doesn't attach the stream and download after we're done.
+            self.measurement.stamp('DATACOMPLETE')
+            self.measurement['DIDTIMEOUT'] = 1
+            self._connecting.cancel()
+        self._request_finished(None)
 
     def _request_finished(self, ignored):
-        log.msg(self.times)
+        if self._timeout_call.active():
+            self._timeout_call.cancel()
+        self.measurement.setdefault('DIDTIMEOUT', 0)
+        self.measurement.finish()
+
+
+# Payload of all uploads, generated by upload_pool() for the first one.
+_upload_pool = None
+
+
+def upload_pool():
+    global _upload_pool
+    if _upload_pool is None:
+        _upload_pool = RandomDataPool(2 ** 20)
+    return _upload_pool
+
+
+class MeasuringUploader(protocol.Protocol):
+    """ Posts FILESIZE random bytes to /sink with an UploadDataProducer.
+        DATAREQUEST is when the request headers are written, DATARESPONSE
+        when the first byte of the reply arrives, and DATACOMPLETE when the
+        server has replied 200 and closed the connection. """
+
+    def connectionMade(self):
+        self.times = self.factory.measurement
+        self.factory.uploader = self
+        self._response = ''
+        size = self.times['FILESIZE']
+        header = 'POST /sink HTTP/1.0\r\nHost: %s\r\n%s: %s\r\n' \
+                 'Content-Type: application/octet-stream\r\n' \
+                 'Content-Length: %d\r\n\r\n' % \
+                 (self.factory.host, Measurement.header, self.times.id, size)
+        self.times.stamp('DATAREQUEST')
+        self.times['WRITEBYTES'] = len(header)
+        self.times['READBYTES'] = 0
+        self.transport.write(header)
+        producer = UploadDataProducer(size, self.times, monotonic_clock,
+                                      self.factory.pool)
+        producer.beginProducing(self.transport).addErrback(lambda f: None)
+
+    def dataReceived(self, data):
+        if self.times['READBYTES'] == 0 and data:
+            self.times.stamp('DATARESPONSE')
+        self.times['READBYTES'] += len(data)
+        if len(self._response) < 64:
+            self._response += data
+
+    def timeout(self):
+        self.times.stamp('DATACOMPLETE')
+        self.times['DIDTIMEOUT'] = 1
+        self.transport.loseConnection()
+
+    def connectionLost(self, reason):
+        if 'DIDTIMEOUT' not in self.times and \
+           self._response.split(' ', 2)[1:2] == ['200']:
+            self.times.stamp('DATACOMPLETE')
+            self.times['DIDTIMEOUT'] = 0
+        self.factory.deferred.callback(None)
+
+
+class PerfdUploadRequest(object):
+    """ A single upload via SOCKS to our web server's /sink, measured like
+        a PerfdWebRequest of the same size, so that upload and download
+        results can be compared directly.  Its measurement has DIRECTION
+        set to upload.  The body comes from pool, or from the pool that all
+        uploads share. """
+
+    def __init__(self, host, http_port, socks_port, file_size,
+                 request_timeout, source, scheduled=None, pool=None):
+        self.measurement = Measurement(source, file_size)
+        self.measurement.stamp('START')
+        self.measurement['DIRECTION'] = 'upload'
+        if scheduled is not None:
+            self.measurement['SCHEDULED'] = scheduled
+            self.measurement['SCHEDULE_LAG'] = \
+                self.measurement['START'] - scheduled
+        endpoint = SOCKSClientEndpoint(reactor, 'localhost', socks_port, host,
+                                       http_port, self.measurement)
+        self.factory = protocol.ClientFactory()
+        self.factory.protocol = MeasuringUploader
+        self.factory.host = '%s:%d' % (host, http_port)
+        self.factory.measurement = self.measurement
+        self.factory.pool = pool or upload_pool()
+        self.factory.uploader = None
+        self.factory.deferred = defer.Deferred()
+        self.factory.deferred.addCallback(self._request_finished)
+        self._timeout_call = reactor.callLater(request_timeout,
+                                               self._timed_out)
+        self._connecting = endpoint.connect(self.factory)
+        self._connecting.addErrback(self._request_finished)
+
+    def _timed_out(self):
+        if self.factory.uploader is not None:
+            self.factory.uploader.timeout()
+        else:
+            self.measurement.stamp('DATACOMPLETE')
+            self.measurement['DIDTIMEOUT'] = 1
+            self._connecting.cancel()
+        self._request_finished(None)
+
+    def _request_finished(self, ignored):
+        if self._timeout_call.active():
+            self._timeout_call.cancel()
+        self.measurement.setdefault('DIDTIMEOUT', 0)
+        self.measurement.finish()
+
+
+class SeriesHTTPClient(protocol.Protocol):
+    """ HTTP/1.1 client that sends a series of GET requests over one
+        persistent connection, one after the other, or all at once if the
+        factory says pipelined.  Each request writes into its own
+        measurement.  Our web server always sends a Content-Length, so
+        responses are only counted, not buffered. """
+
+    def connectionMade(self):
+        self.measurements = self.factory.measurements
+        self.factory.client = self
+        self._sent = 0
+        self._received = 0
+        self._header = ''
+        self._remaining = None
+        if self.factory.stopped:
+            self.transport.loseConnection()
+        elif self.factory.pipelined:
+            while self._sent < len(self.measurements):
+                self._send_request()
+        else:
+            self._send_request()
+
+    def _send_request(self):
+        measurement = self.measurements[self._sent]
+        self._sent += 1
+        request = 'GET %s HTTP/1.1\r\nHost: %s\r\n%s: %s\r\n\r\n' % \
+                  (self.factory.path, self.factory.host, Measurement.header,
+                   measurement.id)
+        if 'START' not in measurement:
+            measurement.stamp('START')
+        measurement.stamp('DATAREQUEST')
+        measurement['WRITEBYTES'] = len(request)
+        self.transport.write(request)
+
+    def _content_length(self, header):
+        for line in header.split('\r\n')[1:]:
+            name, _, value = line.partition(':')
+            if name.strip().lower() == 'content-length':
+                return int(value)
+        return None
+
+    def dataReceived(self, data):
+        while data and self._received < self._sent:
+            measurement = self.measurements[self._received]
+            if self._remaining is None:
+                self._header += data
+                end = self._header.find('\r\n\r\n')
+                if end < 0:
+                    measurement.received(len(data))
+                    return
+                measurement.received(len(data) -
+                                     (len(self._header) - end - 4))
+                data = self._header[end + 4:]
+                self._remaining = self._content_length(self._header[:end])
+                self._header = ''
+                if self._remaining is None:
+                    log.msg('Response without Content-Length, giving up '
+                            'on the series.')
+                    self.transport.loseConnection()
+                    return
+            count = min(len(data), self._remaining)
+            measurement.received(count)
+            self._remaining -= count
+            data = data[count:]
+            if self._remaining == 0:
+                self._remaining = None
+                self._response_complete(measurement)
+
+    def _response_complete(self, measurement):
+        measurement.setdefault('READBYTES', 0)
+        measurement.stamp('DATACOMPLETE')
+        measurement['DIDTIMEOUT'] = 0
+        measurement.finish()
+        self._received += 1
+        if self._received == len(self.measurements):
+            self.transport.loseConnection()
+        elif self._received == self._sent:
+            self._send_request()
+
+    def connectionLost(self, reason):
+        self.factory.deferred.callback(None)
+
+
+class SeriesHTTPClientFactory(protocol.ClientFactory):
+    protocol = SeriesHTTPClient
+
+    def __init__(self, host, path, measurements, pipelined):
+        self.host = host
+        self.path = path
+        self.measurements = measurements
+        self.pipelined = pipelined
+        self.client = None
+        self.stopped = False
+        self.deferred = defer.Deferred()
+
+
+class PerfdRequestSeries(object):
+    """ A series of requests via the same SOCKS port, to tell stream and
+        circuit setup apart from the time to the first byte.  In 'serial'
+        and 'pipelined' shape, all requests share one persistent HTTP/1.1
+        connection, so only the first request has SOCKS timestamps.  In
+        'parallel' shape, every request is a PerfdWebRequest on its own
+        stream.
+
+        Every request has its own measurement with SERIES, SERIES_SHAPE,
+        SERIES_LENGTH, and SERIES_INDEX.  Once all of them are finished,
+        the aggregate measurement without SERIES_INDEX is emitted, with
+        the earliest timestamp of each connection stage, the latest
+        DATACOMPLETE, and the summed byte counts of the series. """
+
+    shapes = ('serial', 'parallel', 'pipelined')
+
+    def __init__(self, host, http_port, socks_port, file_size,
+                 request_timeout, source, length, shape, scheduled=None):
+        if shape not in self.shapes:
+            raise ValueError('Unknown series shape %r.' % (shape, ))
+        self.aggregate = Measurement(source, file_size)
+        self.aggregate.stamp('START')
+        if scheduled is not None:
+            self.aggregate['SCHEDULED'] = scheduled
+            self.aggregate['SCHEDULE_LAG'] = \
+                self.aggregate['START'] - scheduled
+        series = {'SERIES': self.aggregate.id, 'SERIES_SHAPE': shape,
+                  'SERIES_LENGTH': length}
+        self.aggregate.update(series)
+        if shape == 'parallel':
+            self.requests = [PerfdWebRequest(host, http_port, socks_port,
+                                             file_size, request_timeout,
+                                             source)
+                             for i in xrange(length)]
+            self.measurements = [r.measurement for r in self.requests]
+        else:
+            self.measurements = [Measurement(source, file_size)
+                                 for i in xrange(length)]
+            self.measurements[0]['START'] = self.aggregate['START']
+            endpoint = SOCKSClientEndpoint(reactor, 'localhost', socks_port,
+                                           host, http_port,
+                                           self.measurements[0])
+            self.factory = SeriesHTTPClientFactory(
+                    '%s:%d' % (host, http_port), '/urandom/%d' % file_size,
+                    self.measurements, shape == 'pipelined')
+            self.factory.deferred.addCallback(self._connection_finished)
+            self._timeout_call = reactor.callLater(request_timeout,
+                                                   self._timed_out)
+            self._connecting = endpoint.connect(self.factory)
+            self._connecting.addErrback(self._connection_finished)
+        for index, measurement in enumerate(self.measurements):
+            measurement.update(series)
+            measurement['SERIES_INDEX'] = index
+        deferred = defer.DeferredList([m.deferred for m in self.measurements])
+        deferred.addCallback(self._requests_finished)
+
+    def _timed_out(self):
+        self.factory.stopped = True
+        for measurement in self.measurements:
+            if measurement.id in Measurement.pending:
+                measurement.setdefault('READBYTES', 0)
+                measurement.stamp('DATACOMPLETE')
+                measurement['DIDTIMEOUT'] = 1
+        if self.factory.client is not None:
+            self.factory.client.transport.loseConnection()
+        else:
+            self._connecting.cancel()
+        self._connection_finished(None)
+
+    def _connection_finished(self, ignored):
+        if self._timeout_call.active():
+            self._timeout_call.cancel()
+        for measurement in self.measurements:
+            measurement.setdefault('DIDTIMEOUT', 0)
+            measurement.finish()
+
+    def _requests_finished(self, results):
+        for key in Measurement.data_timestamps[1:-1]:
+            stamps = [m[key] for m in self.measurements if key in m]
+            if stamps:
+                self.aggregate[key] = min(stamps)
+        completed = [m['DATACOMPLETE'] for m in self.measurements
+                     if 'DATACOMPLETE' in m]
+        if completed:
+            self.aggregate['DATACOMPLETE'] = max(completed)
+        for key in ('WRITEBYTES', 'READBYTES'):
+            self.aggregate[key] = sum([m.get(key, 0)
+                                       for m in self.measurements])
+        self.aggregate['DIDTIMEOUT'] = max([m['DIDTIMEOUT']
+                                            for m in self.measurements])
+        self.aggregate.finish()
+
+
+class MeasurementScheduler(object):
+    """ Starts the requests of all measurement streams from a single heap
+        of due times.  A stream's first request is due after its start
+        delay, and every following request is due one request delay later
+        plus a random jitter.  No more than max_concurrency requests run
+        via the same Tor process at the same time; due requests wait in
+        line for their Tor process, and the request records how late it
+        started compared to its due time.  A stream's request is skipped if
+        its previous request is still waiting. """
+
+    def __init__(self, max_concurrency, clock=monotonic_clock):
+        self.max_concurrency = max_concurrency
+        self.clock = clock
+        self._heap = []
+        self._seq = itertools.count()
+        self._running = collections.defaultdict(int)
+        self._waiting = collections.defaultdict(collections.deque)
+        self._waiting_streams = set()
+        self._call = None
+        self._stopped = None
+
+    def add_stream(self, start_request, tor, start_delay, request_delay,
+                   jitter=0):
+        """ Add a stream of requests via the Tor process identified by tor.
+            start_request is called with the due time of a request and
+            returns a deferred that fires when that request is finished. """
+        stream = (start_request, tor, request_delay, jitter)
+        self._push(stream, self.clock.seconds() + start_delay)
+        self._reschedule()
+
+    def _push(self, stream, base):
+        due = base + random.uniform(0, stream[3])
+        heapq.heappush(self._heap, (due, next(self._seq), base, stream))
+
+    def _reschedule(self):
+        if not self._heap:
+            return
+        delay = max(self._heap[0][0] - self.clock.seconds(), 0)
+        if self._call is not None and self._call.active():
+            self._call.reset(delay)
+        else:
+            self._call = self.clock.callLater(delay, self._run_due)
+
+    def _run_due(self):
+        now = self.clock.seconds()
+        while self._heap and self._heap[0][0] <= now:
+            due, seq, base, stream = heapq.heappop(self._heap)
+            self._push(stream, base + stream[2])
+            if stream in self._waiting_streams:
+                log.msg('Skipping request via Tor %s due at %f, because the '
+                        'previous one is still waiting.' % (stream[1], due))
+                continue
+            self._waiting_streams.add(stream)
+            self._waiting[stream[1]].append((due, stream))
+            self._start_waiting(stream[1])
+        self._reschedule()
+
+    def _start_waiting(self, tor):
+        waiting = self._waiting[tor]
+        while waiting and self._running[tor] < self.max_concurrency:
+            due, stream = waiting.popleft()
+            self._waiting_streams.discard(stream)
+            self._running[tor] += 1
+            d = stream[0](due)
+            d.addBoth(self._request_finished, tor)
+
+    def _request_finished(self, result, tor):
+        self._running[tor] -= 1
+        self._start_waiting(tor)
+        self._check_stopped()
+        return result
+
+    def stop(self):
+        """ Start no more requests, and return a deferred that fires once
+            the running ones are finished. """
+        del self._heap[:]
+        self._waiting.clear()
+        self._waiting_streams.clear()
+        if self._call is not None and self._call.active():
+            self._call.cancel()
+        self._stopped = defer.Deferred()
+        self._check_stopped()
+        return self._stopped
+
+    def _check_stopped(self):
+        if self._stopped is not None and not self._stopped.called and \
+                not sum(self._running.values()):
+            self._stopped.callback(None)
 
 
 class PerfdWebClient(object):
 
-    def __init__(self, reactor, server_config, client_config):
+    def __init__(self, reactor, server_config, client_config, scheduler,
+                 store=None, tor_pool=None):
         self._reactor = reactor
+        self._scheduler = scheduler
+        self._store = store
+        self._tor_pool = tor_pool
         self._public_host = server_config['public-host']
         self._http_port = server_config['http-port']
         self._source = client_config['source']
         self._launch_tor = client_config['launch-tor']
         self._tor_binary = client_config['tor-binary']
+        self._tor_options = client_config['tor-options']
         self._start_delay = client_config['start-delay']
         self._request_delay = client_config['request-delay']
+        self._request_jitter = client_config['request-jitter']
         self._socks_port = client_config['socks-port']
         self._control_port = client_config['control-port']
         self._file_size = client_config['file-size']
         self._request_timeout = client_config['request-timeout']
-
-    def _create_config(self, proto):
-        """Of course, we could use @inlineCallbacks so there are fewer tiny callbacks"""
-        config = txtorcon.TorConfig(proto)
-        config.post_bootstrap.addCallback(self._set_config).addErrback(self._error)
-
-    def _set_config(self, config):
-        config.SocksPort = [self._socks_port]
-        config.ControlPort = [self._control_port]
-        d = config.save()
-        d.addCallback(self._launched, config).addErrback(self._error)
+        self._data_file = client_config['data-file']
+        self._extradata_file = client_config['extradata-file']
+        self._series_length = client_config['series-length']
+        self._series_shape = client_config['series-shape']
+        self._direction = client_config['direction']
+        if self._direction not in ('download', 'upload'):
+            raise ValueError('Unknown direction %r.' % (self._direction, ))
+        if self._direction == 'upload' and self._series_length > 1:
+            raise ValueError('Request series are only supported for '
+                             'downloads.')
+        if self._series_shape not in PerfdRequestSeries.shapes:
+            raise ValueError('Unknown series shape %r.' %
+                             (self._series_shape, ))
+        self._circuits = None
+        self._protocol = None
+        self._tor = None
 
     def launch_tor(self):
-        # TODO How would we not launch, but only connect to Tor?
-        if True:
-            ## meejah: to connect to a running system Tor, presuming
-            ## default ports, simply do the following. If build_state
-            ## is True instead, then the object you get back is a
-            ## TorState. Below, we get back a TorControlProtocol
-            ## instance (same as launch_tor())
-            d = txtorcon.build_tor_connection(endpoints.TCP4ClientEndpoint(reactor, "localhost", 9051),
-                                              build_state=False)
-            d.addCallback(self._create_config).addErrback(self._error)
+        if not self._launch_tor:
+            # Use the Tor process, or a stand-in like perfdnetwork.py, that
+            # is already listening on our control port, as it's configured.
+            d = txtorcon.build_tor_connection(
+                    endpoints.TCP4ClientEndpoint(self._reactor, 'localhost',
+                                                 self._control_port),
+                    build_state=False)
+            d.addCallback(self._complete).addErrback(self._error)
             return
-
-        config = txtorcon.TorConfig()
-        config.SocksPort = self._socks_port
-        config.ControlPort = self._control_port
-        updates = functools.partial(self._updates,
-                                    'TOR-%d' % self._socks_port)
-        d = txtorcon.launch_tor(config, self._reactor,
-                                tor_binary=self._tor_binary,
-                                progress_updates=updates)
-        d.addCallback(self._launched, config).addErrback(self._error)
-
-    def _launched(self, config, slave):
-        print "Successfully launched Tor process!", config, slave
-        self._launched_tor = slave.protocol
-        self._complete(slave.protocol)
+        # The pool starts Tor right away, in parallel with the other
+        # clients' Tors, and calls us again whenever it was restarted.
+        self._tor = self._tor_pool.launch(self._tor_binary, self._socks_port,
+                                          self._control_port,
+                                          self._tor_options)
+        self._tor.when_ready(self._complete)
 
     def _error(self, fail):
         sys.stderr.write(fail.getBriefTraceback())
         return fail
 
-    def _updates(self, tor, prog, tag, summary):
-        log.msg('%s: %d%%: %s' % (tor, prog, summary))
-
     def _complete(self, protocol):
         log.msg('Connected to Tor version %s' % protocol.version)
-        log.msg("Launching periodic requests every %f seconds" % self._request_delay)
+        first = self._circuits is None
         if False:
             # TODO Placeholder for hidden service support
-            self.service_requestor = task.LoopingCall(PerfdWebRequest, self.config.HiddenServices[0].hostname,
-                                                      self._http_port, self._socks_port, self._file_size, self._request_timeout)
-            self.service_requestor.start(self._request_delay)
-
+            self._host = self.config.HiddenServices[0].hostname
+        else:
+            self._host = self._public_host
+        self._protocol = protocol
+        if not first:
+            # The streams of the Tor that exited won't be closed anymore.
+            self._circuits.release()
+        self._circuits = CircuitTracker(self._source, monotonic_clock,
+                                        Measurement.by_source_port)
+        self._circuits.on_circuit = self._emit_circuit
+        if self._extradata_file:
+            self._circuits.on_line = self._write_extradata_line
+        self._circuits.listen(protocol)
+        if not first:
+            return
+        log.msg("Launching periodic requests every %f seconds" % self._request_delay)
+        self._scheduler.add_stream(self._start_request, self._socks_port,
+                                   self._start_delay, self._request_delay,
+                                   self._request_jitter)
+
+    def stop(self):
+        """ Close our control connection, unless it's the pool's. """
+        if self._protocol is not None and self._tor is None:
+            self._protocol.transport.loseConnection()
+        self._protocol = None
+
+    def _start_request(self, scheduled):
+        if self._tor is not None and self._tor.protocol is None:
+            log.msg('Skipping request via Tor %d due at %f, because Tor is '
+                    'restarting.' % (self._socks_port, scheduled))
+            return defer.succeed(None)
+        if self._direction == 'upload':
+            request = PerfdUploadRequest(self._host, self._http_port,
+                                         self._socks_port, self._file_size,
+                                         self._request_timeout, self._source,
+                                         scheduled)
+            measurements = [request.measurement]
+            done = request.measurement.deferred
+        elif self._series_length > 1:
+            series = PerfdRequestSeries(self._host, self._http_port,
+                                        self._socks_port, self._file_size,
+                                        self._request_timeout, self._source,
+                                        self._series_length,
+                                        self._series_shape, scheduled)
+            measurements = series.measurements + [series.aggregate]
+            done = series.aggregate.deferred
         else:
-            self.service_requestor = task.LoopingCall(PerfdWebRequest, self._public_host,
-                                                      self._http_port, self._socks_port, self._file_size, self._request_timeout)
-            # TODO Add start delay
-            self.service_requestor.start(self._request_delay)
+            request = PerfdWebRequest(self._host, self._http_port,
+                                      self._socks_port, self._file_size,
+                                      self._request_timeout, self._source,
+                                      scheduled)
+            measurements = [request.measurement]
+            done = request.measurement.deferred
+        for measurement in measurements:
+            if self._circuits is not None:
+                measurement.deferred.addCallback(self._join_circuit)
+            measurement.deferred.addCallback(self._emit_measurement)
+        return done
+
+    def _join_circuit(self, measurement):
+        # Wait until the stream closed on the Tor side, so that the
+        # measurement is stored with its circuit.
+        return self._circuits.joined(measurement, measurement.source_port)
+
+    def _emit_circuit(self, record):
+        log.msg(record)
+        if self._store is not None:
+            self._store.add_circuit(record)
+
+    def _emit_measurement(self, measurement):
+        log.msg(dict(measurement))
+        if self._store is not None:
+            self._store.add_request(measurement)
+        # Aggregates of a series are not a single download.
+        if self._data_file and ('SERIES' not in measurement or
+                                'SERIES_INDEX' in measurement):
+            self._write_data_line(measurement)
+        return measurement
+
+    def _write_data_line(self, measurement):
+        with open(self._data_file, 'a') as data_file:
+            data_file.write(measurement.data_line())
+        return measurement
+
+    def _write_extradata_line(self, line):
+        with open(self._extradata_file, 'a') as extradata_file:
+            extradata_file.write(line + '\n')
 
 
 class TorPerfdService(service.Service):
@@ -322,25 +1470,66 @@ class TorPerfdService(service.Service):
         self._server_config = server_config
         self._client_configs = client_configs
         self.started_clients = []
+        self.store = None
+        self.web_port = None
+        self.scheduler = MeasurementScheduler(
+                server_config['max-requests-per-tor'])
+        self.tor_pool = TorPool(server_config['tor-data-directory'],
+                                server_config['tor-bootstrap-timeout'],
+                                clock=reactor, ireactorprocess=reactor)
 
     def privilegedStartService(self):
         service.Service.privilegedStartService(self)
 
         self.web_endpoint = endpoints.TCP4ServerEndpoint(self._reactor,
                             self._server_config['http-port'])
+        pool = RandomDataPool(self._server_config['payload-pool-size'],
+                              self._server_config['payload-file'])
         root = resource.Resource()
-        root.putChild('urandom', UrandomResourceDispatcher())
-        self.web_endpoint.listen(server.Site(root))
+        root.putChild('urandom', UrandomResourceDispatcher(pool,
+                      self._server_config['streaming-payload']))
+        # The result store is only opened after dropping privileges.
+        self.results_resource = ResultsResource()
+        root.putChild('results', self.results_resource)
+        root.putChild('sink', SinkResource())
+        d = self.web_endpoint.listen(PerfdSite(root))
+        d.addCallback(self._listening)
+
+    def _listening(self, port):
+        self.web_port = port
 
     def startService(self):
         service.Service.startService(self)
         if self._server_config['debug-txtorcon']:
             txtorcon.log.debug_logging()
+        if self._server_config['database']:
+            self.store = ResultStore(self._server_config['database'])
+            self.store.start()
+            self.results_resource.store = self.store
+        server_config = self._server_config
+        if not server_config['http-port'] and self.web_port is not None:
+            server_config = dict(server_config, **{
+                'http-port': self.web_port.getHost().port})
         for client_config in self._client_configs:
-            client = PerfdWebClient(self._reactor, self._server_config, client_config)
+            client = PerfdWebClient(self._reactor, server_config,
+                                    client_config, self.scheduler,
+                                    self.store, self.tor_pool)
             client.launch_tor()
             self.started_clients.append(client)
 
+    def stopService(self):
+        service.Service.stopService(self)
+        # Requests that are still running are not waited for.
+        self.scheduler.stop()
+        for client in self.started_clients:
+            client.stop()
+        if self.store is not None:
+            self.store.stop()
+        stopped = [self.tor_pool.stop()]
+        if self.web_port is not None:
+            stopped.append(self.web_port.stopListening())
+        return defer.gatherResults(stopped)
+
 
 class TorPerfdPlugin(object):
     implements(IPlugin, service.IServiceMaker)
@@ -358,7 +1547,781 @@ if __name__ == '__main__':
     print 'Please use "twistd -n torperfd" to launch perfd.py for debugging, or use the "perfd" shell script'
 
 class TestLaunch(unittest.TestCase):
+    """ Runs the service with launched Tor processes, using perfdnetwork.py
+        as the Tor binary, and restarts one of them. """
+
+    tors = 3
 
     def test_launch(self):
-        pass
+        directory = self.mktemp()
+        os.makedirs(directory)
+        configs = [dict(client_configs[0], **{
+            'source': 'tor%d' % index, 'launch-tor': True,
+            'tor-binary': fake_tor_binary(directory), 'start-delay': 0,
+            'request-delay': 0.2, 'request-jitter': 0,
+            'socks-port': free_port(), 'control-port': free_port(),
+            'file-size': 10240, 'request-timeout': 5})
+            for index in range(self.tors)]
+        service = TorPerfdService(reactor, dict(server_config, **{
+            'public-host': '127.0.0.1', 'http-port': 0,
+            'payload-pool-size': 2 ** 16, 'database': self.mktemp(),
+            'tor-data-directory': os.path.join(directory, 'data'),
+            'tor-bootstrap-timeout': 10}), configs)
+        service.tor_pool.restart_delay = 0.1
+        service.privilegedStartService()
+        service.startService()
+        tors = service.tor_pool.processes.values()
+        self.assertEqual(len(tors), self.tors)
+        ready = []
+        def restarted(proto):
+            ready.append(proto)
+            if len(ready) == self.tors:
+                tors[0].transport.signalProcess('KILL')
+            elif len(ready) > self.tors:
+                d.callback(None)
+        d = defer.Deferred()
+        for tor in tors:
+            tor.when_ready(restarted)
+        d.addCallback(lambda ignored: task.deferLater(reactor, 1, lambda: None))
+        d.addCallback(lambda ignored: service.scheduler.stop())
+        d.addCallback(lambda ignored: service.stopService())
+        def check(ignored):
+            self.assertEqual([tor.restarts for tor in tors],
+                             [1] + [0] * (self.tors - 1))
+            for client in service.started_clients:
+                # Only a request that Tor was killed under has no circuit.
+                requests = [request for request in service.store.requests(
+                                source=client._source)
+                            if request.get('CIRC_ID') is not None]
+                self.assertTrue(len(requests) >= 3)
+                for request in requests:
+                    self.assertEqual(request['DIDTIMEOUT'], 0)
+            for tor in tors:
+                self.assertIdentical(tor.protocol, None)
+        return d.addCallback(check)
+
+
+class _CollectingConsumer(object):
+    """ Consumer that pulls everything from a pull producer at once. """
+
+    def __init__(self):
+        self.data = []
+        self.producer = None
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+
+    def unregisterProducer(self):
+        self.producer = None
+
+    def write(self, data):
+        self.data.append(data)
+
+    def drain(self):
+        while self.producer is not None:
+            self.producer.resumeProducing()
+        return ''.join(self.data)
+
+
+class TestRandomDataPool(unittest.TestCase):
+
+    def test_read_wraps_around(self):
+        pool = RandomDataPool(2 ** 16)
+        data = pool.read(2 ** 16 - 10, 20)
+        self.assertEqual(data, pool.read(2 ** 16 - 10, 10) + pool.read(0, 10))
+
+    def test_file_backed_pool(self):
+        path = self.mktemp()
+        pool = RandomDataPool(2 ** 16, path)
+        self.assertEqual(os.path.getsize(path), 2 ** 16)
+        self.assertEqual(pool.read(0, 2 ** 16), open(path, 'rb').read())
+
+    def test_responses_differ(self):
+        pool = RandomDataPool(2 ** 16)
+        bodies = set()
+        for i in xrange(3):
+            consumer = _CollectingConsumer()
+            producer = RandomDataProducer(100000, {}, reactor, pool)
+            producer.beginProducing(consumer)
+            body = consumer.drain()
+            self.assertEqual(len(body), 100000)
+            bodies.add(body)
+        self.assertEqual(len(bodies), 3)
+
+
+
+class _PausingConsumer(_CollectingConsumer):
+    """ Consumer whose buffer is full after every single write. """
+
+    def write(self, data):
+        _CollectingConsumer.write(self, data)
+        self.producer.pauseProducing()
 
+
+class _SentLengthRequest(object):
+    sentLength = 0
+
+
+class _ReadAll(protocol.Protocol):
+    """ Sends a HEAD request and collects the whole response. """
+
+    def connectionMade(self):
+        self.received = []
+        self.transport.write('HEAD /100000 HTTP/1.0\r\n\r\n')
+
+    def dataReceived(self, data):
+        self.received.append(data)
+
+    def connectionLost(self, reason):
+        self.factory.done.callback(''.join(self.received))
+
+
+class TestStreamingPayload(unittest.TestCase):
+
+    def _serve(self, pool):
+        site = server.Site(UrandomResourceDispatcher(pool, True))
+        port = reactor.listenTCP(0, site, interface='127.0.0.1')
+        self.addCleanup(port.stopListening)
+        return port.getHost().port
+
+    def _fetch(self, port, size, method='GET'):
+        agent = client.Agent(reactor)
+        d = agent.request(method, 'http://127.0.0.1:%d/%d' % (port, size))
+        d.addCallback(client.readBody)
+        return d
+
+    def test_backpressure(self):
+        consumer = _PausingConsumer()
+        producer = StreamingDataProducer(200000, {}, reactor,
+                                         RandomDataPool(2 ** 16))
+        producer.beginProducing(consumer)
+        self.assertEqual(len(consumer.data), 1)
+        producer.resumeProducing()
+        self.assertEqual(len(consumer.data), 2)
+
+    def test_push_producer(self):
+        port = self._serve(RandomDataPool(2 ** 16))
+        d = self._fetch(port, 300000)
+        d.addCallback(lambda body: self.assertEqual(len(body), 300000))
+        return d
+
+    def test_sendfile(self):
+        if sendfile is None:
+            raise unittest.SkipTest("No sendfile() on this platform.")
+        pool = RandomDataPool(2 ** 20, self.mktemp())
+        port = self._serve(pool)
+        offset = pool.next_offset() + pool.offset_stride
+        d = self._fetch(port, 3000000)
+        def check(body):
+            self.assertEqual(len(body), 3000000)
+            self.assertEqual(body[:1000], pool.read(offset, 1000))
+        d.addCallback(check)
+        return d
+
+    def test_sendfile_transport(self):
+        skt = socket.socket()
+        self.addCleanup(skt.close)
+        request = _SentLengthRequest()
+        request.transport = tcp.Connection(skt, None, reactor)
+        # All internals are there in the Twisted that we run on.
+        self.assertTrue(SendfileTransport.supports(request))
+        request.transport.dataBuffer = 'abcdef'
+        request.transport.offset = 2
+        request.transport._tempDataLen = 3
+        self.assertEqual(SendfileTransport(request).buffered(), 7)
+        del request.transport._tempDataLen
+        self.assertFalse(SendfileTransport.supports(request))
+
+    def test_head(self):
+        if sendfile is None:
+            raise unittest.SkipTest("No sendfile() on this platform.")
+        port = self._serve(RandomDataPool(2 ** 16, self.mktemp()))
+        # Read everything that comes back, in case a body follows the
+        # headers.
+        collect = protocol.ClientFactory()
+        collect.protocol = _ReadAll
+        collect.done = defer.Deferred()
+        reactor.connectTCP('127.0.0.1', port, collect)
+        def check(response):
+            headers, body = response.split('\r\n\r\n', 1)
+            self.assertIn('Content-Length: 100000', headers)
+            self.assertEqual(body, '')
+        return collect.done.addCallback(check)
+
+
+class TestMeasurement(unittest.TestCase):
+
+    def test_finish_emits_once(self):
+        measurement = Measurement('test', 51200)
+        emitted = []
+        measurement.deferred.addCallback(emitted.append)
+        measurement.finish()
+        measurement.finish()
+        self.assertEqual(emitted, [measurement])
+        self.assertNotIn(measurement.id, Measurement.pending)
+
+    def test_client_and_server_share_measurement(self):
+        site = server.Site(UrandomResourceDispatcher(RandomDataPool(2 ** 16)))
+        port = reactor.listenTCP(0, site, interface='127.0.0.1')
+        self.addCleanup(port.stopListening)
+        measurement = Measurement('test', 200000)
+        factory = client.HTTPClientFactory(
+                'http://127.0.0.1:%d/200000' % port.getHost().port,
+                headers={Measurement.header: measurement.id})
+        factory.protocol = MeasuringHTTPPageGetter
+        factory.measurement = measurement
+        reactor.connectTCP('127.0.0.1', port.getHost().port, factory)
+        def check(body):
+            measurement.finish()
+            self.assertEqual(len(body), 200000)
+            self.assertEqual(measurement['DIDTIMEOUT'], 0)
+            self.assertTrue(measurement['READBYTES'] > 200000)
+            self.assertTrue(measurement['DATAREQUEST'] <=
+                            measurement['DATARESPONSE'] <=
+                            measurement['DATAPERC50'] <=
+                            measurement['DATACOMPLETE'])
+            self.assertIn('SERVER_PERC50', measurement)
+        factory.deferred.addCallback(check)
+        return factory.deferred
+
+
+class TestResultsResource(unittest.TestCase):
+
+    def setUp(self):
+        self.store = ResultStore(self.mktemp(), flush_interval=0.01)
+        self.store.start()
+        for i in xrange(1200):
+            self.store.add_request({'SOURCE': 'ec2' if i % 2 else 'siv',
+                                    'FILESIZE': 51200, 'START': 1000.0 + i,
+                                    'DIDTIMEOUT': 0})
+        self.store.stop()
+        site = server.Site(ResultsResource(self.store))
+        self.port = reactor.listenTCP(0, site, interface='127.0.0.1')
+        self.addCleanup(self.port.stopListening)
+
+    def _get(self, query, headers=None):
+        agent = client.Agent(reactor)
+        url = 'http://127.0.0.1:%d/?%s' % (self.port.getHost().port, query)
+        d = agent.request('GET', url, headers)
+        def read(response):
+            d = client.readBody(response)
+            d.addCallback(lambda body: (response, body))
+            return d
+        d.addCallback(read)
+        return d
+
+    def test_keyvalue(self):
+        d = self._get('source=ec2&start=1100&end=2000')
+        def check((response, body)):
+            lines = body.splitlines()
+            self.assertEqual(len(lines), 450)
+            self.assertEqual(lines[0], 'DIDTIMEOUT=0 FILESIZE=51200 '
+                                       'SOURCE=ec2 START=1101.000000')
+        d.addCallback(check)
+        return d
+
+    def test_json(self):
+        d = self._get('filesize=51200&format=json')
+        def check((response, body)):
+            records = json.loads(body)
+            self.assertEqual(len(records), 1200)
+            self.assertEqual(records[-1]['START'], 2199.0)
+        d.addCallback(check)
+        return d
+
+    def test_bad_arguments(self):
+        d = self._get('filesize=big')
+        d.addCallback(lambda (response, body):
+                      self.assertEqual(response.code, http.BAD_REQUEST))
+        return d
+
+    def test_client_disconnects(self):
+        channel = DummyChannel()
+        request = server.Request(channel, False)
+        request.method = 'GET'
+        request.args = {'source': ['ec2']}
+        finished = []
+        self.patch(request, 'finish', lambda: finished.append(True))
+        read = []
+        requests = self.store.requests
+        def counting_requests(*args):
+            for record in requests(*args):
+                read.append(record)
+                yield record
+        self.patch(self.store, 'requests', counting_requests)
+        results = ResultsResource(self.store)
+        self.assertEqual(results.render_GET(request), server.NOT_DONE_YET)
+        request.connectionLost(failure.Failure(error.ConnectionDone()))
+        def check():
+            # No results were read for or written to the lost connection,
+            # and the request wasn't finished.
+            self.assertEqual(read, [])
+            self.assertEqual(finished, [])
+            self.assertEqual(channel.transport.written.getvalue(), '')
+        return task.deferLater(reactor, 0.05, check)
+
+    def test_conditional_get(self):
+        d = self._get('source=ec2')
+        def again((response, body)):
+            etag = response.headers.getRawHeaders('etag')[0]
+            headers = client.Headers({'If-None-Match': [etag]})
+            return self._get('source=ec2', headers)
+        d.addCallback(again)
+        d.addCallback(lambda (response, body):
+                      self.assertEqual(response.code, http.NOT_MODIFIED))
+        return d
+
+
+class TestMeasurementScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.scheduler = MeasurementScheduler(1, self.clock)
+        self.started = []
+
+    def _start_request(self, name):
+        def start_request(scheduled):
+            d = defer.Deferred()
+            self.started.append((name, scheduled, self.clock.seconds(), d))
+            return d
+        return start_request
+
+    def test_start_delay_and_interval(self):
+        self.scheduler.add_stream(self._start_request('a'), 9020, 120, 300)
+        self.clock.advance(119)
+        self.assertEqual(self.started, [])
+        self.clock.advance(1)
+        self.assertEqual(len(self.started), 1)
+        self.started[0][3].callback(None)
+        self.clock.advance(300)
+        self.assertEqual([s[1] for s in self.started], [120, 420])
+
+    def test_jitter(self):
+        self.scheduler.add_stream(self._start_request('a'), 9020, 0, 300, 30)
+        for i in xrange(10):
+            self.clock.advance(30)
+            for s in self.started:
+                if not s[3].called:
+                    s[3].callback(None)
+            self.clock.advance(270)
+        for i, s in enumerate(self.started):
+            self.assertTrue(i * 300 <= s[1] <= i * 300 + 30)
+
+    def test_concurrency_limit_per_tor(self):
+        self.scheduler.add_stream(self._start_request('a'), 9020, 0, 300)
+        self.scheduler.add_stream(self._start_request('b'), 9020, 0, 300)
+        self.scheduler.add_stream(self._start_request('c'), 9021, 0, 300)
+        self.clock.advance(0)
+        self.assertEqual(sorted([s[0] for s in self.started]), ['a', 'c'])
+        self.clock.advance(5)
+        waiting = [s for s in self.started if s[0] == 'a'][0]
+        waiting[3].callback(None)
+        name, scheduled, started, d = self.started[-1]
+        self.assertEqual((name, scheduled, started), ('b', 0, 5))
+
+    def test_skips_waiting_stream(self):
+        self.scheduler.add_stream(self._start_request('a'), 9020, 0, 10)
+        self.scheduler.add_stream(self._start_request('b'), 9020, 0, 10)
+        self.clock.pump([10] * 5)
+        self.assertEqual(len(self.started), 1)
+        self.started[0][3].callback(None)
+        self.assertEqual(len(self.started), 2)
+        self.assertEqual(self.started[1][2] - self.started[1][1], 50)
+
+
+class TestPerfdWebRequest(unittest.TestCase):
+
+    def test_request_via_socks(self):
+        site = server.Site(resource.Resource())
+        site.resource.putChild('urandom',
+                               UrandomResourceDispatcher(RandomDataPool(2 ** 16)))
+        web = reactor.listenTCP(0, site, interface='127.0.0.1')
+        self.addCleanup(web.stopListening)
+        socks = reactor.listenTCP(0, SOCKSServerFactory(0.01),
+                                  interface='127.0.0.1')
+        self.addCleanup(socks.stopListening)
+        request = PerfdWebRequest('127.0.0.1', web.getHost().port,
+                                  socks.getHost().port, 100000, 30, 'test')
+        def check(measurement):
+            self.assertEqual(measurement['DIDTIMEOUT'], 0)
+            self.assertTrue(measurement['READBYTES'] > 100000)
+            stages = [measurement[key] for key in
+                      Measurement.data_timestamps + ['SERVER_PERC50']]
+            self.assertEqual(stages[:-1], sorted(stages[:-1]))
+            self.assertEqual(len(measurement.data_line().split()), 39)
+        request.measurement.deferred.addCallback(check)
+        return request.measurement.deferred
+
+    def test_timeout_in_socks_handshake(self):
+        factory = protocol.ServerFactory()
+        factory.protocol = _SilentSOCKSServer
+        factory.connections = []
+        socks = reactor.listenTCP(0, factory, interface='127.0.0.1')
+        self.addCleanup(socks.stopListening)
+        request = PerfdWebRequest('127.0.0.1', 80, socks.getHost().port,
+                                  100000, 0.2, 'test')
+        def check(measurement):
+            self.assertEqual(measurement['DIDTIMEOUT'], 1)
+            self.assertFalse('RESPONSE' in measurement)
+            self.assertEqual(len(factory.connections), 1)
+            # The connection to the SOCKS server was dropped.
+            return factory.connections[0].lost
+        request.measurement.deferred.addCallback(check)
+        return request.measurement.deferred
+
+
+class _SilentSOCKSServer(protocol.Protocol):
+    """ SOCKS stand-in for a Tor that never answers. """
+
+    def connectionMade(self):
+        self.lost = defer.Deferred()
+        self.factory.connections.append(self)
+
+    def connectionLost(self, reason):
+        self.lost.callback(None)
+
+
+class _StreamEventsSOCKSServer(SOCKSServerProtocol):
+    """ SOCKS stand-in for Tor that reports its streams on a fake control
+        port, all attached to circuit 5. """
+
+    def connectionMade(self):
+        SOCKSServerProtocol.connectionMade(self)
+        self._strm_id = next(self.factory.stream_ids)
+        self._event('NEW 0 127.0.0.1:80 SOURCE_ADDR=127.0.0.1:%d '
+                    'PURPOSE=USER' % self.transport.getPeer().port)
+        self._event('SENTCONNECT 5 127.0.0.1:80')
+
+    def connectionLost(self, reason):
+        SOCKSServerProtocol.connectionLost(self, reason)
+        self._event('CLOSED 5 127.0.0.1:80 REASON=DONE')
+
+    def _event(self, text):
+        self.factory.control.connections[0].send_event(
+                'STREAM', '%d %s' % (self._strm_id, text))
+
+
+class _ListStore(object):
+
+    def __init__(self):
+        self.requests = []
+        self.circuits = []
+
+    def add_request(self, record):
+        self.requests.append(record)
+
+    def add_circuit(self, record):
+        self.circuits.append(record)
+
+
+class TestCircuitJoin(unittest.TestCase):
+
+    def setUp(self):
+        site = PerfdSite(resource.Resource())
+        site.resource.putChild('urandom',
+                               UrandomResourceDispatcher(RandomDataPool(2 ** 16)))
+        web = reactor.listenTCP(0, site, interface='127.0.0.1')
+        self.addCleanup(web.stopListening)
+        self.control = ReplayControlPortFactory(trace_events([
+            (0, 'CIRC 5 LAUNCHED PURPOSE=GENERAL'),
+            (0, 'CIRC 5 EXTENDED $%s~a PURPOSE=GENERAL' % ('A' * 40)),
+            (0, 'CIRC 5 BUILT $%s~a PURPOSE=GENERAL' % ('A' * 40))]),
+            speed=0, settle=0)
+        control = reactor.listenTCP(0, self.control, interface='127.0.0.1')
+        self.addCleanup(control.stopListening)
+        self.control_port = control.getHost().port
+        socks_factory = SOCKSServerFactory()
+        socks_factory.protocol = _StreamEventsSOCKSServer
+        socks_factory.control = self.control
+        socks_factory.stream_ids = itertools.count(40)
+        socks = reactor.listenTCP(0, socks_factory, interface='127.0.0.1')
+        self.addCleanup(socks.stopListening)
+        self.extradata = self.mktemp()
+        client_config = dict(client_configs[0], **{
+            'source': 'test', 'socks-port': socks.getHost().port,
+            'extradata-file': self.extradata})
+        self.store = _ListStore()
+        self.client = PerfdWebClient(reactor, {
+            'public-host': '127.0.0.1', 'http-port': web.getHost().port},
+            client_config, MeasurementScheduler(1, task.Clock()), self.store)
+
+    def test_measurement_carries_circuit(self):
+        def connected(proto):
+            self.addCleanup(proto.transport.loseConnection)
+            self.client._complete(proto)
+            return self.client._start_request(None)
+        def check(measurement):
+            self.assertEqual(measurement['CIRC_ID'], 5)
+            self.assertEqual(measurement['PATH'], '$' + 'A' * 40)
+            self.assertEqual(measurement['USED_BY'], 40)
+            self.assertEqual(self.store.requests, [measurement])
+            self.assertEqual(self.store.circuits[0]['SOURCE'], 'test')
+            self.assertEqual(Measurement.by_source_port, {})
+            line = open(self.extradata).read()
+            self.assertTrue(line.startswith('CIRC_ID=5 LAUNCH='))
+            self.assertTrue(line.endswith(' USED_BY=40 \n'))
+        d = txtorcon.build_tor_connection(
+                endpoints.TCP4ClientEndpoint(reactor, '127.0.0.1',
+                                             self.control_port),
+                build_state=False)
+        d.addCallback(connected)
+        d.addCallback(check)
+        return d
+
+
+class TestTorPerfdService(unittest.TestCase):
+    """ Runs the whole service against a few dozen emulated Tor processes
+        from perfdnetwork.py, with 20-40 ms round trips, 256 KiB/s streams,
+        and one in ten streams refused and one in ten stalled. """
+
+    tors = 24
+    latency = 0.02
+    bandwidth = 262144
+    file_size = 51200
+    request_timeout = 1.5
+    duration = 3
+
+    def setUp(self):
+        self.emulated = []
+        configs = []
+        for index in range(self.tors):
+            tor = EmulatedTorFactory(self.latency, self.latency,
+                                     self.bandwidth, failure_rate=0.1,
+                                     stall_rate=0.1, stall_after=4096,
+                                     seed=index)
+            socks_port, control_port = tor.listen()
+            self.addCleanup(tor.stopListening)
+            self.emulated.append(tor)
+            configs.append(dict(client_configs[0], **{
+                'source': 'tor%d' % index, 'launch-tor': False,
+                'start-delay': 0.2, 'request-delay': 0.3,
+                'request-jitter': 0.1, 'socks-port': socks_port,
+                'control-port': control_port, 'file-size': self.file_size,
+                'request-timeout': self.request_timeout}))
+        self.service = TorPerfdService(reactor, dict(server_config, **{
+            'public-host': '127.0.0.1', 'http-port': 0,
+            'payload-pool-size': 2 ** 16, 'database': self.mktemp()}),
+            configs)
+
+    def test_emulated_network(self):
+        self.service.privilegedStartService()
+        self.service.startService()
+        d = task.deferLater(reactor, self.duration, self.service.scheduler.stop)
+        d.addCallback(lambda ignored: self.service.stopService())
+        d.addCallback(self._check)
+        return d
+
+    def _check(self, ignored):
+        store = self.service.store
+        # Three hops and the exit's answer, and all but the first chunk at
+        # the stream's bandwidth.
+        minimum = 4 * self.latency + \
+            float(self.file_size - CHUNK_SIZE) / self.bandwidth
+        total_bytes = total_seconds = 0
+        totals = collections.defaultdict(int)
+        for index, tor in enumerate(self.emulated):
+            source = 'tor%d' % index
+            requests = list(store.requests(source=source))
+            circuits = list(store.circuits(source=source))
+            self.assertEqual(len(requests), sum(tor.outcomes.values()))
+            self.assertEqual(len(circuits), len(requests))
+            outcomes = collections.defaultdict(int)
+            for request in requests:
+                self.assertNotEqual(request.get('CIRC_ID'), None)
+                if request['DIDTIMEOUT']:
+                    elapsed = request['DATACOMPLETE'] - request['START']
+                    outcomes['stalled'] += 1
+                    self.assertTrue(request['READBYTES'] < self.file_size)
+                    self.assertTrue(self.request_timeout - 0.01 <= elapsed <
+                                    self.request_timeout + 0.5)
+                elif 'STREAM_FAIL_REASONS' in request:
+                    outcomes['refused'] += 1
+                    self.assertEqual(request['STREAM_FAIL_REASONS'],
+                                     'END:CONNECTREFUSED')
+                else:
+                    outcomes['relayed'] += 1
+                    self.assertTrue(request['READBYTES'] > self.file_size)
+                    self.assertTrue(request['DATACOMPLETE'] -
+                                    request['START'] >= minimum)
+                    self.assertEqual(len(request['PATH'].split(',')), 3)
+                    self.assertEqual(len(request['BUILDTIMES'].split(',')), 3)
+                    total_bytes += request['READBYTES']
+                    total_seconds += (request['DATACOMPLETE'] -
+                                      request['DATARESPONSE'])
+            self.assertEqual(dict(outcomes), dict(tor.outcomes))
+            for outcome, count in outcomes.iteritems():
+                totals[outcome] += count
+        self.assertEqual(sorted(totals), ['refused', 'relayed', 'stalled'])
+        self.assertTrue(totals['relayed'] >= 4 * self.tors)
+        # Streams get their bandwidth, give or take the HTTP headers, even
+        # with all of them sharing one CPU.
+        throughput = total_bytes / total_seconds
+        self.assertTrue(self.bandwidth / 2 < throughput <
+                        self.bandwidth * 1.1)
+
+
+class TestPerfdRequestSeries(unittest.TestCase):
+
+    def setUp(self):
+        site = PerfdSite(resource.Resource())
+        site.resource.putChild('urandom',
+                               UrandomResourceDispatcher(RandomDataPool(2 ** 16)))
+        web = reactor.listenTCP(0, site, interface='127.0.0.1')
+        self.addCleanup(web.stopListening)
+        socks = reactor.listenTCP(0, SOCKSServerFactory(0.01),
+                                  interface='127.0.0.1')
+        self.addCleanup(socks.stopListening)
+        self.ports = (web.getHost().port, socks.getHost().port)
+
+    def _series(self, shape):
+        series = PerfdRequestSeries('127.0.0.1', self.ports[0],
+                                    self.ports[1], 50000, 30, 'test', 3,
+                                    shape)
+        def check(aggregate):
+            self.assertEqual(aggregate['SERIES_LENGTH'], 3)
+            self.assertNotIn('SERIES_INDEX', aggregate)
+            self.assertEqual(aggregate['DIDTIMEOUT'], 0)
+            for index, measurement in enumerate(series.measurements):
+                self.assertEqual(measurement['SERIES'], aggregate['SERIES'])
+                self.assertEqual(measurement['SERIES_INDEX'], index)
+                self.assertEqual(measurement['DIDTIMEOUT'], 0)
+                self.assertTrue(measurement['READBYTES'] > 50000)
+                self.assertIn('SERVER_PERC50', measurement)
+            self.assertEqual(aggregate['READBYTES'],
+                             sum([m['READBYTES'] for m in series.measurements]))
+            self.assertEqual(aggregate['DATACOMPLETE'],
+                             max([m['DATACOMPLETE']
+                                  for m in series.measurements]))
+            return series.measurements
+        series.aggregate.deferred.addCallback(check)
+        return series.aggregate.deferred
+
+    def test_serial(self):
+        def check(measurements):
+            self.assertIn('SOCKET', measurements[0])
+            for previous, measurement in zip(measurements, measurements[1:]):
+                self.assertNotIn('SOCKET', measurement)
+                self.assertTrue(measurement['DATAREQUEST'] >=
+                                previous['DATACOMPLETE'])
+        return self._series('serial').addCallback(check)
+
+    def test_pipelined(self):
+        def check(measurements):
+            self.assertTrue(measurements[2]['DATAREQUEST'] <
+                            measurements[0]['DATARESPONSE'])
+            self.assertNotIn('SOCKET', measurements[2])
+        return self._series('pipelined').addCallback(check)
+
+    def test_parallel(self):
+        def check(measurements):
+            for measurement in measurements:
+                self.assertIn('RESPONSE', measurement)
+        return self._series('parallel').addCallback(check)
+
+    def test_timeout_in_socks_handshake(self):
+        factory = protocol.ServerFactory()
+        factory.protocol = _SilentSOCKSServer
+        factory.connections = []
+        socks = reactor.listenTCP(0, factory, interface='127.0.0.1')
+        self.addCleanup(socks.stopListening)
+        series = PerfdRequestSeries('127.0.0.1', self.ports[0],
+                                    socks.getHost().port, 50000, 0.2, 'test',
+                                    3, 'serial')
+        def check(aggregate):
+            self.assertEqual(aggregate['DIDTIMEOUT'], 1)
+            return factory.connections[0].lost
+        series.aggregate.deferred.addCallback(check)
+        return series.aggregate.deferred
+
+    def test_unknown_shape(self):
+        self.assertRaises(ValueError, PerfdRequestSeries, '127.0.0.1',
+                          self.ports[0], self.ports[1], 50000, 30, 'test', 3,
+                          'random')
+
+
+class TestUpload(unittest.TestCase):
+
+    def setUp(self):
+        root = resource.Resource()
+        root.putChild('sink', SinkResource())
+        web = reactor.listenTCP(0, PerfdSite(root), interface='127.0.0.1')
+        self.addCleanup(web.stopListening)
+        self.web_port = web.getHost().port
+
+    def test_sink_discards_body(self):
+        measurement = Measurement('test', 1000000)
+        self.addCleanup(measurement.finish)
+        agent = client.Agent(reactor)
+        body = client.FileBodyProducer(StringIO.StringIO('x' * 1000000))
+        d = agent.request('POST', 'http://127.0.0.1:%d/sink' % self.web_port,
+                          http_headers.Headers({Measurement.header:
+                                                [measurement.id]}), body)
+        d.addCallback(client.readBody)
+        def check(body):
+            self.assertEqual(body, '1000000\n')
+            stamps = [measurement['SERVER_PERC%d' % perc]
+                      for perc in range(10, 100, 10)]
+            self.assertEqual(stamps, sorted(stamps))
+        d.addCallback(check)
+        return d
+
+    def test_upload_via_socks(self):
+        socks = reactor.listenTCP(0, SOCKSServerFactory(0.01),
+                                  interface='127.0.0.1')
+        self.addCleanup(socks.stopListening)
+        upload_pool()
+        urandom = []
+        def counting_urandom(n, urandom_=os.urandom):
+            urandom.append(n)
+            return urandom_(n)
+        self.patch(os, 'urandom', counting_urandom)
+        request = PerfdUploadRequest('127.0.0.1', self.web_port,
+                                     socks.getHost().port, 1000000, 30,
+                                     'test')
+        def check(measurement):
+            # The body is read from the shared payload pool.
+            self.assertEqual(urandom, [])
+            self.assertEqual(measurement['DIDTIMEOUT'], 0)
+            self.assertEqual(measurement['DIRECTION'], 'upload')
+            self.assertTrue(measurement['WRITEBYTES'] > 1000000)
+            stages = [measurement[key] for key in
+                      Measurement.data_timestamps[:-3] +
+                      ['DATAPERC%d' % perc for perc in range(10, 100, 10)] +
+                      ['DATARESPONSE', 'DATACOMPLETE']]
+            self.assertEqual(stages, sorted(stages))
+            self.assertIn('SERVER_PERC90', measurement)
+        request.measurement.deferred.addCallback(check)
+        return request.measurement.deferred
+
+    def test_timeout_in_socks_handshake(self):
+        factory = protocol.ServerFactory()
+        factory.protocol = _SilentSOCKSServer
+        factory.connections = []
+        socks = reactor.listenTCP(0, factory, interface='127.0.0.1')
+        self.addCleanup(socks.stopListening)
+        request = PerfdUploadRequest('127.0.0.1', self.web_port,
+                                     socks.getHost().port, 1000000, 0.2,
+                                     'test')
+        def check(measurement):
+            self.assertEqual(measurement['DIDTIMEOUT'], 1)
+            return factory.connections[0].lost
+        request.measurement.deferred.addCallback(check)
+        return request.measurement.deferred
+
+
+class TestDataLine(unittest.TestCase):
+
+    def test_trivsocks_client_format(self):
+        measurement = Measurement('test', 51200)
+        measurement.update({'START': 1362528000.25, 'SOCKET': 1362528000.5,
+                            'DATACOMPLETE': 1362528003.9999999,
+                            'WRITEBYTES': 75, 'READBYTES': 51375,
+                            'DIDTIMEOUT': 0, 'DATAPERC10': 1362528001.000001})
+        fields = measurement.data_line().split()
+        self.assertEqual(len(fields), 39)
+        self.assertEqual(fields[:4], ['1362528000', '250000',
+                                      '1362528000', '500000'])
+        self.assertEqual(fields[16:21], ['1362528004', '0', '75', '51375',
+                                         '0'])
+        self.assertEqual(fields[21:23], ['1362528001', '1'])
+        self.assertEqual(fields[-2:], ['0', '0'])
@@ -0,0 +1,490 @@
+"""
+Circuit tracking for perfd:
+
+- Follows the CIRC, STREAM, and BUILDTIMEOUT_SET events of a Tor process
+  via txtorcon in perfd's reactor, with the same state machine that
+  extra_stats.py runs on TorCtl, and emits the same circuit records that
+  extra_stats.py writes to .extradata files.
+
+- Joins each circuit record to the request whose stream it carried when
+  the stream closes, by the local port of the request's SOCKS connection
+  that Tor reports as SOURCE_ADDR, so that results carry CIRC_ID, PATH,
+  BUILDTIMES, etc. without matching timestamps in consolidate_stats.py.
+
+Tests replay event traces through perfdreplay.py's control port.
+"""
+
+import re
+
+from twisted.internet import defer, endpoints, reactor
+from twisted.python import log
+from twisted.trial import unittest
+
+import txtorcon
+
+from torperf_circuits import Circuit, InFlightTable
+from torperf_circuits import CIRCUIT_MAX_AGE, STREAM_MAX_AGE
+from perfdreplay import ReplayControlPortFactory, trace_events
+
+# Circuit record keys that are copied into the request that used the
+# circuit, the same that consolidate_stats.py merges into .mergedata.
+JOINED_FIELDS = ['CIRC_ID', 'LAUNCH', 'PATH', 'BUILDTIMES', 'FAIL_REASONS',
+                 'STREAM_FAIL_REASONS', 'USED_AT', 'USED_BY', 'TIMEOUT',
+                 'QUANTILE']
+
+_KEYWORD_RE = re.compile(r'^[A-Z_]+=')
+
+
+def parse_event(text):
+    """ Split the text of an asynchronous event, without its event name,
+        into positional arguments and keyword arguments. """
+    positional, keywords = [], {}
+    for token in text.split():
+        if _KEYWORD_RE.match(token):
+            key, value = token.split('=', 1)
+            keywords[key] = value
+        elif not keywords:
+            positional.append(token)
+    return positional, keywords
+
+
+def _hop(long_name):
+    """ '$fingerprint' of a '$fingerprint~nickname' or '$fingerprint=nickname'
+        long name, which is how analyze_guards.py looks up guards. """
+    return re.split('[~=]', long_name, 1)[0]
+
+
+def _reason(keywords):
+    reason = keywords.get('REASON')
+    if reason and keywords.get('REMOTE_REASON'):
+        reason += ':' + keywords['REMOTE_REASON']
+    return reason
+
+
+def _source_port(keywords):
+    address = keywords.get('SOURCE_ADDR')
+    if not address or ':' not in address:
+        return None
+    try:
+        return int(address.rsplit(':', 1)[1])
+    except ValueError:
+        return None
+
+
+class CircuitTracker(object):
+    """ Turns the circuit and stream events of one Tor process into circuit
+        records, which are dicts with the keys of an .extradata line plus
+        SOURCE, and passes each of them to on_circuit(record) and, as an
+        .extradata line, to on_line(line).  on_line also gets a line for
+        every BUILDTIMEOUT_SET event.
+
+        requests maps the local port of a SOCKS connection to the record of
+        the unfinished request that made it.  When Tor closes that stream,
+        the record is updated with the JOINED_FIELDS of the circuit that
+        carried it.  Once a request finishes, joined(record, port) waits up
+        to join_timeout seconds for the stream to close, in case Tor tells
+        us after our side has seen the connection close.
+
+        Unlike extra_stats.py, which asserts, events that contradict the
+        state machine are logged and otherwise ignored, so that a surprise
+        from Tor doesn't take down the reactor's event handling.  Circuits
+        and streams that Tor never reports as closed are evicted from the
+        InFlightTables all_circs, ignore_streams, and stream_ports, which
+        count them. """
+
+    def __init__(self, source, clock=reactor, requests=None, join_timeout=10):
+        self.source = source
+        self._clock = clock
+        self.requests = requests if requests is not None else {}
+        self.join_timeout = join_timeout
+        self.on_circuit = None
+        self.on_line = None
+        self.all_circs = InFlightTable(CIRCUIT_MAX_AGE)
+        self.ignore_streams = InFlightTable(STREAM_MAX_AGE)
+        self.stream_ports = InFlightTable(STREAM_MAX_AGE)
+        self.current_timeout = None
+        self.current_quantile = None
+        # Finished requests waiting for their stream to close, by port.
+        self._waiting = {}
+
+    def listen(self, protocol):
+        """ Register for events on a txtorcon TorControlProtocol. """
+        protocol.add_event_listener('CIRC', self.circ_status_event)
+        protocol.add_event_listener('STREAM', self.stream_status_event)
+        try:
+            protocol.add_event_listener('BUILDTIMEOUT_SET',
+                                        self.buildtimeout_set_event)
+        except RuntimeError:
+            # BUILDTIMEOUT_SET is not available in 0.2.1.
+            log.msg('Tor does not support BUILDTIMEOUT_SET events.')
+
+    def buildtimeout_set_event(self, text):
+        positional, keywords = parse_event(text)
+        try:
+            self.current_timeout = int(keywords['TIMEOUT_MS'])
+            self.current_quantile = float(keywords['CUTOFF_QUANTILE'])
+        except (KeyError, ValueError):
+            log.msg('Malformed BUILDTIMEOUT_SET event %r.' % (text, ))
+        if self.on_line is not None:
+            self.on_line('BUILDTIMEOUT_SET ' + text)
+
+    def circ_status_event(self, text):
+        positional, keywords = parse_event(text)
+        if len(positional) < 2:
+            log.msg('Malformed CIRC event %r.' % (text, ))
+            return
+        circ_id, status = int(positional[0]), positional[1]
+        path = ()
+        if len(positional) > 2:
+            path = tuple([_hop(hop) for hop in positional[2].split(',')])
+        arrived_at = self._clock.seconds()
+        if status == 'LAUNCHED':
+            self.all_circs.add(circ_id, Circuit(arrived_at, circ_id),
+                               arrived_at)
+        elif circ_id not in self.all_circs:
+            return
+
+        circ = self.all_circs[circ_id]
+        if status == 'EXTENDED':
+            circ.build_times.append(arrived_at - circ.launch_time)
+        elif status == 'BUILT':
+            circ.path = path
+        elif status == 'FAILED':
+            circ.fail_reason = _reason(keywords)
+            circ.path = path
+            circ.close_time = arrived_at
+            circ.failed = True
+            self.write_circ(circ)
+            self.all_circs.pop(circ_id)
+        elif status == 'CLOSED':
+            circ.close_time = arrived_at
+            self.write_circ(circ)
+            self.all_circs.pop(circ_id)
+
+    def stream_status_event(self, text):
+        positional, keywords = parse_event(text)
+        if len(positional) < 3:
+            log.msg('Malformed STREAM event %r.' % (text, ))
+            return
+        strm_id, status = int(positional[0]), positional[1]
+        circ_id = int(positional[2])
+        arrived_at = self._clock.seconds()
+        port = _source_port(keywords)
+        if port is not None:
+            self.stream_ports.add(strm_id, port, arrived_at)
+        if status == 'NEW':
+            if keywords.get('PURPOSE') != 'USER':
+                self.ignore_streams.add(strm_id, True, arrived_at)
+                self.stream_ports.pop(strm_id, None)
+            return
+        if strm_id in self.ignore_streams:
+            if status == 'CLOSED':
+                self.ignore_streams.pop(strm_id)
+            self.stream_ports.pop(strm_id, None)
+            return
+        if circ_id not in self.all_circs:
+            if circ_id:
+                log.msg('Unknown circuit id %d has a stream event %d %s' %
+                        (circ_id, strm_id, status))
+            if status in ('DETACHED', 'FAILED', 'CLOSED'):
+                self._join(self.stream_ports.pop(strm_id, None), None)
+            return
+        circ = self.all_circs[circ_id]
+        if status == 'DETACHED' or status == 'FAILED':
+            # Detached usually means there was some failure
+            if circ.strm_id:
+                log.msg('Circuit %d already carried stream %d.' %
+                        (circ_id, circ.strm_id))
+            circ.used = True
+            circ.strm_id = strm_id
+            circ.stream_failed = True
+            circ.stream_end_time = arrived_at
+            circ.stream_fail_reason = _reason(keywords)
+            self._join(self.stream_ports.pop(strm_id, None),
+                       self.write_circ(circ))
+            # We have no explicit assurance here that tor will not
+            # try to reuse this circuit later... But we should
+            # log a message above if that happens.
+            self.all_circs.pop(circ_id)
+            # Some STREAM FAILED events are paired with a CLOSED, some are
+            # not :(
+            if status == 'FAILED':
+                self.ignore_streams.add(strm_id, True, arrived_at)
+        if status == 'CLOSED':
+            if circ.strm_id and not circ.stream_failed:
+                log.msg('Circuit %d already carried stream %d.' %
+                        (circ_id, circ.strm_id))
+            circ.used = True
+            circ.strm_id = strm_id
+            circ.stream_end_time = arrived_at
+            self._join(self.stream_ports.pop(strm_id, None),
+                       self.write_circ(circ))
+            self.all_circs.pop(circ_id)
+
+    def write_circ(self, circ):
+        """ Emit the record of a circuit, and return it. """
+        record = {'SOURCE': self.source, 'CIRC_ID': circ.circ_id,
+                  'LAUNCH': circ.launch_time, 'PATH': ','.join(circ.path),
+                  'BUILDTIMES': ','.join(map(str, circ.build_times))}
+        line = 'CIRC_ID=%d LAUNCH=%s PATH=%s BUILDTIMES=%s ' % \
+            (circ.circ_id, str(circ.launch_time), record['PATH'],
+             record['BUILDTIMES'])
+        if circ.failed:
+            record['FAIL_REASONS'] = circ.fail_reason
+            line += 'FAIL_REASONS=%s ' % circ.fail_reason
+        if circ.stream_failed:
+            record['STREAM_FAIL_REASONS'] = circ.stream_fail_reason
+            line += 'STREAM_FAIL_REASONS=%s ' % circ.stream_fail_reason
+        elif circ.used:
+            record['USED_AT'] = circ.stream_end_time
+            record['USED_BY'] = circ.strm_id
+            line += 'USED_AT=%s USED_BY=%d ' % \
+                (str(circ.stream_end_time), circ.strm_id)
+        if self.current_timeout:
+            record['TIMEOUT'] = self.current_timeout
+            record['QUANTILE'] = self.current_quantile
+            line += 'TIMEOUT=%d QUANTILE=%f ' % \
+                (self.current_timeout, self.current_quantile)
+        if self.on_circuit is not None:
+            self.on_circuit(record)
+        if self.on_line is not None:
+            self.on_line(line)
+        return record
+
+    def _join(self, port, record):
+        """ Copy a circuit record into the request whose stream used the
+            given local port, or just stop waiting for it without a
+            record. """
+        if port is None:
+            return
+        waiting = self._waiting.pop(port, None)
+        if waiting is not None:
+            request, deferred, timeout_call = waiting
+            timeout_call.cancel()
+        else:
+            request, deferred = self.requests.pop(port, None), None
+        if request is None:
+            return
+        if record is not None:
+            for key in JOINED_FIELDS:
+                if key in record:
+                    request[key] = record[key]
+        request.setdefault('CIRC_ID', None)
+        if deferred is not None:
+            deferred.callback(request)
+
+    def joined(self, request, port):
+        """ Deferred that fires with the record of a finished request once
+            it's joined to its circuit, or after join_timeout seconds. """
+        if port is None or 'CIRC_ID' in request:
+            return defer.succeed(request)
+        if self.requests.get(port) is request:
+            del self.requests[port]
+        previous = self._waiting.pop(port, None)
+        if previous is not None:
+            previous[2].cancel()
+            previous[1].callback(previous[0])
+        deferred = defer.Deferred()
+        timeout_call = self._clock.callLater(self.join_timeout,
+                                             self._join_timed_out, port)
+        self._waiting[port] = (request, deferred, timeout_call)
+        return deferred
+
+    def _join_timed_out(self, port):
+        request, deferred, timeout_call = self._waiting.pop(port)
+        deferred.callback(request)
+
+    def release(self):
+        """ Stop waiting for streams to close, because Tor went away, and
+            pass on the finished requests without a circuit. """
+        for port in self._waiting.keys():
+            self._join(port, None)
+
+
+class _Clock(object):
+    """ Reactor time that only moves when tests say so, for timestamps. """
+
+    def __init__(self, now):
+        self.now = now
+
+    def seconds(self):
+        return self.now
+
+    def callLater(self, delay, f, *args):
+        return reactor.callLater(delay, f, *args)
+
+
+FP = ['$' + c * 40 for c in 'ABCD']
+
+TRACE_EVENTS = [
+    (0.0, 'BUILDTIMEOUT_SET COMPUTED TOTAL_TIMES=1000 TIMEOUT_MS=1500 '
+          'XM=1000 ALPHA=1.5 CUTOFF_QUANTILE=0.800000'),
+    (0.0, 'CIRC 7 LAUNCHED PURPOSE=GENERAL'),
+    (0.5, 'CIRC 7 EXTENDED %s~a PURPOSE=GENERAL' % FP[0]),
+    (0.5, 'CIRC 7 BUILT %s~a,%s~b,%s=c PURPOSE=GENERAL' % tuple(FP[:3])),
+    (0.0, 'CIRC 8 LAUNCHED PURPOSE=GENERAL'),
+    (1.0, 'CIRC 8 FAILED %s~a REASON=TIMEOUT REMOTE_REASON=NONE' % FP[0]),
+    (0.0, 'STREAM 21 NEW 0 127.0.0.1:80 SOURCE_ADDR=127.0.0.1:50001 '
+          'PURPOSE=DIR_FETCH'),
+    (0.0, 'STREAM 21 CLOSED 7 127.0.0.1:80 REASON=DONE'),
+    (0.0, 'STREAM 22 NEW 0 127.0.0.1:80 SOURCE_ADDR=127.0.0.1:50002 '
+          'PURPOSE=USER'),
+    (0.0, 'STREAM 22 SENTCONNECT 7 127.0.0.1:80'),
+    (2.0, 'STREAM 22 CLOSED 7 127.0.0.1:80 REASON=DONE'),
+    (0.0, 'CIRC 9 LAUNCHED PURPOSE=GENERAL'),
+    (0.0, 'CIRC 9 BUILT %s~d PURPOSE=GENERAL' % FP[3]),
+    (0.0, 'STREAM 23 NEW 0 127.0.0.1:80 SOURCE_ADDR=127.0.0.1:50003 '
+          'PURPOSE=USER'),
+    (0.0, 'STREAM 23 FAILED 9 127.0.0.1:80 REASON=END '
+          'REMOTE_REASON=TIMEOUT'),
+]
+
+
+class TestCircuitTracker(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = _Clock(1362528000.0)
+        self.records = []
+        self.lines = []
+        self.requests = {}
+        self.tracker = CircuitTracker('test', self.clock, self.requests,
+                                      join_timeout=0.1)
+        self.tracker.on_circuit = self.records.append
+        self.tracker.on_line = self.lines.append
+
+    def _replay(self, trace):
+        names = {'CIRC': self.tracker.circ_status_event,
+                 'STREAM': self.tracker.stream_status_event,
+                 'BUILDTIMEOUT_SET': self.tracker.buildtimeout_set_event}
+        for delay, event in trace:
+            self.clock.now += delay
+            name, text = event.split(' ', 1)
+            names[name](text)
+
+    def test_extradata_lines(self):
+        self._replay(TRACE_EVENTS)
+        self.assertEqual(self.lines, [
+            'BUILDTIMEOUT_SET COMPUTED TOTAL_TIMES=1000 TIMEOUT_MS=1500 '
+            'XM=1000 ALPHA=1.5 CUTOFF_QUANTILE=0.800000',
+            'CIRC_ID=8 LAUNCH=1362528001.0 PATH=%s BUILDTIMES= '
+            'FAIL_REASONS=TIMEOUT:NONE TIMEOUT=1500 QUANTILE=0.800000 '
+            % FP[0],
+            'CIRC_ID=7 LAUNCH=1362528000.0 PATH=%s,%s,%s BUILDTIMES=0.5 '
+            'USED_AT=1362528004.0 USED_BY=22 TIMEOUT=1500 '
+            'QUANTILE=0.800000 ' % tuple(FP[:3]),
+            'CIRC_ID=9 LAUNCH=1362528004.0 PATH=%s BUILDTIMES= '
+            'STREAM_FAIL_REASONS=END:TIMEOUT TIMEOUT=1500 '
+            'QUANTILE=0.800000 ' % FP[3]])
+        self.assertEqual(self.records[1]['USED_BY'], 22)
+        self.assertEqual(self.records[1]['SOURCE'], 'test')
+        self.assertEqual(len(self.tracker.all_circs), 0)
+        self.assertEqual(len(self.tracker.ignore_streams), 1)
+        self.assertTrue(23 in self.tracker.ignore_streams)
+        self.assertEqual(len(self.tracker.stream_ports), 0)
+
+    def test_join_before_finish(self):
+        request = {'SOURCE': 'test'}
+        self.requests[50002] = request
+        self._replay(TRACE_EVENTS)
+        self.assertEqual(request['CIRC_ID'], 7)
+        self.assertEqual(request['USED_BY'], 22)
+        self.assertEqual(request['PATH'], ','.join(FP[:3]))
+        self.assertEqual(self.requests, {})
+        self.assertTrue(self.tracker.joined(request, 50002).called)
+
+    def test_join_after_finish(self):
+        request = {'SOURCE': 'test'}
+        self.requests[50003] = request
+        deferred = self.tracker.joined(request, 50003)
+        self.assertFalse(deferred.called)
+        self._replay(TRACE_EVENTS)
+        self.assertTrue(deferred.called)
+        self.assertEqual(request['CIRC_ID'], 9)
+        self.assertEqual(request['STREAM_FAIL_REASONS'], 'END:TIMEOUT')
+        self.assertEqual(self.tracker._waiting, {})
+
+    def test_join_timeout(self):
+        request = {'SOURCE': 'test'}
+        deferred = self.tracker.joined(request, 50004)
+        def check(joined):
+            self.assertEqual(joined, {'SOURCE': 'test'})
+            self.assertEqual(self.tracker._waiting, {})
+        deferred.addCallback(check)
+        return deferred
+
+    def test_release(self):
+        request = {'SOURCE': 'test'}
+        deferred = self.tracker.joined(request, 50004)
+        self.tracker.release()
+        self.assertEqual(self.successResultOf(deferred),
+                         {'SOURCE': 'test', 'CIRC_ID': None})
+        self.assertEqual(self.tracker._waiting, {})
+
+    def test_stream_without_circuit(self):
+        request = {'SOURCE': 'test'}
+        deferred = self.tracker.joined(request, 50005)
+        self._replay([
+            (0.0, 'STREAM 30 NEW 0 127.0.0.1:80 SOURCE_ADDR=127.0.0.1:50005 '
+                  'PURPOSE=USER'),
+            (0.0, 'STREAM 30 FAILED 0 127.0.0.1:80 REASON=TIMEOUT')])
+        self.assertTrue(deferred.called)
+        self.assertEqual(request['CIRC_ID'], None)
+        self.assertEqual(self.records, [])
+
+    def test_soak(self):
+        # Three days of 200 circuits per hour.  Every 20th circuit is never
+        # closed, and its stream fails without a CLOSED event.
+        for circ_id in xrange(1, 3 * 24 * 200 + 1):
+            strm_id = circ_id
+            self._replay([
+                (18.0, 'CIRC %d LAUNCHED PURPOSE=GENERAL' % circ_id),
+                (0.0, 'CIRC %d BUILT %s~a PURPOSE=GENERAL' %
+                      (circ_id, FP[0])),
+                (0.0, 'STREAM %d NEW 0 127.0.0.1:80 '
+                      'SOURCE_ADDR=127.0.0.1:%d PURPOSE=USER' %
+                      (strm_id, 1024 + circ_id % 60000))])
+            if circ_id % 20:
+                self._replay([
+                    (0.0, 'STREAM %d CLOSED %d 127.0.0.1:80 REASON=DONE' %
+                          (strm_id, circ_id)),
+                    (0.0, 'CIRC %d CLOSED REASON=FINISHED' % circ_id)])
+            else:
+                self._replay([
+                    (0.0, 'STREAM %d FAILED 0 127.0.0.1:80 REASON=TIMEOUT' %
+                          strm_id)])
+        self.assertEqual(len(self.tracker.all_circs), 24 * 10)
+        self.assertEqual(self.tracker.all_circs.evicted, 2 * 24 * 10)
+        self.assertEqual(len(self.tracker.stream_ports), 0)
+        self.assertEqual(len(self.records), 3 * 24 * 190)
+
+class TestReplay(unittest.TestCase):
+
+    def test_replay_via_txtorcon(self):
+        factory = ReplayControlPortFactory(trace_events(TRACE_EVENTS),
+                                           speed=0)
+        port = reactor.listenTCP(0, factory, interface='127.0.0.1')
+        self.addCleanup(port.stopListening)
+        tracker = CircuitTracker('test')
+        done = defer.Deferred()
+        lines = []
+        def on_line(line):
+            lines.append(line)
+            if len(lines) == 4:
+                done.callback(None)
+        tracker.on_line = on_line
+        def connected(proto):
+            self.addCleanup(proto.transport.loseConnection)
+            tracker.listen(proto)
+            return done
+        def check(ignored):
+            self.assertTrue(lines[0].startswith('BUILDTIMEOUT_SET COMPUTED'))
+            self.assertTrue(lines[2].startswith('CIRC_ID=7 '))
+            self.assertTrue('USED_BY=22 ' in lines[2])
+            self.assertEqual(tracker.current_timeout, 1500)
+        d = txtorcon.build_tor_connection(
+                endpoints.TCP4ClientEndpoint(reactor, '127.0.0.1',
+                                             port.getHost().port),
+                build_state=False)
+        d.addCallback(connected)
+        d.addCallback(check)
+        return d
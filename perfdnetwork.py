@@ -0,0 +1,503 @@
+"""
+A local stand-in for the Tor network, for end-to-end tests of perfd:
+
+- EmulatedTorFactory is a SOCKS server that, like a Tor client's SOCKS
+  port, connects to the requested host and port, e.g. perfd's own web
+  server, but shapes every stream the way a circuit through the Tor network
+  would: every round trip takes latency plus up to jitter seconds, data
+  flows at no more than bandwidth bytes per second in either direction, a
+  failure_rate fraction of streams is refused by the "exit", and a
+  stall_rate fraction stops relaying after stall_after bytes until the
+  client gives up.
+
+- Every stream gets a circuit of its own, which takes one round trip per
+  hop to build.  Both are reported with CIRC and STREAM events, including
+  the client's SOURCE_ADDR, on a perfdreplay.py control port, so that
+  perfd's CircuitTracker joins them to requests as it would with Tor.
+
+- listen() opens the SOCKS port and the control port of one emulated Tor
+  process; outcomes counts how its streams ended.  perfd.py's tests run
+  the whole TorPerfdService against a few dozen of them, with perfd
+  connecting to their control ports instead of launching Tor.
+
+- Run with "-f <torrc>", it stands in for a Tor binary that perfdtor.py
+  launches: it listens on the torrc's SocksPort and ControlPort and logs
+  "Bootstrapped N%" lines to stdout, over BOOTSTRAP_SECONDS the first time
+  and at once when its DataDirectory already has a cached consensus.
+
+Usage:
+  python perfdnetwork.py <socks port> <control port> [latency] [bandwidth]
+      [failure rate] [stall rate]
+  python perfdnetwork.py -f <torrc>
+"""
+
+import os
+import sys
+import random
+import itertools
+import collections
+
+from twisted.internet import defer, protocol, reactor
+from twisted.internet.error import ConnectionRefusedError
+from twisted.python import failure, log
+from twisted.trial import unittest
+
+from perfdreplay import ReplayControlPortFactory
+from perfdsocks import SOCKSClientEndpoint, SOCKSError, SOCKSServerFactory
+from perfdsocks import SOCKSServerProtocol
+
+# Bytes written at a time to a stream with a bandwidth cap.
+CHUNK_SIZE = 4096
+
+# Bytes waiting in a shaped stream before we stop reading from its source.
+QUEUE_LIMIT = 65536
+
+# Relays that emulated circuits are built through.
+RELAYS = 50
+
+# Seconds that an emulated Tor binary takes to bootstrap without a cached
+# consensus.
+BOOTSTRAP_SECONDS = 0.5
+
+
+class _Shaper(object):
+    """ Writes data to a transport in chunks of CHUNK_SIZE bytes and no
+        faster than rate bytes per second, or all at once without a rate.
+        The transport that the data comes from is paused while more than
+        QUEUE_LIMIT bytes are waiting.  After limit bytes, everything else
+        is held back, and the source stays paused.  close() closes the
+        transport once all data is written. """
+
+    def __init__(self, clock, transport, source, rate=None, limit=None):
+        self._clock = clock
+        self._transport = transport
+        self._source = source
+        self._rate = rate
+        self._limit = limit
+        self._queue = collections.deque()
+        self._queued = 0
+        self._paused = False
+        self._closing = False
+        self._call = None
+        self.written = 0
+
+    def write(self, data):
+        self._queue.append(data)
+        self._queued += len(data)
+        if self._queued > QUEUE_LIMIT:
+            self._pause()
+        if self._call is None:
+            self._send()
+
+    def close(self):
+        self._closing = True
+        if self._call is None:
+            self._send()
+
+    def stop(self):
+        if self._call is not None:
+            self._call.cancel()
+            self._call = None
+
+    def _pause(self):
+        if not self._paused:
+            self._paused = True
+            self._source.pauseProducing()
+
+    def _send(self):
+        self._call = None
+        while self._queue:
+            chunk = self._queue.popleft()
+            size = self._rate and CHUNK_SIZE or len(chunk)
+            if self._limit is not None:
+                size = min(size, self._limit - self.written)
+                if size <= 0:
+                    # Stalled for good.
+                    self._queue.appendleft(chunk)
+                    self._pause()
+                    return
+            if len(chunk) > size:
+                self._queue.appendleft(chunk[size:])
+                chunk = chunk[:size]
+            self._queued -= len(chunk)
+            self.written += len(chunk)
+            self._transport.write(chunk)
+            if self._rate:
+                self._call = self._clock.callLater(
+                        len(chunk) / float(self._rate), self._send)
+                break
+        if self._paused and self._queued <= QUEUE_LIMIT / 2:
+            self._paused = False
+            self._source.resumeProducing()
+        if self._closing and not self._queue and self._call is None:
+            self._transport.loseConnection()
+
+
+class EmulatedTorProtocol(SOCKSServerProtocol):
+    """ One SOCKS connection to an emulated Tor process, which builds a
+        circuit, attaches the stream to it, and relays the stream through
+        shapers, reporting each step on the factory's control port. """
+
+    def connectionMade(self):
+        SOCKSServerProtocol.connectionMade(self)
+        self._calls = []
+        self._lost = False
+        self._strm_id = None
+        self._circ_id = 0
+        self._path = ''
+        self._stream_open = False
+        self._stalled = False
+        self._to_target = None
+        self._to_client = None
+        # What the target sent before we replied to the client.
+        self._held = []
+        self._target_closed = False
+
+    def _after(self, delay, f, *args):
+        self._calls = [call for call in self._calls if call.active()]
+        self._calls.append(self.factory.clock.callLater(delay, f, *args))
+
+    def _stream_event(self, status, circ_id, extra=''):
+        self.factory.control.send_event('STREAM', ('%d %s %d %s %s' % (
+            self._strm_id, status, circ_id, self._target, extra)).rstrip())
+
+    def _circ_event(self, status, extra=''):
+        self.factory.control.send_event('CIRC', ('%d %s %s %s' % (
+            self._circ_id, status, self._path, extra)).rstrip())
+
+    def _connect(self, host, port, version):
+        factory = self.factory
+        self._strm_id = next(factory.stream_ids)
+        self._target = '%s:%d' % (host, port)
+        self._stream_open = True
+        peer = self.transport.getPeer()
+        self._stream_event('NEW', 0, 'SOURCE_ADDR=%s:%d PURPOSE=USER' %
+                           (peer.host, peer.port))
+        self._circ_id = next(factory.circ_ids)
+        self._circ_event('LAUNCHED', 'PURPOSE=GENERAL')
+        self._after(factory.round_trip(), self._extended, factory.path(), 1,
+                    host, port, version)
+
+    def _extended(self, path, hops, host, port, version):
+        self._path = ','.join(path[:hops])
+        self._circ_event('EXTENDED', 'PURPOSE=GENERAL')
+        if hops < len(path):
+            self._after(self.factory.round_trip(), self._extended, path,
+                        hops + 1, host, port, version)
+            return
+        self._circ_event('BUILT', 'PURPOSE=GENERAL')
+        self._stream_event('SENTCONNECT', self._circ_id)
+        outcome = self.factory.outcome()
+        if outcome == 'refused':
+            self._after(self.factory.round_trip(), self._failed,
+                        failure.Failure(ConnectionRefusedError()), version)
+            return
+        self._stalled = outcome == 'stalled'
+        SOCKSServerProtocol._connect(self, host, port, version)
+
+    def _connected(self, peer, version):
+        if self._lost:
+            peer.transport.loseConnection()
+            return
+        # The exit's answer takes another round trip.
+        self._peer = peer
+        self._to_target = _Shaper(self.factory.clock, peer.transport,
+                                  self.transport, self.factory.bandwidth)
+        self._after(self.factory.round_trip(),
+                    SOCKSServerProtocol._connected, self, peer, version)
+
+    def _start_relaying(self, reply):
+        self._stream_event('SUCCEEDED', self._circ_id)
+        limit = self._stalled and self.factory.stall_after or None
+        self._to_client = _Shaper(self.factory.clock, self.transport,
+                                  self._peer.transport, self.factory.bandwidth,
+                                  limit)
+        SOCKSServerProtocol._start_relaying(self, reply)
+        for data in self._held:
+            self._to_client.write(data)
+        self._held = []
+        if self._target_closed:
+            self._to_client.close()
+
+    def _refuse(self, reply):
+        reason = 'REASON=END REMOTE_REASON=CONNECTREFUSED'
+        self._stream_event('FAILED', self._circ_id, reason)
+        self._stream_event('CLOSED', self._circ_id, reason)
+        self._stream_open = False
+        self._circ_event('CLOSED', 'PURPOSE=GENERAL REASON=FINISHED')
+        SOCKSServerProtocol._refuse(self, reply)
+
+    def relay_to_target(self, data):
+        self._to_target.write(data)
+
+    def relay_to_client(self, data):
+        if self._to_client is None:
+            self._held.append(data)
+        else:
+            self._to_client.write(data)
+
+    def target_closed(self):
+        self._target_closed = True
+        if self._to_client is not None:
+            self._to_client.close()
+        elif self._peer is None:
+            SOCKSServerProtocol.target_closed(self)
+
+    def connectionLost(self, reason):
+        self._lost = True
+        for call in self._calls:
+            if call.active():
+                call.cancel()
+        for shaper in (self._to_target, self._to_client):
+            if shaper is not None:
+                shaper.stop()
+        if self._stream_open:
+            # Streams that closed before their circuit was built were
+            # never attached to it.
+            attached = self._peer is not None
+            self._stream_event('CLOSED', attached and self._circ_id or 0,
+                               'REASON=DONE')
+            self._circ_event('CLOSED', 'PURPOSE=GENERAL REASON=FINISHED')
+        SOCKSServerProtocol.connectionLost(self, reason)
+
+
+class EmulatedTorFactory(SOCKSServerFactory):
+    """ SOCKS port of an emulated Tor process, whose CIRC and STREAM
+        events go to the ReplayControlPortFactory control.  Draws from its
+        own random generator, so that a seed makes round trip times, paths,
+        and outcomes repeatable.  outcomes counts streams that were
+        'relayed', 'refused', or 'stalled'. """
+    protocol = EmulatedTorProtocol
+
+    def __init__(self, latency=0.05, jitter=0, bandwidth=None,
+                 failure_rate=0, stall_rate=0, stall_after=1024, hops=3,
+                 seed=None, clock=reactor):
+        SOCKSServerFactory.__init__(self, 0, clock)
+        self.latency = latency
+        self.jitter = jitter
+        self.bandwidth = bandwidth
+        self.failure_rate = failure_rate
+        self.stall_rate = stall_rate
+        self.stall_after = stall_after
+        self.hops = hops
+        self.random = random.Random(seed)
+        self.relays = ['$%040X~emulated%d' % (self.random.getrandbits(160), i)
+                       for i in range(RELAYS)]
+        self.control = ReplayControlPortFactory(speed=0, settle=0,
+                                                clock=clock)
+        self.circ_ids = itertools.count(1)
+        self.stream_ids = itertools.count(1)
+        self.outcomes = collections.defaultdict(int)
+        self._ports = []
+
+    def round_trip(self):
+        return self.latency + self.random.uniform(0, self.jitter)
+
+    def path(self):
+        return self.random.sample(self.relays, self.hops)
+
+    def outcome(self):
+        draw = self.random.random()
+        if draw < self.failure_rate:
+            outcome = 'refused'
+        elif draw < self.failure_rate + self.stall_rate:
+            outcome = 'stalled'
+        else:
+            outcome = 'relayed'
+        self.outcomes[outcome] += 1
+        return outcome
+
+    def listen(self, socks_port=0, control_port=0, interface='127.0.0.1'):
+        """ Listen on the SOCKS port and the control port, and return their
+            port numbers. """
+        self._ports = [reactor.listenTCP(socks_port, self,
+                                         interface=interface),
+                       reactor.listenTCP(control_port, self.control,
+                                         interface=interface)]
+        return tuple([port.getHost().port for port in self._ports])
+
+    def stopListening(self):
+        return defer.gatherResults([port.stopListening()
+                                    for port in self._ports])
+
+
+def read_torrc(path):
+    """ Options of a torrc by name, the last value of each. """
+    options = {}
+    with open(path) as torrc:
+        for line in torrc:
+            line = line.split('#', 1)[0].strip()
+            if line:
+                name, _, value = line.partition(' ')
+                options[name] = value.strip()
+    return options
+
+
+def _bootstrapped(progress, summary):
+    print '[notice] Bootstrapped %d%%: %s' % (progress, summary)
+    sys.stdout.flush()
+
+
+def emulate_tor_binary(torrc):
+    """ Listen on the ports of a torrc, log bootstrap progress like Tor,
+        and leave a cached consensus in its DataDirectory. """
+    options = read_torrc(torrc)
+    cached = os.path.join(options.get('DataDirectory', '.'),
+                          'cached-consensus')
+    factory = EmulatedTorFactory()
+    try:
+        factory.listen(int(options['SocksPort']),
+                       int(options['ControlPort']))
+    except Exception, e:
+        sys.stderr.write('[err] Could not open ports: %s\n' % e)
+        sys.exit(1)
+    _bootstrapped(0, 'Starting')
+    seconds = BOOTSTRAP_SECONDS
+    if os.path.exists(cached):
+        seconds = 0
+    for progress in range(10, 101, 10):
+        summary = progress == 100 and 'Done' or 'Loading relay descriptors'
+        reactor.callLater(seconds * progress / 100, _bootstrapped,
+                          progress, summary)
+    def cache():
+        with open(cached, 'w') as consensus:
+            consensus.write('network-status-version 3\n')
+    reactor.callLater(seconds, cache)
+    reactor.run()
+
+
+def main(argv):
+    if len(argv) == 3 and argv[1] == '-f':
+        emulate_tor_binary(argv[2])
+        return
+    if len(argv) < 3 or len(argv) > 7:
+        print __doc__
+        sys.exit(1)
+    options = [float(arg) for arg in argv[3:]]
+    latency, bandwidth, failure_rate, stall_rate = \
+        (options + [0.05, None, 0, 0][len(options):])[:4]
+    log.startLogging(sys.stderr, setStdout=False)
+    factory = EmulatedTorFactory(latency, latency / 2, bandwidth,
+                                 failure_rate, stall_rate)
+    ports = factory.listen(int(argv[1]), int(argv[2]))
+    print 'SOCKS port %d, control port %d' % ports
+    sys.stdout.flush()
+    reactor.run()
+
+
+class _Payload(protocol.Protocol):
+    """ Sends the factory's payload and closes the connection. """
+
+    def connectionMade(self):
+        self.transport.write(self.factory.payload)
+        self.transport.loseConnection()
+
+
+class _Collect(protocol.Protocol):
+
+    def __init__(self):
+        self.received = ''
+        self.done = defer.Deferred()
+
+    def dataReceived(self, data):
+        self.received += data
+
+    def connectionLost(self, reason):
+        self.done.callback(self.received)
+
+
+class _Timestamps(dict):
+
+    def stamp(self, key):
+        self[key] = reactor.seconds()
+
+
+class _Events(object):
+    """ Collects the events that the emulated control port sends. """
+
+    def __init__(self):
+        self.subscribed = set(['CIRC', 'STREAM'])
+        self.events = []
+
+    def send_event(self, name, text, multiline=False):
+        self.events.append('%s %s' % (name, text))
+
+
+class TestEmulatedTor(unittest.TestCase):
+
+    def setUp(self):
+        factory = protocol.ServerFactory()
+        factory.protocol = _Payload
+        factory.payload = 'x' * 40000
+        self.target = reactor.listenTCP(0, factory, interface='127.0.0.1')
+        self.addCleanup(self.target.stopListening)
+
+    def _request(self, **options):
+        self.tor = EmulatedTorFactory(seed=1, **options)
+        self.events = _Events()
+        self.tor.control.connections.append(self.events)
+        socks_port, control_port = self.tor.listen()
+        self.addCleanup(self.tor.stopListening)
+        self.timestamps = _Timestamps()
+        self.timestamps.stamp('START')
+        endpoint = SOCKSClientEndpoint(reactor, '127.0.0.1', socks_port,
+                                       '127.0.0.1',
+                                       self.target.getHost().port,
+                                       self.timestamps)
+        self.collect = _Collect()
+        d = endpoint.connect(protocol.ClientFactory.forProtocol(
+                lambda: self.collect))
+        d.addCallback(lambda ignored: self.collect.done)
+        return d
+
+    def test_latency_and_bandwidth(self):
+        def check(received):
+            self.assertEqual(len(received), 40000)
+            elapsed = reactor.seconds() - self.timestamps['START']
+            # Three hops and the exit's answer, then 40 KB at 200 KB/s.
+            self.assertTrue(self.timestamps['RESPONSE'] -
+                            self.timestamps['START'] >= 4 * 0.05 - 0.01)
+            self.assertTrue(elapsed >= 4 * 0.05 + 0.2 - 0.02)
+            self.assertTrue(elapsed < 1.5)
+            self.assertEqual(dict(self.tor.outcomes), {'relayed': 1})
+            events = self.events.events
+            self.assertTrue(events[0].startswith('STREAM 1 NEW 0 127.0.0.1:'))
+            self.assertIn('SOURCE_ADDR=127.0.0.1:', events[0])
+            self.assertEqual([event.split()[2] for event in events[1:6]],
+                             ['LAUNCHED', 'EXTENDED', 'EXTENDED',
+                              'EXTENDED', 'BUILT'])
+            self.assertEqual(len(events[5].split()[3].split(',')), 3)
+            self.assertEqual([' '.join(event.split()[:4])
+                              for event in events[6:]],
+                             ['STREAM 1 SENTCONNECT 1',
+                              'STREAM 1 SUCCEEDED 1', 'STREAM 1 CLOSED 1',
+                              'CIRC 1 CLOSED ' + events[5].split()[3]])
+        d = self._request(latency=0.05, bandwidth=200000)
+        d.addCallback(check)
+        return d
+
+    def test_failure(self):
+        d = self._request(latency=0.01, failure_rate=1)
+        def check(failure):
+            self.assertEqual(dict(self.tor.outcomes), {'refused': 1})
+            self.assertEqual(self.events.events[-3:-1], [
+                'STREAM 1 %s 1 127.0.0.1:%d REASON=END '
+                'REMOTE_REASON=CONNECTREFUSED' % (status,
+                                                  self.target.getHost().port)
+                for status in ('FAILED', 'CLOSED')])
+        return self.assertFailure(d, SOCKSError).addCallback(check)
+
+    def test_stall(self):
+        d = self._request(latency=0.01, stall_rate=1, stall_after=1000)
+        # The stream stays open with the first 1000 bytes, until the
+        # client gives up.
+        def give_up():
+            self.assertEqual(dict(self.tor.outcomes), {'stalled': 1})
+            self.collect.transport.loseConnection()
+        reactor.callLater(0.5, give_up)
+        d.addCallback(lambda received: self.assertEqual(len(received), 1000))
+        return d
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,461 @@
+"""
+Recording and replaying Tor control port events:
+
+- EventRecorder connects to a Tor control port via txtorcon, saves the
+  answers to a few GETINFO keys, and appends every event of the given
+  types to a trace file with one JSON object per line, e.g.
+    {"getinfo": "version", "value": "0.2.4.10-alpha"}
+    {"time": 1362528000.25, "event": "CIRC", "text": "7 LAUNCHED"}
+  Multi-line events like NS have "multiline": true and their lines
+  separated by newlines in "text".
+
+- ReplayControlPortFactory is a control port server that answers
+  PROTOCOLINFO, AUTHENTICATE, GETINFO, GETCONF, and SETCONF well enough for
+  txtorcon and TorCtl, using the GETINFO answers of a trace, and replays
+  the trace's events at their recorded pace, N times faster, or as fast as
+  possible.  Like Tor, it only sends the events that the controller set
+  with SETEVENTS.  desc/id/* and ns/id/* are looked up in desc/all-recent
+  and ns/all.
+
+Usage:
+  python perfdreplay.py record <control port> <trace> [event,event,...]
+  python perfdreplay.py serve <port> <trace> [speed, 0 for no delays]
+"""
+
+import sys
+import json
+import base64
+import functools
+
+from twisted.internet import defer, endpoints, protocol, reactor
+from twisted.protocols import basic
+from twisted.python import log
+from twisted.test import proto_helpers
+from twisted.trial import unittest
+
+import txtorcon
+
+RECORDED_EVENTS = ['CIRC', 'STREAM', 'BUILDTIMEOUT_SET', 'NEWCONSENSUS',
+                   'NEWDESC', 'NS', 'GUARD']
+
+RECORDED_GETINFO = ['version', 'ns/all', 'desc/all-recent']
+
+# Events sent before giving the reactor a chance to do something else.
+REPLAY_BATCH = 1000
+
+_DEFAULT_GETINFO = {
+    'version': '0.2.4.10-alpha',
+    'signal/names': 'RELOAD SHUTDOWN DUMP DEBUG HALT HUP INT USR1 USR2 '
+                    'TERM NEWNYM CLEARDNSCACHE',
+    'events/names': 'CIRC STREAM ORCONN BW DEBUG INFO NOTICE WARN ERR '
+                    'NEWDESC ADDRMAP AUTHDIR_NEWDESCS DESCCHANGED '
+                    'STATUS_GENERAL STATUS_CLIENT STATUS_SERVER GUARD NS '
+                    'STREAM_BW CLIENTS_SEEN NEWCONSENSUS BUILDTIMEOUT_SET',
+}
+
+
+def read_trace(lines):
+    """ GETINFO answers by key and the list of events of a trace. """
+    getinfo, events = {}, []
+    for line in lines:
+        if not line.strip():
+            continue
+        record = dict([(str(key), isinstance(value, unicode) and
+                        value.encode('utf-8') or value)
+                       for key, value in json.loads(line).iteritems()])
+        if 'getinfo' in record:
+            getinfo[record['getinfo']] = record['value']
+        else:
+            events.append(record)
+    return getinfo, events
+
+
+def trace_events(pairs, start=0.0):
+    """ Events of a trace from (delay in seconds, 'NAME text') pairs. """
+    events, now = [], start
+    for delay, line in pairs:
+        now += delay
+        name, text = (line.split(' ', 1) + [''])[:2]
+        events.append({'time': now, 'event': name, 'text': text})
+    return events
+
+
+def _relay_id(entry):
+    """ Upper-case hex fingerprint of a descriptor or network status
+        entry, or None. """
+    for line in entry.split('\n'):
+        words = line.split()
+        if words[:1] == ['opt']:
+            words = words[1:]
+        if words[:1] == ['fingerprint']:
+            return ''.join(words[1:]).upper()
+        if words[:1] == ['r'] and len(words) > 2:
+            identity = words[2] + '=' * (-len(words[2]) % 4)
+            return base64.b64decode(identity).encode('hex').upper()
+    return None
+
+
+def _split_entries(document, first_keyword):
+    entries, current = [], []
+    for line in document.split('\n'):
+        if line.startswith(first_keyword + ' ') and current:
+            entries.append('\n'.join(current))
+            current = []
+        current.append(line)
+    if current:
+        entries.append('\n'.join(current))
+    return entries
+
+
+class ReplayControlPort(basic.LineOnlyReceiver):
+
+    delimiter = '\r\n'
+    MAX_LENGTH = 1 << 20
+
+    def connectionMade(self):
+        self.subscribed = set()
+        self.sent = 0
+        self._replaying = False
+        self._first = None
+        self._started = None
+        self.factory.connections.append(self)
+
+    def connectionLost(self, reason):
+        self.factory.connections.remove(self)
+
+    def lineReceived(self, line):
+        command, _, arguments = line.partition(' ')
+        command = command.upper()
+        if command == 'PROTOCOLINFO':
+            self._reply(['PROTOCOLINFO 1', 'AUTH METHODS=NULL',
+                         'VERSION Tor="%s"' % self.factory.getinfo('version')])
+        elif command == 'GETINFO':
+            self._getinfo(arguments.split())
+        elif command == 'GETCONF':
+            self._reply(['%s=%s' % (key, self.factory.conf[key])
+                         if key in self.factory.conf else key
+                         for key in arguments.split()])
+        elif command in ('SETCONF', 'RESETCONF'):
+            for setting in arguments.split():
+                key, _, value = setting.partition('=')
+                self.factory.conf[key] = value.strip('"')
+            self._reply([])
+        elif command == 'SETEVENTS':
+            self.subscribed = set(arguments.upper().split()) - \
+                set(['EXTENDED'])
+            self._reply([])
+            if self.subscribed and not self._replaying:
+                self._replaying = True
+                if self.factory.settle:
+                    self.factory.clock.callLater(self.factory.settle,
+                                                 self._start_replay)
+                else:
+                    self._start_replay()
+        else:
+            self._reply([])
+
+    def _reply(self, lines):
+        for line in lines:
+            self.sendLine('250-' + line)
+        self.sendLine('250 OK')
+
+    def _getinfo(self, keys):
+        out = []
+        for key in keys:
+            value = self.factory.getinfo(key)
+            if value is None:
+                self.sendLine('552 Unrecognized key "%s"' % key)
+                return
+            if '\n' in value:
+                out.append('250+%s=' % key)
+                out.extend(self._escaped(value))
+                out.append('.')
+            else:
+                out.append('250-%s=%s' % (key, value))
+        out.append('250 OK')
+        self.transport.write('\r\n'.join(out) + '\r\n')
+
+    def _escaped(self, text):
+        return [line.startswith('.') and '.' + line or line
+                for line in text.split('\n')]
+
+    def send_event(self, name, text, multiline=False):
+        if multiline:
+            self.transport.write('\r\n'.join(
+                ['650+' + name] + self._escaped(text) + ['.', '650 OK', '']))
+        else:
+            self.sendLine(('650 %s %s' % (name, text)).rstrip())
+
+    def _start_replay(self):
+        self._started = self.factory.clock.seconds()
+        self._replay(0)
+
+    def _replay(self, index):
+        events = self.factory.events
+        speed = self.factory.speed
+        clock = self.factory.clock
+        batch = 0
+        while index < len(events):
+            event = events[index]
+            if speed:
+                if self._first is None:
+                    self._first = event['time']
+                due = self._started + (event['time'] - self._first) / speed
+                if due > clock.seconds():
+                    clock.callLater(due - clock.seconds(), self._replay, index)
+                    return
+            if batch >= REPLAY_BATCH:
+                clock.callLater(0, self._replay, index)
+                return
+            if event['event'] in self.subscribed:
+                self.send_event(event['event'], event['text'],
+                                event.get('multiline', False))
+                self.sent += 1
+            index += 1
+            batch += 1
+        log.msg('Replayed %d events.' % self.sent)
+        if not self.factory.finished.called:
+            self.factory.finished.callback(self)
+
+
+class ReplayControlPortFactory(protocol.ServerFactory):
+    """ Replays events, a list of dicts like those in a trace file, to
+        every controller that connects, speed times faster than recorded,
+        or without delays if speed is 0.  Replaying starts settle seconds
+        after the first SETEVENTS, since txtorcon sends one per event type.
+        finished fires with the first connection that got all events. """
+    protocol = ReplayControlPort
+
+    def __init__(self, events=(), getinfo=None, speed=1.0, settle=0.1,
+                 clock=reactor):
+        self.events = list(events)
+        self.speed = speed
+        self.settle = settle
+        self.clock = clock
+        self.conf = {}
+        self.connections = []
+        self.finished = defer.Deferred()
+        self._getinfo = dict(_DEFAULT_GETINFO)
+        self._getinfo.update(getinfo or {})
+        self._by_id = {}
+
+    def getinfo(self, key):
+        if key in self._getinfo:
+            return self._getinfo[key]
+        for prefix, document, keyword in (('desc/id/', 'desc/all-recent',
+                                           'router'),
+                                          ('ns/id/', 'ns/all', 'r')):
+            if key.startswith(prefix) and document in self._getinfo:
+                if document not in self._by_id:
+                    entries = _split_entries(self._getinfo[document], keyword)
+                    self._by_id[document] = dict([(_relay_id(entry), entry)
+                                                  for entry in entries])
+                return self._by_id[document].get(
+                        key[len(prefix):].lstrip('$').upper())
+        return None
+
+    def send_event(self, name, text, multiline=False):
+        """ Send an event to every controller that set it with SETEVENTS,
+            for stand-ins like perfdnetwork.py that make events up. """
+        for connection in self.connections:
+            if name in connection.subscribed:
+                connection.send_event(name, text, multiline)
+
+
+class EventRecorder(object):
+    """ Writes the answers to GETINFO keys and then every event of the given
+        types, with the time it arrived, to output as a trace. """
+
+    def __init__(self, output, events=RECORDED_EVENTS,
+                 getinfo=RECORDED_GETINFO, clock=reactor):
+        self.output = output
+        self.events = events
+        self.getinfo_keys = getinfo
+        self._clock = clock
+        self.recorded = 0
+
+    def _write(self, record):
+        self.output.write(json.dumps(record) + '\n')
+        self.output.flush()
+
+    @defer.inlineCallbacks
+    def record(self, protocol):
+        for key in self.getinfo_keys:
+            try:
+                answer = yield protocol.get_info_raw(key)
+            except Exception, e:
+                log.msg('Not recording GETINFO %s: %s' % (key, e))
+                continue
+            value = answer.split('=', 1)[1]
+            if value.startswith('\n'):
+                value = value[1:]
+            self._write({'getinfo': key, 'value': value})
+        for name in self.events:
+            try:
+                protocol.add_event_listener(
+                        name, functools.partial(self._event, name))
+            except RuntimeError:
+                log.msg('Tor does not support %s events.' % name)
+
+    def _event(self, name, text):
+        record = {'time': self._clock.seconds(), 'event': name}
+        if '\n' in text:
+            # txtorcon passes multi-line events with their final OK.
+            if text.endswith('\nOK'):
+                text = text[:-len('\nOK')]
+            record['multiline'] = True
+        record['text'] = text
+        self._write(record)
+        self.recorded += 1
+
+
+def _connect(port):
+    return txtorcon.build_tor_connection(
+            endpoints.TCP4ClientEndpoint(reactor, '127.0.0.1', port),
+            build_state=False)
+
+
+def main(argv):
+    log.startLogging(sys.stderr, setStdout=False)
+    if argv[1:2] == ['record'] and len(argv) in (4, 5):
+        events = len(argv) == 5 and argv[4].split(',') or RECORDED_EVENTS
+        recorder = EventRecorder(open(argv[3], 'a'), events)
+        d = _connect(int(argv[2]))
+        d.addCallback(recorder.record)
+        d.addErrback(lambda failure: (log.err(failure), reactor.stop()))
+    elif argv[1:2] == ['serve'] and len(argv) in (4, 5):
+        with open(argv[3]) as trace:
+            getinfo, events = read_trace(trace)
+        speed = len(argv) == 5 and float(argv[4]) or 0.0
+        factory = ReplayControlPortFactory(events, getinfo, speed)
+        port = reactor.listenTCP(int(argv[2]), factory, interface='127.0.0.1')
+        # Benchmarks read the port from the first line of output.
+        print 'Listening on port %d' % port.getHost().port
+        sys.stdout.flush()
+    else:
+        print __doc__
+        sys.exit(1)
+    reactor.run()
+
+
+DESCRIPTORS = '\n'.join([
+    'router a 10.0.0.1 9001 0 0',
+    'opt fingerprint AAAA AAAA AAAA AAAA AAAA AAAA AAAA AAAA AAAA AAAA',
+    'bandwidth 100 200 150',
+    'router b 10.0.0.2 9001 0 0',
+    'fingerprint BBBB BBBB BBBB BBBB BBBB BBBB BBBB BBBB BBBB BBBB',
+    'bandwidth 300 400 350'])
+
+NETWORK_STATUS = '\n'.join([
+    'r a qqqqqqqqqqqqqqqqqqqqqqqqqqo %s 2013-03-06 00:00:00 10.0.0.1 9001 0'
+    % ('A' * 27),
+    's Fast Guard Running Valid',
+    'r b u7u7u7u7u7u7u7u7u7u7u7u7u7s %s 2013-03-06 00:00:00 10.0.0.2 9001 0'
+    % ('B' * 27),
+    's Fast Running Valid'])
+
+TRACE = trace_events([
+    (0.0, 'CIRC 7 LAUNCHED PURPOSE=GENERAL'),
+    (0.5, 'GUARD ENTRY $%s DOWN' % ('A' * 40)),
+    (0.5, 'CIRC 7 BUILT $%s~a PURPOSE=GENERAL' % ('A' * 40)),
+], start=1362528000.0) + [
+    {'time': 1362528001.5, 'event': 'NS', 'multiline': True,
+     'text': NETWORK_STATUS.split('\n', 2)[2]},
+    {'time': 1362528002.0, 'event': 'CIRC', 'text': '7 CLOSED REASON=DONE'},
+]
+
+
+class TestReplayControlPort(unittest.TestCase):
+
+    def _protocol(self, speed=0):
+        factory = ReplayControlPortFactory(
+                TRACE, {'ns/all': NETWORK_STATUS,
+                        'desc/all-recent': DESCRIPTORS}, speed, settle=0)
+        proto = factory.buildProtocol(None)
+        transport = proto_helpers.StringTransport()
+        proto.makeConnection(transport)
+        return proto, transport
+
+    def test_getinfo_and_conf(self):
+        proto, transport = self._protocol()
+        proto.dataReceived('GETINFO version desc/id/%s\r\n' % ('B' * 40))
+        self.assertEqual(transport.value(), '\r\n'.join([
+            '250-version=0.2.4.10-alpha',
+            '250+desc/id/%s=' % ('B' * 40),
+            'router b 10.0.0.2 9001 0 0',
+            'fingerprint BBBB BBBB BBBB BBBB BBBB BBBB BBBB BBBB BBBB BBBB',
+            'bandwidth 300 400 350', '.', '250 OK', '']))
+        transport.clear()
+        proto.dataReceived('GETINFO ns/id/%s\r\n' % ('A' * 40))
+        self.assertTrue(transport.value().startswith(
+                '250+ns/id/%s=\r\nr a ' % ('A' * 40)))
+        transport.clear()
+        proto.dataReceived('GETINFO ns/id/%s\r\n' % ('C' * 40))
+        self.assertTrue(transport.value().startswith('552 '))
+        transport.clear()
+        proto.dataReceived('SETCONF EntryNodes="$AB,$CD" '
+                           'StrictEntryNodes=1\r\n'
+                           'GETCONF EntryNodes UseEntryNodes\r\n')
+        self.assertEqual(transport.value(), '250 OK\r\n'
+                         '250-EntryNodes=$AB,$CD\r\n250-UseEntryNodes\r\n'
+                         '250 OK\r\n')
+
+    def test_replays_subscribed_events(self):
+        proto, transport = self._protocol()
+        proto.dataReceived('SETEVENTS EXTENDED CIRC NS\r\n')
+        self.assertEqual(transport.value(), '\r\n'.join([
+            '250 OK',
+            '650 CIRC 7 LAUNCHED PURPOSE=GENERAL',
+            '650 CIRC 7 BUILT $%s~a PURPOSE=GENERAL' % ('A' * 40),
+            '650+NS'] + NETWORK_STATUS.split('\n')[2:] + [
+            '.', '650 OK',
+            '650 CIRC 7 CLOSED REASON=DONE', '']))
+        self.assertEqual(proto.sent, 4)
+        self.assertTrue(proto.factory.finished.called)
+
+    def test_speed(self):
+        proto, transport = self._protocol(speed=100)
+        start = reactor.seconds()
+        proto.dataReceived('SETEVENTS CIRC\r\n')
+        self.assertEqual(proto.sent, 1)
+        def check(ignored):
+            # Two seconds of events at 100 times the speed.
+            self.assertEqual(proto.sent, 3)
+            self.assertTrue(reactor.seconds() - start >= 0.019)
+        return proto.factory.finished.addCallback(check)
+
+    def test_record_replayed_trace(self):
+        factory = ReplayControlPortFactory(TRACE, {'ns/all': NETWORK_STATUS},
+                                           speed=0)
+        port = reactor.listenTCP(0, factory, interface='127.0.0.1')
+        self.addCleanup(port.stopListening)
+        output = open(self.mktemp(), 'w+')
+        recorder = EventRecorder(output, ['CIRC', 'NS', 'GUARD'],
+                                 ['version', 'ns/all', 'desc/all-recent'])
+        def connected(proto):
+            self.addCleanup(proto.transport.loseConnection)
+            recorder.record(proto)
+            return factory.finished
+        def wait(ignored):
+            # Let the last events arrive.
+            d = defer.Deferred()
+            reactor.callLater(0.1, d.callback, None)
+            return d
+        def check(ignored):
+            output.seek(0)
+            getinfo, events = read_trace(output)
+            self.assertEqual(getinfo, {'version': '0.2.4.10-alpha',
+                                       'ns/all': NETWORK_STATUS})
+            self.assertEqual([(e['event'], e['text'], 'multiline' in e)
+                              for e in events],
+                             [(e['event'], e['text'], 'multiline' in e)
+                              for e in TRACE])
+        d = _connect(port.getHost().port)
+        d.addCallback(connected)
+        d.addCallback(wait)
+        d.addCallback(check)
+        return d
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,465 @@
+"""
+Non-blocking SOCKS 4a and SOCKS 5 client for perfd:
+
+- Records the same connection stages as trivsocks-client: SOCKET when
+  the connection attempt starts, CONNECT when the connection to the SOCKS
+  server is established, NEGOTIATE when the SOCKS 5 authentication method
+  is negotiated (right after CONNECT for SOCKS 4a), REQUEST when the SOCKS
+  request is sent, and RESPONSE when the SOCKS response is received.
+
+- Hands the connection to the wrapped protocol once the SOCKS server has
+  connected us to the target.
+
+Also contains a minimal SOCKS server that is used as local stand-in for
+Tor in tests.
+"""
+
+import socket
+import struct
+
+from twisted.internet import defer, interfaces, protocol, reactor, task
+from twisted.trial import unittest
+
+from zope.interface import implements
+
+
+class SOCKSError(Exception):
+    """ The SOCKS server refused our request or sent a malformed reply. """
+
+
+class SOCKSClientProtocol(protocol.Protocol):
+
+    def connectionMade(self):
+        self._buffer = ''
+        self._wrapped = None
+        self.factory.stamp('CONNECT')
+        self.factory.connected(self.transport.getHost())
+        if self.factory.version == 5:
+            self._state = 'methods'
+            self.transport.write('\x05\x01\x00')
+        else:
+            self.factory.stamp('NEGOTIATE')
+            self._send_request()
+
+    def _send_request(self):
+        host, port = self.factory.host, self.factory.port
+        if self.factory.version == 5:
+            try:
+                address = '\x01' + socket.inet_pton(socket.AF_INET, host)
+            except socket.error:
+                address = '\x03' + chr(len(host)) + host
+            request = '\x05\x01\x00' + address + struct.pack('!H', port)
+            self._state = 'response5'
+        else:
+            # SOCKS 4a: address 0.0.0.1, empty user ID, and hostname.
+            request = struct.pack('!BBHI', 4, 1, port, 1) + '\x00' + \
+                      host + '\x00'
+            self._state = 'response4'
+        self.transport.write(request)
+        self.factory.stamp('REQUEST')
+
+    def dataReceived(self, data):
+        if self._wrapped is not None:
+            self._wrapped.dataReceived(data)
+            return
+        self._buffer += data
+        if self._state == 'methods':
+            if len(self._buffer) < 2:
+                return
+            reply, self._buffer = self._buffer[:2], self._buffer[2:]
+            if reply != '\x05\x00':
+                self._fail('SOCKS 5 server refused authentication method.')
+                return
+            self.factory.stamp('NEGOTIATE')
+            self._send_request()
+        if self._state == 'response4':
+            if len(self._buffer) < 8:
+                return
+            if self._buffer[0] != '\x00' or self._buffer[1] != '\x5a':
+                self._fail('SOCKS 4a request failed with status %d.' %
+                           ord(self._buffer[1]))
+                return
+            self._connected(self._buffer[8:])
+        elif self._state == 'response5':
+            if len(self._buffer) < 5:
+                return
+            version, status, reserved, address_type = \
+                struct.unpack('!BBBB', self._buffer[:4])
+            if version != 5:
+                self._fail('Bad SOCKS 5 reply version %d.' % version)
+                return
+            if status != 0:
+                self._fail('SOCKS 5 request failed with status %d.' % status)
+                return
+            if address_type == 1:
+                length = 4 + 4 + 2
+            elif address_type == 3:
+                length = 4 + 1 + ord(self._buffer[4]) + 2
+            elif address_type == 4:
+                length = 4 + 16 + 2
+            else:
+                self._fail('Bad SOCKS 5 address type %d.' % address_type)
+                return
+            if len(self._buffer) < length:
+                return
+            self._connected(self._buffer[length:])
+
+    def _connected(self, rest):
+        self.factory.stamp('RESPONSE')
+        self._state = 'connected'
+        self._buffer = ''
+        self._wrapped = self.factory.wrapped_factory.buildProtocol(
+                self.transport.getPeer())
+        self._wrapped.makeConnection(self.transport)
+        self.factory.succeed(self._wrapped)
+        if rest:
+            self._wrapped.dataReceived(rest)
+
+    def _fail(self, message):
+        self._state = 'failed'
+        self.factory.fail(SOCKSError(message))
+        self.transport.loseConnection()
+
+    def connectionLost(self, reason):
+        if self._wrapped is not None:
+            self._wrapped.connectionLost(reason)
+        else:
+            self.factory.fail(reason)
+
+
+class SOCKSClientFactory(protocol.ClientFactory):
+    protocol = SOCKSClientProtocol
+
+    def __init__(self, host, port, wrapped_factory, timestamps, version):
+        self.host = host
+        self.port = port
+        self.wrapped_factory = wrapped_factory
+        self.timestamps = timestamps
+        self.version = version
+        self.connector = None
+        self.deferred = defer.Deferred(self._cancel)
+
+    def _cancel(self, deferred):
+        # Drops the connection to the SOCKS server, or stops connecting to
+        # it; the deferred then fails with CancelledError.
+        if self.connector is not None:
+            self.connector.disconnect()
+
+    def stamp(self, key):
+        self.timestamps.stamp(key)
+
+    def connected(self, address):
+        connected = getattr(self.timestamps, 'connected', None)
+        if connected is not None:
+            connected(address)
+
+    def startedConnecting(self, connector):
+        self.connector = connector
+        self.stamp('SOCKET')
+
+    def clientConnectionFailed(self, connector, reason):
+        self.fail(reason)
+
+    def succeed(self, wrapped):
+        if not self.deferred.called:
+            self.deferred.callback(wrapped)
+
+    def fail(self, reason):
+        if not self.deferred.called:
+            self.deferred.errback(reason)
+
+
+class SOCKSClientEndpoint(object):
+    """ Client endpoint that connects to host:port via the SOCKS server at
+        socks_host:socks_port.  timestamps needs a stamp(key) method, like
+        perfd's Measurement, which is called for each connection stage,
+        and may have a connected(address) method, which is called with the
+        local address of the connection to the SOCKS server.
+        The deferred returned by connect() fires with the wrapped protocol
+        after the SOCKS handshake, or fails with SOCKSError.  Cancelling it
+        before then closes the connection to the SOCKS server. """
+    implements(interfaces.IStreamClientEndpoint)
+
+    def __init__(self, reactor, socks_host, socks_port, host, port,
+                 timestamps, version=5, timeout=30):
+        if version not in (4, 5):
+            raise ValueError("SOCKS version must be 4 or 5.")
+        self._reactor = reactor
+        self._socks_host = socks_host
+        self._socks_port = socks_port
+        self._host = host
+        self._port = port
+        self._timestamps = timestamps
+        self._version = version
+        self._timeout = timeout
+
+    def connect(self, protocolFactory):
+        factory = SOCKSClientFactory(self._host, self._port, protocolFactory,
+                                     self._timestamps, self._version)
+        self._reactor.connectTCP(self._socks_host, self._socks_port, factory,
+                                 timeout=self._timeout)
+        return factory.deferred
+
+
+class _SOCKSRelay(protocol.Protocol):
+
+    def __init__(self, server):
+        self.server = server
+
+    def dataReceived(self, data):
+        self.server.relay_to_client(data)
+
+    def connectionLost(self, reason):
+        self.server.target_closed()
+
+
+class SOCKSServerProtocol(protocol.Protocol):
+    """ Minimal SOCKS 4a and SOCKS 5 server (no authentication, CONNECT
+        only) that connects to the requested target and relays data in both
+        directions.  Every reply to the client is sent after the factory's
+        delay, so that tests can check timestamps.  Relayed data passes
+        through relay_to_target() and relay_to_client(), and target_closed()
+        closes the client connection, so that subclasses can shape traffic
+        like a network would. """
+
+    def connectionMade(self):
+        self._buffer = ''
+        self._state = 'greeting'
+        self._peer = None
+
+    def dataReceived(self, data):
+        if self._state == 'relaying':
+            self.relay_to_target(data)
+            return
+        self._buffer += data
+        self._parse()
+
+    def _later(self, f, *args):
+        self.factory.clock.callLater(self.factory.delay, f, *args)
+
+    def _parse(self):
+        buf = self._buffer
+        if self._state == 'greeting' and buf[:1] == '\x05':
+            if len(buf) < 2 or len(buf) < 2 + ord(buf[1]):
+                return
+            self._buffer = buf[2 + ord(buf[1]):]
+            self._state = 'waiting'
+            self._later(self._reply_methods)
+        elif self._state == 'greeting' and buf[:1] == '\x04':
+            user_end = buf.find('\x00', 8)
+            if user_end < 0:
+                return
+            port, address = struct.unpack('!HI', buf[2:8])
+            if 0 < address < 256:
+                host_end = buf.find('\x00', user_end + 1)
+                if host_end < 0:
+                    return
+                host = buf[user_end + 1:host_end]
+            else:
+                host_end = user_end
+                host = socket.inet_ntoa(buf[4:8])
+            self._buffer = buf[host_end + 1:]
+            self._state = 'waiting'
+            self._connect(host, port, 4)
+        elif self._state == 'greeting' and buf:
+            self.transport.loseConnection()
+        elif self._state == 'request5' and len(buf) >= 5:
+            address_type = ord(buf[3])
+            if address_type == 1:
+                length = 4 + 4 + 2
+                host = socket.inet_ntoa(buf[4:8])
+            elif address_type == 3:
+                length = 4 + 1 + ord(buf[4]) + 2
+                host = buf[5:length - 2]
+            else:
+                self.transport.loseConnection()
+                return
+            if len(buf) < length:
+                return
+            port = struct.unpack('!H', buf[length - 2:length])[0]
+            self._buffer = buf[length:]
+            self._state = 'waiting'
+            self._connect(host, port, 5)
+
+    def _reply_methods(self):
+        self.transport.write('\x05\x00')
+        self._state = 'request5'
+        self._parse()
+
+    def _connect(self, host, port, version):
+        creator = protocol.ClientCreator(self.factory.clock, _SOCKSRelay, self)
+        d = creator.connectTCP(host, port)
+        d.addCallbacks(self._connected, self._failed,
+                       callbackArgs=(version, ), errbackArgs=(version, ))
+
+    def _connected(self, peer, version):
+        self._peer = peer
+        if version == 5:
+            reply = '\x05\x00\x00\x01' + '\x00' * 6
+        else:
+            reply = '\x00\x5a' + '\x00' * 6
+        self._later(self._start_relaying, reply)
+
+    def _start_relaying(self, reply):
+        self.transport.write(reply)
+        self._state = 'relaying'
+        if self._buffer:
+            self.relay_to_target(self._buffer)
+            self._buffer = ''
+
+    def relay_to_target(self, data):
+        self._peer.transport.write(data)
+
+    def relay_to_client(self, data):
+        self.transport.write(data)
+
+    def target_closed(self):
+        self.transport.loseConnection()
+
+    def _failed(self, failure, version):
+        if version == 5:
+            reply = '\x05\x05\x00\x01' + '\x00' * 6
+        else:
+            reply = '\x00\x5b' + '\x00' * 6
+        self._later(self._refuse, reply)
+
+    def _refuse(self, reply):
+        self.transport.write(reply)
+        self.transport.loseConnection()
+
+    def connectionLost(self, reason):
+        if self._peer is not None:
+            self._peer.transport.loseConnection()
+
+
+class SOCKSServerFactory(protocol.ServerFactory):
+    protocol = SOCKSServerProtocol
+
+    def __init__(self, delay=0, clock=reactor):
+        self.delay = delay
+        self.clock = clock
+
+
+class _Timestamps(dict):
+
+    def stamp(self, key):
+        self[key] = reactor.seconds()
+
+
+class _Echo(protocol.Protocol):
+
+    def connectionMade(self):
+        self.lost = defer.Deferred()
+        self.factory.connections.append(self)
+
+    def dataReceived(self, data):
+        self.transport.write(data)
+
+    def connectionLost(self, reason):
+        self.lost.callback(None)
+
+
+class _Silent(protocol.Protocol):
+    """ A SOCKS server that accepts connections and never replies. """
+
+    def connectionMade(self):
+        self.lost = defer.Deferred()
+        self.factory.connections.append(self)
+
+    def connectionLost(self, reason):
+        self.lost.callback(None)
+
+
+class _Collect(protocol.Protocol):
+
+    def __init__(self):
+        self.received = ''
+        self.done = defer.Deferred()
+
+    def dataReceived(self, data):
+        self.received += data
+        if self.received.endswith('\n'):
+            self.done.callback(self.received)
+
+
+class TestSOCKSClient(unittest.TestCase):
+
+    delay = 0.05
+
+    def setUp(self):
+        factory = protocol.ServerFactory()
+        factory.protocol = _Echo
+        factory.connections = self.connections = []
+        self.target = reactor.listenTCP(0, factory, interface='127.0.0.1')
+        self.socks = reactor.listenTCP(0, SOCKSServerFactory(self.delay),
+                                       interface='127.0.0.1')
+
+    def tearDown(self):
+        return defer.gatherResults([self.target.stopListening(),
+                                    self.socks.stopListening()] +
+                                   [echo.lost for echo in self.connections])
+
+    def _connect(self, version, host='127.0.0.1', port=None):
+        timestamps = _Timestamps()
+        endpoint = SOCKSClientEndpoint(
+                reactor, '127.0.0.1', self.socks.getHost().port, host,
+                port or self.target.getHost().port, timestamps, version)
+        factory = protocol.Factory()
+        factory.protocol = _Collect
+        return timestamps, endpoint.connect(factory)
+
+    def _check_relay(self, version, host='127.0.0.1'):
+        timestamps, d = self._connect(version, host)
+        def connected(proto):
+            stages = [timestamps[key] for key in ('SOCKET', 'CONNECT',
+                      'NEGOTIATE', 'REQUEST', 'RESPONSE')]
+            self.assertEqual(stages, sorted(stages))
+            self.assertTrue(timestamps['RESPONSE'] - timestamps['REQUEST'] >=
+                            self.delay * 0.9)
+            if version == 5:
+                self.assertTrue(timestamps['NEGOTIATE'] -
+                                timestamps['CONNECT'] >= self.delay * 0.9)
+            proto.transport.write('hello\n')
+            proto.done.addCallback(self.assertEqual, 'hello\n')
+            proto.done.addCallback(lambda ignored:
+                                   proto.transport.loseConnection())
+            return proto.done
+        d.addCallback(connected)
+        return d
+
+    def test_socks5(self):
+        return self._check_relay(5)
+
+    def test_socks5_hostname(self):
+        return self._check_relay(5, 'localhost')
+
+    def test_socks4a(self):
+        return self._check_relay(4, 'localhost')
+
+    def test_refused(self):
+        closed = reactor.listenTCP(0, protocol.ServerFactory(),
+                                   interface='127.0.0.1')
+        port = closed.getHost().port
+        d = closed.stopListening()
+        d.addCallback(lambda ignored: self._connect(5, port=port)[1])
+        return self.assertFailure(d, SOCKSError)
+
+    def test_cancel(self):
+        factory = protocol.ServerFactory()
+        factory.protocol = _Silent
+        factory.connections = []
+        silent = reactor.listenTCP(0, factory, interface='127.0.0.1')
+        self.addCleanup(silent.stopListening)
+        endpoint = SOCKSClientEndpoint(
+                reactor, '127.0.0.1', silent.getHost().port, '127.0.0.1',
+                self.target.getHost().port, _Timestamps())
+        wrapped = protocol.Factory()
+        wrapped.protocol = _Collect
+        d = endpoint.connect(wrapped)
+        self.assertFailure(d, defer.CancelledError)
+        def accepted():
+            if not factory.connections:
+                return task.deferLater(reactor, 0.01, accepted)
+            d.cancel()
+            return factory.connections[0].lost
+        return defer.gatherResults([d, accepted()])
@@ -0,0 +1,296 @@
+"""
+SQLite result store for perfd:
+
+- Records every request (timestamps, byte counts, DIDTIMEOUT, source,
+  and file size) and every circuit that perfd learns about.
+
+- Hands all writes to a background thread that commits them in batches
+  in WAL mode, so that the reactor never waits for the disk.
+"""
+
+import os
+import json
+import time
+import sqlite3
+import threading
+import Queue
+
+from twisted.internet import reactor, task
+from twisted.python import log
+from twisted.trial import unittest
+
+
+REQUEST_TIMESTAMPS = ['START', 'SOCKET', 'CONNECT', 'NEGOTIATE', 'REQUEST',
+                      'RESPONSE', 'DATAREQUEST', 'DATARESPONSE',
+                      'DATACOMPLETE'] + \
+                     ['DATAPERC%d' % perc for perc in range(10, 100, 10)] + \
+                     ['SERVER_PERC50']
+REQUEST_COUNTERS = ['FILESIZE', 'WRITEBYTES', 'READBYTES', 'DIDTIMEOUT']
+REQUEST_FIELDS = ['SOURCE'] + REQUEST_COUNTERS + REQUEST_TIMESTAMPS
+
+CIRCUIT_FIELDS = ['SOURCE', 'CIRC_ID', 'LAUNCH', 'PATH', 'BUILDTIMES',
+                  'FAIL_REASONS', 'STREAM_FAIL_REASONS', 'USED_AT', 'USED_BY',
+                  'TIMEOUT', 'QUANTILE']
+
+_COLUMN_TYPES = {
+    'SOURCE': 'TEXT', 'PATH': 'TEXT', 'BUILDTIMES': 'TEXT',
+    'FAIL_REASONS': 'TEXT', 'STREAM_FAIL_REASONS': 'TEXT',
+    'LAUNCH': 'REAL', 'USED_AT': 'REAL', 'QUANTILE': 'REAL',
+}
+for _field in REQUEST_TIMESTAMPS:
+    _COLUMN_TYPES[_field] = 'REAL'
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS requests (
+    id INTEGER PRIMARY KEY,
+    %s,
+    extra TEXT);
+CREATE INDEX IF NOT EXISTS requests_source_filesize_start
+    ON requests (source, filesize, start);
+CREATE TABLE IF NOT EXISTS circuits (
+    id INTEGER PRIMARY KEY,
+    %s,
+    extra TEXT);
+CREATE INDEX IF NOT EXISTS circuits_source_launch
+    ON circuits (source, launch);
+CREATE INDEX IF NOT EXISTS circuits_source_used_at
+    ON circuits (source, used_at);
+""" % (",\n    ".join(["%s %s" % (f.lower(), _COLUMN_TYPES.get(f, 'INTEGER'))
+                       for f in REQUEST_FIELDS]),
+       ",\n    ".join(["%s %s" % (f.lower(), _COLUMN_TYPES.get(f, 'INTEGER'))
+                       for f in CIRCUIT_FIELDS]))
+
+_TABLE_FIELDS = {
+    'requests': REQUEST_FIELDS,
+    'circuits': CIRCUIT_FIELDS,
+}
+
+# Tells the writer thread to commit what it has and exit.
+_STOP = object()
+
+
+def _extra_fields(text):
+    """ Fields of an extra column, with str keys and text values like the
+        other columns. """
+    fields = {}
+    for key, value in json.loads(text).iteritems():
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        fields[key.encode('utf-8')] = value
+    return fields
+
+
+class ResultStore(object):
+    """ Stores request and circuit records in an SQLite database.
+
+        add_request() and add_circuit() only put the record into a queue
+        and can be called from the reactor thread.  A background thread
+        writes queued records in one transaction per batch_size records,
+        or after flush_interval seconds, whatever comes first.  Queries
+        use their own connection, which WAL mode lets read while the
+        writer thread commits.
+
+        last_request_id and last_modified describe the latest commit, so
+        that clients can tell whether results have changed.  A batch that
+        the database refuses is logged and counted in dropped, and the
+        writer thread goes on with the next one. """
+
+    def __init__(self, path, batch_size=500, flush_interval=1.0):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue = Queue.Queue()
+        self._thread = None
+        self.dropped = 0
+        conn = self._connect()
+        conn.executescript(_SCHEMA)
+        self.last_request_id = self._last_request_id(conn)
+        conn.close()
+        self.last_modified = os.path.getmtime(path)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def _last_request_id(self, conn):
+        return conn.execute("SELECT max(id) FROM requests").fetchone()[0] or 0
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run,
+                                        name='perfd-result-store')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """ Commit all queued records and wait for the writer thread. """
+        if self._thread is None:
+            return
+        self._queue.put(_STOP)
+        self._thread.join()
+        self._thread = None
+
+    def add_request(self, record):
+        self._queue.put(('requests', self._row(REQUEST_FIELDS, record)))
+
+    def add_circuit(self, record):
+        self._queue.put(('circuits', self._row(CIRCUIT_FIELDS, record)))
+
+    def _row(self, fields, record):
+        extra = dict([(key, value) for key, value in record.iteritems()
+                      if key not in fields])
+        return tuple([record.get(field) for field in fields]) + \
+               (extra and json.dumps(extra, sort_keys=True) or None, )
+
+    def _run(self):
+        conn = self._connect()
+        statements = {}
+        for table, fields in _TABLE_FIELDS.iteritems():
+            statements[table] = "INSERT INTO %s (%s, extra) VALUES (%s)" % \
+                (table, ", ".join(fields), ", ".join("?" * (len(fields) + 1)))
+        stopping = False
+        while not stopping:
+            batch = {'requests': [], 'circuits': []}
+            queued = 0
+            deadline = None
+            while queued < self.batch_size:
+                try:
+                    if deadline is None:
+                        item = self._queue.get()
+                        deadline = time.time() + self.flush_interval
+                    else:
+                        item = self._queue.get(
+                            timeout=max(deadline - time.time(), 0.001))
+                except Queue.Empty:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch[item[0]].append(item[1])
+                queued += 1
+            if queued:
+                try:
+                    with conn:
+                        for table, rows in batch.iteritems():
+                            if rows:
+                                conn.executemany(statements[table], rows)
+                except sqlite3.Error, e:
+                    self.dropped += queued
+                    log.msg('Dropping %d results that could not be stored '
+                            'in %s: %s' % (queued, self.path, e))
+                    continue
+                self.last_request_id = self._last_request_id(conn)
+                self.last_modified = time.time()
+        conn.close()
+
+    def _query(self, table, time_field, source, filesize, start, end):
+        fields = _TABLE_FIELDS[table]
+        where = []
+        args = []
+        if source is not None:
+            where.append("source = ?")
+            args.append(source)
+        if filesize is not None:
+            where.append("filesize = ?")
+            args.append(filesize)
+        if start is not None:
+            where.append("%s >= ?" % time_field)
+            args.append(start)
+        if end is not None:
+            where.append("%s < ?" % time_field)
+            args.append(end)
+        sql = "SELECT %s, extra FROM %s" % (", ".join(fields), table)
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY %s" % time_field
+        conn = sqlite3.connect(self.path)
+        conn.text_factory = str
+        try:
+            for row in conn.execute(sql, args):
+                record = {}
+                for field, value in zip(fields, row):
+                    if value is not None:
+                        record[field] = value
+                if row[-1]:
+                    record.update(_extra_fields(row[-1]))
+                yield record
+        finally:
+            conn.close()
+
+    def requests(self, source=None, filesize=None, start=None, end=None):
+        """ Iterate over request records, ordered by START, that match all
+            given filters.  Records are read from the database while
+            iterating, not loaded all at once. """
+        return self._query('requests', 'start', source, filesize, start, end)
+
+    def circuits(self, source=None, start=None, end=None):
+        """ Iterate over circuit records, ordered by LAUNCH. """
+        return self._query('circuits', 'launch', source, None, start, end)
+
+
+class TestResultStore(unittest.TestCase):
+
+    def setUp(self):
+        self.store = ResultStore(self.mktemp(), batch_size=10,
+                                 flush_interval=0.01)
+        self.store.start()
+
+    def tearDown(self):
+        self.store.stop()
+
+    def test_requests(self):
+        for i in xrange(25):
+            self.store.add_request({'SOURCE': 'ec2', 'FILESIZE': 51200,
+                                    'START': 1000.0 + i,
+                                    'DATACOMPLETE': 1001.5 + i,
+                                    'DIDTIMEOUT': 0, 'SOCKS_EXTRA': 'x',
+                                    'SOCKS_NOTE': 'has space',
+                                    'SOCKS_COUNT': 3, 'SOCKS_NONE': None})
+        self.store.add_request({'SOURCE': 'ec2', 'FILESIZE': 1048576,
+                                'START': 1010.0, 'DIDTIMEOUT': 1})
+        self.store.stop()
+        results = list(self.store.requests(source='ec2', filesize=51200,
+                                           start=1010.0, end=1020.0))
+        self.assertEqual([r['START'] for r in results],
+                         [1010.0 + i for i in xrange(10)])
+        self.assertEqual(results[0]['DATACOMPLETE'], 1011.5)
+        self.assertEqual(results[0]['SOCKS_EXTRA'], 'x')
+        self.assertEqual(results[0]['SOCKS_NOTE'], 'has space')
+        self.assertEqual(results[0]['SOCKS_COUNT'], 3)
+        self.assertEqual(results[0]['SOCKS_NONE'], None)
+        self.assertNotIn('SOCKET', results[0])
+        self.assertEqual(len(list(self.store.requests())), 26)
+        self.assertEqual(self.store.last_request_id, 26)
+
+    def test_uses_index(self):
+        conn = sqlite3.connect(self.store.path)
+        plan = conn.execute("EXPLAIN QUERY PLAN SELECT * FROM requests "
+                            "WHERE source = 'ec2' AND filesize = 5242880 "
+                            "AND start >= 1000 ORDER BY start").fetchall()
+        conn.close()
+        self.assertIn('requests_source_filesize_start', str(plan))
+
+    def test_circuits(self):
+        self.store.add_circuit({'SOURCE': 'ec2', 'CIRC_ID': 7,
+                                'LAUNCH': 1000.25, 'PATH': '$A,$B,$C',
+                                'USED_AT': 1002.5, 'USED_BY': 12})
+        self.store.stop()
+        circuits = list(self.store.circuits(source='ec2'))
+        self.assertEqual(len(circuits), 1)
+        self.assertEqual(circuits[0]['PATH'], '$A,$B,$C')
+        self.assertEqual(circuits[0]['USED_BY'], 12)
+
+    def test_failed_batch(self):
+        # SQLite can't store a list, which fails the whole batch.
+        self.store.add_request({'SOURCE': 'ec2', 'START': 1000.0,
+                                'DIDTIMEOUT': [0]})
+        def dropped():
+            if not self.store.dropped:
+                return task.deferLater(reactor, 0.01, dropped)
+            self.store.add_request({'SOURCE': 'ec2', 'START': 1001.0})
+            self.store.stop()
+            self.assertEqual(self.store.dropped, 1)
+            self.assertEqual([r['START'] for r in self.store.requests()],
+                             [1001.0])
+        return dropped()
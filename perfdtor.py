@@ -0,0 +1,348 @@
+"""
+Launching and supervising the Tor processes that perfd measures through:
+
+- TorPool starts one TorProcess per SOCKS port, all at once, each with a
+  DataDirectory of its own under the pool's directory.  DataDirectories
+  are kept across restarts and runs, so that Tor starts from its cached
+  consensus and descriptors instead of bootstrapping from scratch.
+
+- TorProcess writes a torrc, runs the Tor binary with it, and follows the
+  "Bootstrapped N%" lines that Tor logs to stdout.  Once Tor is
+  bootstrapped, it connects to the control port with txtorcon and hands
+  the control connection to everyone waiting for it with when_ready().
+  A Tor that exits, or that doesn't bootstrap within bootstrap_timeout
+  seconds, is restarted after restart_delay seconds, twice as long after
+  every failed start, up to max_restart_delay.
+
+- perfdnetwork.py run with "-f <torrc>" behaves enough like a Tor binary
+  for TorPool, which is how the tests below and perfd.py's run.
+"""
+
+import os
+import re
+import sys
+import stat
+import socket
+
+from twisted.internet import defer, endpoints, error, protocol, reactor
+from twisted.python import log
+from twisted.trial import unittest
+
+import txtorcon
+
+BOOTSTRAPPED = re.compile(r'Bootstrapped (\d+)%(?: \((\S+)\))?: (.*)')
+
+# perfdnetwork.py, which fake_tor_binary() runs, found at import time
+# because trial changes the working directory.
+PERFDNETWORK = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            'perfdnetwork.py')
+
+
+class TorProcess(protocol.ProcessProtocol):
+    """ A Tor process of a TorPool and its control connection.  progress
+        and summary are the last bootstrap status that Tor logged,
+        protocol is the control connection while Tor is bootstrapped and
+        running, and restarts counts how often Tor was started again. """
+
+    def __init__(self, pool, tor_binary, socks_port, control_port,
+                 options=None):
+        self.pool = pool
+        self.tor_binary = tor_binary
+        self.socks_port = socks_port
+        self.control_port = control_port
+        self.options = options or {}
+        self.data_directory = os.path.abspath(
+                os.path.join(pool.data_directory, 'tor-%d' % socks_port))
+        self.progress = 0
+        self.summary = ''
+        self.protocol = None
+        self.restarts = 0
+        self.started = None
+        self.bootstrap_seconds = None
+        self._ready = []
+        self._output = ''
+        self._restart_delay = pool.restart_delay
+        self._timeout = None
+        self._restart = None
+        self._stopping = False
+        self._ended = None
+
+    def __repr__(self):
+        return 'TOR-%d' % self.socks_port
+
+    def when_ready(self, callback):
+        """ Call callback with the control connection now, if Tor is ready,
+            and every time it is ready after a (re)start. """
+        self._ready.append(callback)
+        if self.protocol is not None:
+            callback(self.protocol)
+
+    def torrc(self):
+        lines = ['DataDirectory %s' % self.data_directory,
+                 'SocksPort %d' % self.socks_port,
+                 'ControlPort %d' % self.control_port,
+                 'CookieAuthentication 1',
+                 'Log notice stdout',
+                 # Tor exits when perfd does.
+                 '__OwningControllerProcess %d' % os.getpid()]
+        for name, value in sorted(self.options.items()):
+            lines.append('%s %s' % (name, value))
+        return '\n'.join(lines) + '\n'
+
+    def start(self):
+        if not os.path.isdir(self.data_directory):
+            os.makedirs(self.data_directory, 0700)
+        torrc = os.path.join(self.data_directory, 'torrc')
+        with open(torrc, 'w') as torrc_file:
+            torrc_file.write(self.torrc())
+        self.progress = 0
+        self.summary = ''
+        self._output = ''
+        self.started = self.pool.clock.seconds()
+        self.bootstrap_seconds = None
+        self._restart = None
+        self._ended = defer.Deferred()
+        self.pool.reactor.spawnProcess(self, self.tor_binary,
+                                       [self.tor_binary, '-f', torrc],
+                                       env=os.environ,
+                                       path=self.data_directory)
+        self._timeout = self.pool.clock.callLater(self.pool.bootstrap_timeout,
+                                                  self._timed_out)
+
+    def outReceived(self, data):
+        lines = (self._output + data).split('\n')
+        self._output = lines.pop()
+        for line in lines:
+            match = BOOTSTRAPPED.search(line)
+            if match is None:
+                continue
+            self.progress = int(match.group(1))
+            self.summary = match.group(3).strip()
+            log.msg('%r: %d%%: %s' % (self, self.progress, self.summary))
+            if self.progress == 100 and self.bootstrap_seconds is None:
+                self.bootstrap_seconds = \
+                        self.pool.clock.seconds() - self.started
+                self._connect()
+
+    def errReceived(self, data):
+        log.msg('%r: %s' % (self, data.rstrip()))
+
+    def _connect(self):
+        d = txtorcon.build_tor_connection(
+                endpoints.TCP4ClientEndpoint(self.pool.reactor, '127.0.0.1',
+                                             self.control_port),
+                build_state=False)
+        d.addCallbacks(self._connected, self._connect_failed)
+
+    def _connected(self, proto):
+        if self._stopping or self._ended is None or self._ended.called:
+            proto.transport.loseConnection()
+            return
+        if self._timeout is not None and self._timeout.active():
+            self._timeout.cancel()
+        self._restart_delay = self.pool.restart_delay
+        self.protocol = proto
+        log.msg('%r: bootstrapped in %.1f seconds, connected to Tor %s' %
+                (self, self.bootstrap_seconds, proto.version))
+        for callback in self._ready:
+            callback(proto)
+
+    def _connect_failed(self, failure):
+        log.msg('%r: connecting to control port %d failed: %s' %
+                (self, self.control_port, failure.getErrorMessage()))
+        self._kill()
+
+    def _timed_out(self):
+        log.msg('%r: not bootstrapped after %g seconds, at %d%%: %s' %
+                (self, self.pool.bootstrap_timeout, self.progress,
+                 self.summary))
+        self._kill()
+
+    def _kill(self):
+        try:
+            self.transport.signalProcess('KILL')
+        except error.ProcessExitedAlready:
+            pass
+
+    def processEnded(self, reason):
+        if self._timeout is not None and self._timeout.active():
+            self._timeout.cancel()
+        if self.protocol is not None:
+            self.protocol.transport.loseConnection()
+            self.protocol = None
+        ended, self._ended = self._ended, None
+        if self._stopping:
+            ended.callback(None)
+            return
+        log.msg('%r: exited (%s), restarting in %.1f seconds' %
+                (self, reason.getErrorMessage(), self._restart_delay))
+        self._restart = self.pool.clock.callLater(self._restart_delay,
+                                                  self._restarted)
+        self._restart_delay = min(self._restart_delay * 2,
+                                  self.pool.max_restart_delay)
+        ended.callback(None)
+
+    def _restarted(self):
+        self.restarts += 1
+        self.start()
+
+    def stop(self):
+        """ Stop Tor, and return a deferred that fires once it exited. """
+        self._stopping = True
+        if self._restart is not None and self._restart.active():
+            self._restart.cancel()
+        if self._ended is None:
+            return defer.succeed(None)
+        ended = self._ended
+        try:
+            self.transport.signalProcess('TERM')
+        except error.ProcessExitedAlready:
+            pass
+        return ended
+
+
+class TorPool(object):
+    """ The Tor processes of perfd, by SOCKS port, with their
+        DataDirectories in data_directory. """
+
+    def __init__(self, data_directory, bootstrap_timeout=300,
+                 restart_delay=1.0, max_restart_delay=300, clock=reactor,
+                 ireactorprocess=reactor):
+        self.data_directory = data_directory
+        self.bootstrap_timeout = bootstrap_timeout
+        self.restart_delay = restart_delay
+        self.max_restart_delay = max_restart_delay
+        self.clock = clock
+        self.reactor = ireactorprocess
+        self.processes = {}
+
+    def launch(self, tor_binary, socks_port, control_port, options=None):
+        """ Return the TorProcess for socks_port, and start it if it isn't
+            running yet. """
+        tor = self.processes.get(socks_port)
+        if tor is not None:
+            if (tor.tor_binary, tor.control_port, tor.options) != \
+                    (tor_binary, control_port, options or {}):
+                raise ValueError('Tor on SOCKS port %d is already launched '
+                                 'with another configuration.' % socks_port)
+            return tor
+        tor = TorProcess(self, tor_binary, socks_port, control_port, options)
+        self.processes[socks_port] = tor
+        tor.start()
+        return tor
+
+    def stop(self):
+        """ Stop all Tor processes, and return a deferred that fires once
+            they exited. """
+        return defer.gatherResults([tor.stop()
+                                    for tor in self.processes.values()])
+
+
+def free_port():
+    """ A TCP port on localhost that nobody listens on right now. """
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def fake_tor_binary(directory, script='exec %(python)s %(perfdnetwork)s "$@"'):
+    """ Write an executable that runs perfdnetwork.py like a Tor binary, or
+        the given shell script, and return its path. """
+    path = os.path.abspath(os.path.join(directory, 'tor'))
+    with open(path, 'w') as binary:
+        binary.write('#!/bin/sh\n' + script % {
+            'python': sys.executable,
+            'perfdnetwork': PERFDNETWORK} + '\n')
+    os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR)
+    return path
+
+
+class TestTorPool(unittest.TestCase):
+
+    def setUp(self):
+        directory = self.mktemp()
+        os.makedirs(directory)
+        self.directory = directory
+        self.pool = TorPool(os.path.join(directory, 'data'),
+                            bootstrap_timeout=10, restart_delay=0.1)
+        self.addCleanup(self.pool.stop)
+
+    def _ready(self, tor):
+        d = defer.Deferred()
+        def ready(proto):
+            if not d.called:
+                d.callback(proto)
+        tor.when_ready(ready)
+        return d
+
+    def _ready_again(self, tor):
+        d = defer.Deferred()
+        def ready(proto):
+            if not d.called and tor.restarts:
+                d.callback(proto)
+        tor.when_ready(ready)
+        return d
+
+    def test_launch_and_restart(self):
+        from perfdnetwork import BOOTSTRAP_SECONDS
+        binary = fake_tor_binary(self.directory)
+        tors = [self.pool.launch(binary, free_port(), free_port(),
+                                 {'UseEntryGuards': 0})
+                for index in range(3)]
+        self.assertIdentical(self.pool.launch(binary, tors[0].socks_port,
+                                              tors[0].control_port,
+                                              {'UseEntryGuards': 0}),
+                             tors[0])
+        self.assertRaises(ValueError, self.pool.launch, binary,
+                          tors[0].socks_port, tors[0].control_port)
+        d = defer.gatherResults([self._ready(tor) for tor in tors])
+        cold = []
+        def launched(protocols):
+            for tor in tors:
+                self.assertEqual(tor.progress, 100)
+                self.assertEqual(tor.restarts, 0)
+                self.assertTrue(tor.bootstrap_seconds >= BOOTSTRAP_SECONDS)
+                with open(os.path.join(tor.data_directory, 'torrc')) as torrc:
+                    self.assertIn('UseEntryGuards 0\n', torrc.read())
+            cold.append(tors[1].bootstrap_seconds)
+            again = self._ready_again(tors[1])
+            tors[1].transport.signalProcess('KILL')
+            return again
+        def restarted(proto):
+            self.assertEqual(tors[1].restarts, 1)
+            self.assertIdentical(tors[1].protocol, proto)
+            # Started from its DataDirectory.
+            self.assertTrue(tors[1].bootstrap_seconds < cold[0])
+            self.assertEqual([tor.restarts for tor in tors], [0, 1, 0])
+            return proto.get_info('version')
+        def answered(info):
+            self.assertIn('version', info)
+            return self.pool.stop()
+        def stopped(ignored):
+            for tor in tors:
+                self.assertIdentical(tor.protocol, None)
+        d.addCallback(launched)
+        d.addCallback(restarted)
+        d.addCallback(answered)
+        d.addCallback(stopped)
+        return d
+
+    def test_bootstrap_timeout(self):
+        binary = fake_tor_binary(self.directory, 'exec sleep 60')
+        self.pool.bootstrap_timeout = 0.2
+        tor = self.pool.launch(binary, free_port(), free_port())
+        d = defer.Deferred()
+        def check():
+            if tor.restarts >= 2:
+                d.callback(tor)
+            else:
+                reactor.callLater(0.05, check)
+        check()
+        def restarted(tor):
+            self.assertEqual(tor.progress, 0)
+            self.assertIdentical(tor.protocol, None)
+            # 0.1 and 0.2 seconds after the first and second timeout.
+            self.assertTrue(tor._restart_delay >= 0.4)
+        return d.addCallback(restarted)
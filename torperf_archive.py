@@ -0,0 +1,416 @@
+#!/usr/bin/python
+#
+# This script converts a Torperf .data or .extradata file into a columnar
+# archive, and this module provides the reader for such archives.
+#
+# An archive is a directory with one NumPy .npy file per column and an
+# archive.json file that lists the columns and their types.  Readers
+# memory-map only the columns they ask for, so loading a year of
+# measurements takes milliseconds instead of re-parsing text.
+#
+# Columns of .data archives are named like the timestamps and counters in
+# .mergedata files, without the SEC/USEC suffixes.  Timestamps are int64
+# microseconds since the epoch, with 0 for timestamps that weren't
+# recorded; Archive.seconds() returns them as float seconds with NaN
+# instead.  Lines without DATAPERC fields have 0 for all of them.
+#
+# Columns of .extradata archives are the keys found in the file.  Keys
+# whose values are all numbers become float64 columns, with NaN where a
+# line doesn't have the key, all other keys become string columns.  Words
+# without "=", like "BUILDTIMEOUT_SET COMPUTED", go to the EVENT column.
+#
+# Files are converted in two passes of constant memory, so that archives
+# of any size can be converted.  Files rotated by truncate-data.py or
+# extra_stats.py are read together with their segments, oldest first.
+#
+# Usage:
+#   ./torperf_archive.py <.data or .extradata file> <archive directory>
+###
+
+import os
+import re
+import sys
+import json
+import unittest
+import tempfile
+import shutil
+
+import numpy
+
+from torperf_segments import segment_lines, unsegmented
+
+DATA_TIMESTAMPS = ["START", "SOCKET", "CONNECT", "NEGOTIATE", "REQUEST",
+                   "RESPONSE", "DATAREQUEST", "DATARESPONSE", "DATACOMPLETE"]
+DATA_PERCENTILES = ["DATAPERC%d" % perc for perc in range(10, 100, 10)]
+DATA_COUNTERS = ["WRITEBYTES", "READBYTES", "DIDTIMEOUT"]
+# Number of whitespace-separated values in .data lines without and with
+# DATAPERC fields.
+DATA_SHORT = 2 * len(DATA_TIMESTAMPS) + len(DATA_COUNTERS)
+DATA_LONG = DATA_SHORT + 2 * len(DATA_PERCENTILES)
+
+# Lines converted at once.
+CHUNK = 65536
+
+META = "archive.json"
+
+MULTIPLIERS = {"": 1, "kb": 1024, "mb": 1024 ** 2, "gb": 1024 ** 3,
+               "tb": 1024 ** 4}
+
+class TorperfFile:
+  """A .data file or archive, and the guards and file size that its name
+  stands for, like in metrics/filter.R."""
+
+  def __init__(self, filename):
+    self.filename = filename
+    # e.g. "torperf-50kb.data" results in guard_label = "torperf",
+    # filesize_label = "50kb", and filesize = 50 * 1024.  Segments like
+    # "torperf-50kb.data.2013-03-05" stand for the same guards and size.
+    parts = os.path.basename(unsegmented(filename)).split("-")
+    if len(parts) != 2:
+      raise ValueError("filenames must be of the form guard-filesize.data, "
+                       "you said \"%s\"" % os.path.basename(filename))
+    self.guard_label = parts[0]
+    size = parts[1].split(".")
+    if len(size) != 2:
+      raise ValueError("tail of filename must be filesize.data, you said "
+                       "\"%s\"" % parts[1])
+    self.filesize_label = size[0].lower()
+    match = re.match(r"(\d+)([a-z]*)$", self.filesize_label)
+    if not match or match.group(2) not in MULTIPLIERS:
+      raise ValueError("file size must be a number followed by kb, mb, gb, "
+                       "or tb, you said \"%s\"" % size[0])
+    self.filesize = int(match.group(1)) * MULTIPLIERS[match.group(2)]
+
+class StringColumn:
+  """Variable-length strings stored as one byte array and the offsets of
+  each string in it, both memory-mapped."""
+
+  def __init__(self, data, offsets):
+    self._data = data
+    self._offsets = offsets
+
+  def __len__(self):
+    return len(self._offsets) - 1
+
+  def __getitem__(self, i):
+    return self._data[self._offsets[i]:self._offsets[i + 1]].tostring()
+
+  def tolist(self):
+    return [self[i] for i in xrange(len(self))]
+
+class Archive:
+  """A columnar archive written by convert_data() or convert_extradata().
+  Columns are memory-mapped when they are first asked for."""
+
+  def __init__(self, path):
+    self.path = path
+    with open(os.path.join(path, META)) as meta_file:
+      meta = json.load(meta_file)
+    self.kind = meta["kind"]
+    self.rows = meta["rows"]
+    self.columns = meta["columns"]
+    self._loaded = {}
+
+  def __len__(self):
+    return self.rows
+
+  def _load(self, name):
+    return numpy.load(os.path.join(self.path, name + ".npy"), mmap_mode="r")
+
+  def column(self, name):
+    if name not in self._loaded:
+      if self.columns[name] == "string":
+        self._loaded[name] = StringColumn(self._load(name + ".data"),
+                                          self._load(name + ".offsets"))
+      else:
+        self._loaded[name] = self._load(name)
+    return self._loaded[name]
+
+  __getitem__ = column
+
+  def seconds(self, name):
+    """A .data timestamp column as float seconds, with NaN for timestamps
+    that weren't recorded."""
+    micros = self.column(name)
+    seconds = micros / 1e6
+    seconds[micros == 0] = numpy.nan
+    return seconds
+
+class ArchiveWriter:
+  def __init__(self, path, kind, rows):
+    if not os.path.isdir(path):
+      os.makedirs(path)
+    self.path = path
+    self.kind = kind
+    self.rows = rows
+    self.columns = {}
+
+  def _create(self, name, dtype, length):
+    return numpy.lib.format.open_memmap(os.path.join(self.path, name + ".npy"),
+                                        mode="w+", dtype=dtype,
+                                        shape=(length, ))
+
+  def create(self, name, dtype, fill=0):
+    self.columns[name] = numpy.dtype(dtype).name
+    column = self._create(name, dtype, self.rows)
+    if fill:
+      column[:] = fill
+    return column
+
+  def create_string(self, name, size):
+    self.columns[name] = "string"
+    return (self._create(name + ".data", numpy.uint8, size),
+            self._create(name + ".offsets", numpy.int64, self.rows + 1))
+
+  def close(self):
+    # Written last, so that an archive without it is an incomplete one.
+    with open(os.path.join(self.path, META), "w") as meta_file:
+      json.dump({"kind": self.kind, "rows": self.rows,
+                 "columns": self.columns}, meta_file, indent=1,
+                sort_keys=True)
+
+# Column names and the positions of their values in a .data line.
+DATA_LAYOUT = [(name, 2 * i) for i, name in enumerate(DATA_TIMESTAMPS)] + \
+              [(name, 2 * len(DATA_TIMESTAMPS) + i)
+               for i, name in enumerate(DATA_COUNTERS)] + \
+              [(name, DATA_SHORT + 2 * i)
+               for i, name in enumerate(DATA_PERCENTILES)]
+
+def _data_chunks(data_file):
+  """Lists of up to CHUNK .data lines with DATA_LONG values each.  Lines
+  without DATAPERC fields are padded with zeros, lines that have neither
+  DATA_SHORT nor DATA_LONG values are skipped."""
+  padding = " 0" * (DATA_LONG - DATA_SHORT)
+  chunk = []
+  for line in data_file:
+    count = len(line.split())
+    if count == DATA_SHORT:
+      line = line.rstrip() + padding
+    elif count != DATA_LONG:
+      continue
+    chunk.append(line)
+    if len(chunk) == CHUNK:
+      yield chunk
+      chunk = []
+  if chunk:
+    yield chunk
+
+def _parse_data_chunk(chunk):
+  values = numpy.fromstring(" ".join(chunk), dtype=numpy.int64, sep=" ")
+  values = values.reshape(-1, DATA_LONG)
+  columns = {}
+  for name, position in DATA_LAYOUT:
+    if name in DATA_COUNTERS:
+      columns[name] = values[:, position]
+    else:
+      columns[name] = values[:, position] * 1000000 + values[:, position + 1]
+  return columns
+
+def load_data(path, names=None):
+  """The given columns (or all of them) of a .data file and its segments or
+  of a .data archive as in-memory arrays by name."""
+  if names is None:
+    names = [name for name, _ in DATA_LAYOUT]
+  if os.path.isdir(path):
+    archive = Archive(path)
+    return dict([(name, numpy.array(archive[name])) for name in names])
+  return load_data_lines(segment_lines(path), names)
+
+def load_data_lines(lines, names=None):
+  """Like load_data(), but for .data lines from any iterable."""
+  if names is None:
+    names = [name for name, _ in DATA_LAYOUT]
+  chunks = [_parse_data_chunk(chunk) for chunk in _data_chunks(lines)]
+  columns = {}
+  for name in names:
+    columns[name] = numpy.concatenate([chunk[name] for chunk in chunks] or
+                                      [numpy.zeros(0, numpy.int64)])
+  return columns
+
+def convert_data(data_path, archive_path):
+  rows = sum(len(chunk) for chunk in _data_chunks(segment_lines(data_path)))
+  writer = ArchiveWriter(archive_path, "data", rows)
+  columns = {}
+  for name, _ in DATA_LAYOUT:
+    columns[name] = writer.create(name, name == "DIDTIMEOUT" and numpy.int8
+                                        or numpy.int64)
+  row = 0
+  for chunk in _data_chunks(segment_lines(data_path)):
+    values = _parse_data_chunk(chunk)
+    end = row + len(chunk)
+    for name, column in columns.iteritems():
+      column[row:end] = values[name]
+    row = end
+  for column in columns.itervalues():
+    column.flush()
+  writer.close()
+  return Archive(archive_path)
+
+def _extradata_lines(extradata_file):
+  """.extradata lines as dicts, with words that are not key=value pairs
+  joined in EVENT."""
+  for line in extradata_file:
+    record = {}
+    words = []
+    for token in line.split():
+      key, sep, value = token.partition("=")
+      if sep:
+        record[key] = value
+      else:
+        words.append(token)
+    if words:
+      record["EVENT"] = " ".join(words)
+    if record:
+      yield record
+
+def _is_number(value):
+  try:
+    float(value)
+    return True
+  except ValueError:
+    return False
+
+def convert_extradata(extradata_path, archive_path):
+  # First pass: find keys, their types, and the bytes needed for strings.
+  rows = 0
+  numeric = {}
+  sizes = {}
+  for record in _extradata_lines(segment_lines(extradata_path)):
+    rows += 1
+    for key, value in record.iteritems():
+      if numeric.get(key, True) and not _is_number(value):
+        numeric[key] = False
+      else:
+        numeric.setdefault(key, True)
+      sizes[key] = sizes.get(key, 0) + len(value)
+
+  writer = ArchiveWriter(archive_path, "extradata", rows)
+  numbers = {}
+  strings = {}
+  for key in numeric:
+    if numeric[key]:
+      numbers[key] = writer.create(key, numpy.float64, numpy.nan)
+    else:
+      strings[key] = writer.create_string(key, sizes[key])
+  # Next free byte in each string column's data.
+  ends = dict([(key, 0) for key in strings])
+
+  def flush(chunk, row):
+    end = row + len(chunk)
+    for key, column in numbers.iteritems():
+      values = [record.get(key) for record in chunk]
+      present = numpy.array([value is not None for value in values])
+      column[row:end][present] = [float(value) for value in values
+                                  if value is not None]
+    for key, (data, offsets) in strings.iteritems():
+      values = [record.get(key, "") for record in chunk]
+      lengths = numpy.array([len(value) for value in values],
+                            dtype=numpy.int64)
+      offsets[row + 1:end + 1] = ends[key] + numpy.cumsum(lengths)
+      joined = "".join(values)
+      data[ends[key]:ends[key] + len(joined)] = \
+          numpy.frombuffer(joined, dtype=numpy.uint8)
+      ends[key] += len(joined)
+    return end
+
+  # Second pass: fill the columns.
+  row = 0
+  chunk = []
+  for record in _extradata_lines(segment_lines(extradata_path)):
+    chunk.append(record)
+    if len(chunk) == CHUNK:
+      row = flush(chunk, row)
+      chunk = []
+  if chunk:
+    row = flush(chunk, row)
+  for column in numbers.itervalues():
+    column.flush()
+  for data, offsets in strings.itervalues():
+    data.flush()
+    offsets.flush()
+  writer.close()
+  return Archive(archive_path)
+
+class TestArchive(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def _write(self, name, text):
+    path = os.path.join(self.directory, name)
+    with open(path, "w") as f:
+      f.write(text)
+    return path
+
+  def test_data(self):
+    short = " ".join(["1362528000 250000"] + ["0 0"] * 7 +
+                     ["1362528003 999999", "75 51375 0"]) + " \n"
+    long = " ".join(["1362528300 5"] * 9 + ["75 51375 1"] +
+                    ["1362528301 %d" % perc for perc in range(10, 100, 10)])
+    path = self._write("50kb.data", short + "garbage\n" + long + "\n")
+    archive = convert_data(path, os.path.join(self.directory, "a"))
+    archive = Archive(archive.path)
+    self.assertEqual(len(archive), 2)
+    self.assertEqual(list(archive["START"]),
+                     [1362528000250000, 1362528300000005])
+    self.assertEqual(list(archive["DIDTIMEOUT"]), [0, 1])
+    self.assertEqual(list(archive["DATAPERC90"]), [0, 1362528301000090])
+    for source in (path, archive.path):
+      columns = load_data(source, ["READBYTES", "DATACOMPLETE"])
+      self.assertEqual(sorted(columns), ["DATACOMPLETE", "READBYTES"])
+      self.assertEqual(list(columns["DATACOMPLETE"]),
+                       [1362528003999999, 1362528300000005])
+    seconds = archive.seconds("SOCKET")
+    self.assertTrue(numpy.isnan(seconds[0]))
+    self.assertAlmostEqual(seconds[1], 1362528300.000005, 6)
+
+  def test_segments(self):
+    lines = [" ".join(["%d 0" % start] + ["0 0"] * 7 +
+                      ["%d 0" % (start + 2), "75 51375 0"]) + "\n"
+             for start in (1362528000, 1362614400)]
+    self._write("torperf-50kb.data.2013-03-06-000000", lines[0])
+    path = self._write("torperf-50kb.data", lines[1])
+    self.assertEqual(list(load_data(path, ["START"])["START"]),
+                     [1362528000000000, 1362614400000000])
+    self.assertEqual(len(convert_data(path, os.path.join(self.directory,
+                                                         "a"))), 2)
+    torperf_file = TorperfFile(os.path.join(self.directory,
+                                            "torperf-50kb.data.2013-03-05"))
+    self.assertEqual(torperf_file.guard_label, "torperf")
+    self.assertEqual(torperf_file.filesize, 50 * 1024)
+
+  def test_extradata(self):
+    path = self._write("50kb.extradata",
+        "CIRC_ID=7 LAUNCH=1362528000.25 PATH=$A,$B,$C BUILDTIMES=0.5,0.9 "
+        "USED_AT=1362528003.5 USED_BY=12\n"
+        "BUILDTIMEOUT_SET COMPUTED TIMEOUT_MS=1500\n"
+        "CIRC_ID=8 LAUNCH=1362528001 PATH= FAIL_REASONS=TIMEOUT\n")
+    archive = convert_extradata(path, os.path.join(self.directory, "a"))
+    self.assertEqual(len(archive), 3)
+    self.assertEqual(archive.columns["PATH"], "string")
+    self.assertEqual(archive.columns["USED_AT"], "float64")
+    self.assertEqual(archive["PATH"].tolist(), ["$A,$B,$C", "", ""])
+    self.assertEqual(archive["EVENT"][1], "BUILDTIMEOUT_SET COMPUTED")
+    self.assertEqual(archive["FAIL_REASONS"][2], "TIMEOUT")
+    used_at = archive["USED_AT"]
+    self.assertEqual(used_at[0], 1362528003.5)
+    self.assertTrue(numpy.isnan(used_at[2]))
+    self.assertEqual(list(archive["CIRC_ID"][[0, 2]]), [7, 8])
+
+def main():
+  if len(sys.argv) != 3:
+    print("See script header for usage")
+    sys.exit(1)
+  if unsegmented(sys.argv[1]).endswith(".extradata"):
+    archive = convert_extradata(sys.argv[1], sys.argv[2])
+  else:
+    archive = convert_data(sys.argv[1], sys.argv[2])
+  print("Wrote %d rows and %d columns to %s" % (len(archive),
+                                                len(archive.columns),
+                                                archive.path))
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,183 @@
+#!/usr/bin/python
+#
+# This module holds the circuits that extra_stats.py and perfd's circuit
+# tracker are following until Tor reports them as closed or failed.
+#
+# Circuit records use __slots__ and keep their build times in an array of
+# doubles, so that an open circuit takes a few hundred bytes.  Circuits
+# and ignored streams are kept in an InFlightTable, which evicts entries
+# once they are max_age seconds old or once there are more than
+# max_entries of them, oldest first, and counts how many it evicted.  Tor
+# doesn't always tell us that a circuit closed, e.g. when we connect while
+# it's open or when it drops events, and some STREAM FAILED events are
+# never followed by a CLOSED, so without eviction these would pile up over
+# months of uptime.
+#
+# Usage:
+#   ./torperf_circuits.py [days] [circuits per hour]
+# runs a soak test that feeds the given number of days of synthetic
+# circuits, some of which never close, through a table and prints its size
+# and memory use.
+###
+
+import sys
+import array
+import resource
+import collections
+import unittest
+
+# Tor closes circuits that it doesn't use after an hour, and streams don't
+# last for days, so what is still open after a day was never reported.
+CIRCUIT_MAX_AGE = 24 * 60 * 60
+STREAM_MAX_AGE = 24 * 60 * 60
+
+MAX_ENTRIES = 100000
+
+class Circuit(object):
+  __slots__ = ("circ_id", "launch_time", "close_time", "stream_end_time",
+               "path", "build_times", "failed", "fail_reason", "used",
+               "strm_id", "stream_failed", "stream_fail_reason")
+
+  def __init__(self, launch_time, circ_id):
+    self.circ_id = circ_id
+    self.launch_time = launch_time
+    self.close_time = launch_time
+    self.stream_end_time = 0
+    self.path = ()
+    self.build_times = array.array("d")
+    self.failed = False
+    self.fail_reason = None
+    self.used = False
+    self.strm_id = 0
+    self.stream_failed = False
+    self.stream_fail_reason = None
+
+class InFlightTable:
+  """Values by key in the order they were added, evicted once they're
+  max_age seconds old, or oldest first once there are more than
+  max_entries.  evicted counts the entries that were evicted rather than
+  popped."""
+
+  def __init__(self, max_age, max_entries=MAX_ENTRIES):
+    self.max_age = max_age
+    self.max_entries = max_entries
+    self.evicted = 0
+    self._entries = collections.OrderedDict()
+
+  def __len__(self):
+    return len(self._entries)
+
+  def __contains__(self, key):
+    return key in self._entries
+
+  def __getitem__(self, key):
+    return self._entries[key][1]
+
+  def get(self, key, default=None):
+    entry = self._entries.get(key)
+    if entry is None:
+      return default
+    return entry[1]
+
+  def add(self, key, value, now):
+    """Adds or replaces an entry, after evicting expired ones."""
+    self.expire(now)
+    self._entries.pop(key, None)
+    self._entries[key] = (now, value)
+    if len(self._entries) > self.max_entries:
+      self._entries.popitem(last=False)
+      self.evicted += 1
+
+  def pop(self, key, default=None):
+    entry = self._entries.pop(key, None)
+    if entry is None:
+      return default
+    return entry[1]
+
+  def expire(self, now):
+    entries = self._entries
+    while entries:
+      key = next(iter(entries))
+      if now - entries[key][0] < self.max_age:
+        break
+      del entries[key]
+      self.evicted += 1
+
+def soak(table, days, per_hour, closed=0.95):
+  """Adds per_hour circuits per hour for days, of which all but one in
+  1/(1 - closed) are popped again within a minute, and yields the
+  simulated time and table size once per hour."""
+  leak_every = int(round(1 / (1 - closed)))
+  now = 1362528000.0
+  interval = 3600.0 / per_hour
+  circ_id = 0
+  for hour in xrange(int(days * 24)):
+    for i in xrange(per_hour):
+      circ_id += 1
+      circ = Circuit(now, circ_id)
+      circ.path = ("$%040X" % circ_id, ) * 3
+      circ.build_times.extend((0.3, 0.6, 0.9))
+      table.add(circ_id, circ, now)
+      # Circuits are closed out of order, some time after the next ones
+      # were launched.
+      if circ_id > 10 and (circ_id - 10) % leak_every:
+        table.pop(circ_id - 10)
+      now += interval
+    yield now, len(table)
+
+class TestInFlightTable(unittest.TestCase):
+
+  def test_expire(self):
+    table = InFlightTable(10)
+    table.add(1, "a", 100)
+    table.add(2, "b", 105)
+    self.assertEqual(table[1], "a")
+    table.add(1, "c", 108)
+    table.add(3, "d", 116)
+    self.assertFalse(2 in table)
+    self.assertEqual(table.get(1), "c")
+    self.assertEqual(table.evicted, 1)
+    self.assertEqual(table.pop(1), "c")
+    self.assertEqual(table.pop(1), None)
+    table.expire(126)
+    self.assertEqual(len(table), 0)
+    self.assertEqual(table.evicted, 2)
+
+  def test_max_entries(self):
+    table = InFlightTable(10, 2)
+    for key in range(4):
+      table.add(key, key, 100)
+    self.assertEqual(sorted(table._entries.keys()), [2, 3])
+    self.assertEqual(table.evicted, 2)
+
+  def test_soak(self):
+    # A week of 1000 circuits per hour, 5% of which are never closed,
+    # levels off after a day.
+    table = InFlightTable(CIRCUIT_MAX_AGE)
+    sizes = [size for now, size in soak(table, 7, 1000)]
+    self.assertTrue(max(sizes) <= 24 * 50 + 10)
+    self.assertEqual(max(sizes[24:]), max(sizes[-24:]))
+    self.assertTrue(6 * 24 * 50 - 50 < table.evicted <= 6 * 24 * 50)
+
+  def test_circuit(self):
+    circ = Circuit(1362528000.25, 7)
+    circ.build_times.append(0.5)
+    self.assertEqual(",".join(map(str, circ.build_times)), "0.5")
+    self.assertRaises(AttributeError, setattr, circ, "nickname", "a")
+
+def main():
+  if len(sys.argv) > 3:
+    print("See script header for usage")
+    sys.exit(1)
+  days = len(sys.argv) > 1 and float(sys.argv[1]) or 90
+  per_hour = len(sys.argv) > 2 and int(sys.argv[2]) or 3000
+  table = InFlightTable(CIRCUIT_MAX_AGE)
+  for now, size in soak(table, days, per_hour):
+    hour = int((now - 1362528000.0) / 3600)
+    if hour % 24 == 0:
+      print "day %4d: %6d in flight, %8d evicted, max RSS %d KiB" % (
+          hour / 24, size, table.evicted,
+          resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+if __name__ == "__main__":
+  main()
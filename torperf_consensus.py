@@ -0,0 +1,501 @@
+#!/usr/bin/python
+#
+# This script indexes archived consensuses and server descriptors, and
+# this module provides the reader for such indexes, so that
+# analyze_guards.py can rank the guard of each circuit in the consensus
+# that was valid when the circuit was launched, without a running Tor.
+#
+# Consensuses and descriptors are read from files or directory trees, as
+# found in a Tor data directory (cached-consensus, cached-descriptors) or
+# extracted from CollecTor tarballs.  Each file is recognized by its
+# first line that isn't an @annotation.  An index is a directory with
+# three columnar archives, see torperf_archive.py:
+#
+#   consensuses  VALID_AFTER, FRESH_UNTIL, and VALID_UNTIL in seconds since
+#                the epoch, ordered by VALID_AFTER, and START, the row of
+#                the first relay of each consensus in relays
+#   relays       FINGERPRINT and descriptor DIGEST as 20 bytes, consensus
+#                weight BW, and DESC_BW, the advertised bandwidth of the
+#                relay's descriptor, or 0 if it wasn't found, ordered by
+#                FINGERPRINT within each consensus
+#   descriptors  DIGEST, FINGERPRINT, PUBLISHED, and DESC_BW of every
+#                descriptor, ordered by DIGEST
+#
+# and sources.json, with the size and modification time of every file that
+# was read.  Indexing again only parses files that are new, and starts
+# over if a file changed or disappeared.  Files are parsed in parallel.
+#
+# Relays are matched to the descriptor with the digest in their "r" line,
+# or, for microdescriptor consensuses and descriptors that are missing, to
+# the newest descriptor of the same relay published before the consensus.
+# Advertised bandwidth is the smaller of average and observed bandwidth,
+# like TorCtl's desc_bw.
+#
+# Usage:
+#   ./torperf_consensus.py <index directory> <consensus or descriptor file
+#       or directory> [more files or directories]
+###
+
+import os
+import re
+import sys
+import json
+import time
+import base64
+import shutil
+import hashlib
+import binascii
+import calendar
+import tempfile
+import unittest
+import collections
+import multiprocessing
+
+import numpy
+
+from torperf_archive import Archive, ArchiveWriter
+
+SOURCES = "sources.json"
+
+# Ranks of this many consensuses are kept, since circuits in .extradata
+# files are mostly in order.
+RANKS_CACHED = 4
+
+NO_DIGEST = "\x00" * 20
+
+DESCRIPTOR_RE = re.compile(r"^router .*?^router-signature\n", re.M | re.S)
+
+def _seconds(date):
+  return calendar.timegm(time.strptime(date.strip(), "%Y-%m-%d %H:%M:%S"))
+
+def _decode(identity):
+  return base64.b64decode(identity + "=" * (-len(identity) % 4))
+
+def document_type(path):
+  """"consensus", "descriptors", or None for other files."""
+  with open(path) as f:
+    for line in f:
+      if line.startswith("@"):
+        continue
+      if line.startswith("network-status-version 3"):
+        return "consensus"
+      if line.startswith("router "):
+        return "descriptors"
+      return None
+  return None
+
+def parse_consensus(lines):
+  """valid-after, fresh-until, and valid-until of a consensus, and the
+  fingerprints, descriptor digests, and consensus weights of its relays, or
+  None if the document isn't a consensus.  Relays in microdescriptor
+  consensuses have NO_DIGEST."""
+  times = {}
+  fingerprints = []
+  digests = []
+  weights = []
+  for line in lines:
+    if line.startswith("r "):
+      parts = line.split()
+      fingerprints.append(_decode(parts[2]))
+      digests.append(len(parts) == 9 and _decode(parts[3]) or NO_DIGEST)
+      weights.append(0)
+    elif line.startswith("w ") and weights:
+      for word in line.split()[1:]:
+        if word.startswith("Bandwidth="):
+          weights[-1] = int(word[len("Bandwidth="):])
+    elif line.startswith("vote-status "):
+      if line.split()[1] != "consensus":
+        return None
+    elif line.startswith(("valid-after ", "fresh-until ", "valid-until ")):
+      keyword, date = line.split(" ", 1)
+      times[keyword] = _seconds(date)
+    elif line.startswith("directory-footer"):
+      break
+  if len(times) != 3:
+    return None
+  return (times["valid-after"], times["fresh-until"], times["valid-until"],
+          numpy.array(fingerprints, dtype="S20"),
+          numpy.array(digests, dtype="S20"),
+          numpy.array(weights, dtype=numpy.int64))
+
+def parse_descriptors(text):
+  """(digest, fingerprint, published, advertised bandwidth) of the server
+  descriptors in text."""
+  for match in DESCRIPTOR_RE.finditer(text):
+    descriptor = match.group(0)
+    fingerprint = NO_DIGEST
+    published = 0
+    bandwidth = 0
+    for line in descriptor.split("\n"):
+      if line.startswith("opt "):
+        line = line[len("opt "):]
+      if line.startswith("fingerprint "):
+        fingerprint = binascii.unhexlify("".join(line.split()[1:]))
+      elif line.startswith("published "):
+        published = _seconds(line[len("published "):])
+      elif line.startswith("bandwidth "):
+        average, burst, observed = map(int, line.split()[1:4])
+        bandwidth = min(average, observed)
+    yield hashlib.sha1(descriptor).digest(), fingerprint, published, bandwidth
+
+def _parse_file(path):
+  """A consensus as from parse_consensus() or descriptors as column arrays,
+  tagged with their type, or None for other files."""
+  kind = document_type(path)
+  if kind == "consensus":
+    with open(path) as f:
+      consensus = parse_consensus(f)
+    return consensus and ("consensus", consensus)
+  if kind == "descriptors":
+    with open(path) as f:
+      descriptors = zip(*parse_descriptors(f.read())) or [[], [], [], []]
+    return ("descriptors",
+            (numpy.array(descriptors[0], dtype="S20"),
+             numpy.array(descriptors[1], dtype="S20"),
+             numpy.array(descriptors[2], dtype=numpy.int64),
+             numpy.array(descriptors[3], dtype=numpy.int64)))
+  return None
+
+def _files(paths):
+  """Size and modification time of the files in paths, by absolute path."""
+  files = {}
+  for path in paths:
+    if os.path.isdir(path):
+      for directory, _, names in os.walk(path):
+        for name in names:
+          files.update(_files([os.path.join(directory, name)]))
+    else:
+      stat = os.stat(path)
+      files[os.path.abspath(path)] = [stat.st_size, int(stat.st_mtime)]
+  return files
+
+def _bytes(column, width):
+  """An S-typed column as an array of its bytes, including the padding."""
+  return numpy.ascontiguousarray(column).view(numpy.uint8).reshape(-1, width)
+
+def _relay_keys(fingerprints, times):
+  """Keys that sort like (fingerprint, time)."""
+  times = numpy.asarray(times, dtype=">i8")
+  return numpy.hstack([_bytes(fingerprints, 20),
+                       _bytes(times.view("S8"), 8)]).view("S28").ravel()
+
+def match_descriptors(fingerprints, digests, valid_after, descriptors):
+  """Advertised bandwidths of relays with the given fingerprints, digests,
+  and consensus valid-after times, from descriptors ordered by digest."""
+  desc_digests, desc_fingerprints, published, desc_bw = descriptors
+  bandwidths = numpy.zeros(len(fingerprints), dtype=numpy.int64)
+  if not len(desc_digests):
+    return bandwidths
+  found = numpy.searchsorted(desc_digests, digests)
+  found[found == len(desc_digests)] = 0
+  matched = desc_digests[found] == digests
+  bandwidths[matched] = desc_bw[found[matched]]
+  unmatched = numpy.flatnonzero(~matched)
+  if len(unmatched):
+    keys = _relay_keys(desc_fingerprints, published)
+    order = numpy.argsort(keys, kind="mergesort")
+    newest = numpy.searchsorted(keys[order], _relay_keys(
+        fingerprints[unmatched], valid_after[unmatched]), side="right") - 1
+    same = (newest >= 0) & (desc_fingerprints[order[newest]] ==
+                            fingerprints[unmatched])
+    bandwidths[unmatched[same]] = desc_bw[order[newest[same]]]
+  return bandwidths
+
+class ConsensusIndex:
+  """An index written by build_index().  Relays are ranked per consensus
+  when the first of them is asked for, and found by binary search."""
+
+  def __init__(self, path):
+    self.path = path
+    consensuses = Archive(os.path.join(path, "consensuses"))
+    self.relays = Archive(os.path.join(path, "relays"))
+    self.valid_after = numpy.array(consensuses["VALID_AFTER"])
+    self.valid_until = numpy.array(consensuses["VALID_UNTIL"])
+    self._starts = numpy.append(numpy.array(consensuses["START"]),
+                                len(self.relays))
+    self._cached = collections.OrderedDict()
+
+  def __len__(self):
+    return len(self.valid_after)
+
+  def at(self, seconds):
+    """The number of the newest consensus that was valid at seconds, or None
+    if there is none."""
+    consensus = numpy.searchsorted(self.valid_after, seconds, "right") - 1
+    if consensus < 0 or seconds >= self.valid_until[consensus]:
+      return None
+    return int(consensus)
+
+  def _ranks(self, consensus, ratio):
+    """Ranks of the relays of a consensus in row order, or -1 for relays
+    without descriptors."""
+    if (consensus, ratio) in self._cached:
+      ranks = self._cached.pop((consensus, ratio))
+    else:
+      start, end = self._starts[consensus], self._starts[consensus + 1]
+      bandwidths = self.relays["DESC_BW"][start:end]
+      known = numpy.flatnonzero(bandwidths > 0)
+      weights = self.relays["BW"][start:end][known]
+      if ratio:
+        weights = weights / bandwidths[known].astype(numpy.float64)
+      order = numpy.argsort(-weights, kind="mergesort")
+      ranks = numpy.empty(end - start, dtype=numpy.int64)
+      ranks.fill(-1)
+      ranks[known[order]] = numpy.arange(len(order))
+      if len(self._cached) == RANKS_CACHED:
+        self._cached.popitem(last=False)
+    self._cached[(consensus, ratio)] = ranks
+    return ranks
+
+  def rank(self, consensus, fingerprint, ratio=False):
+    """The rank of the relay with a hex fingerprint among the relays with
+    descriptors in a consensus, from 0 for the highest consensus weight or,
+    with ratio, for the highest ratio of consensus weight to advertised
+    bandwidth, or None if the relay isn't ranked."""
+    try:
+      fingerprint = numpy.array([binascii.unhexlify(fingerprint)], "S20")
+    except TypeError:
+      return None
+    start, end = self._starts[consensus], self._starts[consensus + 1]
+    fingerprints = self.relays["FINGERPRINT"][start:end]
+    row = numpy.searchsorted(fingerprints, fingerprint)[0]
+    if row == end - start or fingerprints[row:row + 1] != fingerprint:
+      return None
+    rank = self._ranks(consensus, ratio)[row]
+    if rank < 0:
+      return None
+    return int(rank)
+
+def _load_sources(path):
+  try:
+    with open(os.path.join(path, SOURCES)) as sources_file:
+      return json.load(sources_file)
+  except IOError:
+    return {}
+
+def _write_index(path, consensuses, descriptors, sources):
+  """Writes consensuses, a list of parse_consensus() results, and
+  descriptors, as column arrays, to an index in path."""
+  consensuses.sort(key=lambda consensus: consensus[0])
+  rows = sum(len(consensus[3]) for consensus in consensuses)
+  writer = ArchiveWriter(os.path.join(path, "consensuses"), "consensuses",
+                         len(consensuses))
+  columns = [writer.create(name, numpy.int64) for name in
+             ("VALID_AFTER", "FRESH_UNTIL", "VALID_UNTIL", "START")]
+  relays = ArchiveWriter(os.path.join(path, "relays"), "relays", rows)
+  fingerprints = relays.create("FINGERPRINT", "S20")
+  digests = relays.create("DIGEST", "S20")
+  weights = relays.create("BW", numpy.int64)
+  valid_after = numpy.zeros(rows, dtype=numpy.int64)
+  start = 0
+  for i, consensus in enumerate(consensuses):
+    end = start + len(consensus[3])
+    for column, value in zip(columns, consensus[:3] + (start, )):
+      column[i] = value
+    order = numpy.argsort(consensus[3], kind="mergesort")
+    fingerprints[start:end] = consensus[3][order]
+    digests[start:end] = consensus[4][order]
+    weights[start:end] = consensus[5][order]
+    valid_after[start:end] = consensus[0]
+    start = end
+  relays.create("DESC_BW", numpy.int64)[:] = match_descriptors(
+      fingerprints, digests, valid_after, descriptors)
+  writer.close()
+  relays.close()
+  writer = ArchiveWriter(os.path.join(path, "descriptors"), "descriptors",
+                         len(descriptors[0]))
+  for name, values in zip(("DIGEST", "FINGERPRINT", "PUBLISHED", "DESC_BW"),
+                          descriptors):
+    writer.create(name, values.dtype)[:] = values
+  writer.close()
+  # Written last, so that an index without it is rebuilt.
+  with open(os.path.join(path, SOURCES), "w") as sources_file:
+    json.dump(sources, sources_file, indent=1, sort_keys=True)
+
+def _old_index(path):
+  """The consensuses and descriptors of an existing index, in the form
+  that _write_index() takes."""
+  index = ConsensusIndex(path)
+  consensuses = []
+  archive = Archive(os.path.join(path, "consensuses"))
+  for i in xrange(len(index)):
+    start, end = index._starts[i], index._starts[i + 1]
+    consensuses.append((int(index.valid_after[i]),
+                        int(archive["FRESH_UNTIL"][i]),
+                        int(index.valid_until[i]),
+                        numpy.array(index.relays["FINGERPRINT"][start:end]),
+                        numpy.array(index.relays["DIGEST"][start:end]),
+                        numpy.array(index.relays["BW"][start:end])))
+  archive = Archive(os.path.join(path, "descriptors"))
+  descriptors = [numpy.array(archive[name]) for name in
+                 ("DIGEST", "FINGERPRINT", "PUBLISHED", "DESC_BW")]
+  return consensuses, descriptors
+
+def build_index(path, paths, jobs=None):
+  """Adds the consensuses and descriptors in the files and directories in
+  paths that aren't in the index in path yet, and returns the index."""
+  files = _files(paths)
+  sources = _load_sources(path)
+  if not all(files.get(name) == stat for name, stat in sources.iteritems()):
+    sources = {}
+  new_files = sorted(name for name in files if name not in sources)
+  if sources and not new_files:
+    return ConsensusIndex(path)
+  if sources:
+    consensuses, descriptors = _old_index(path)
+  else:
+    consensuses = []
+    descriptors = [numpy.zeros(0, dtype="S20"), numpy.zeros(0, dtype="S20"),
+                   numpy.zeros(0, dtype=numpy.int64),
+                   numpy.zeros(0, dtype=numpy.int64)]
+  workers = multiprocessing.Pool(jobs)
+  try:
+    parsed = workers.map(_parse_file, new_files, chunksize=16)
+  finally:
+    workers.close()
+  new_descriptors = [descriptors]
+  for result in parsed:
+    if result and result[0] == "consensus":
+      consensuses.append(result[1])
+    elif result:
+      new_descriptors.append(result[1])
+  descriptors = [numpy.concatenate(columns)
+                 for columns in zip(*new_descriptors)]
+  _, unique = numpy.unique(descriptors[0], return_index=True)
+  descriptors = [column[unique] for column in descriptors]
+  # The same consensus may have been archived more than once.
+  consensuses = dict((consensus[0], consensus)
+                     for consensus in consensuses).values()
+  sources.update(files)
+  parent = os.path.dirname(os.path.abspath(path))
+  temp_path = tempfile.mkdtemp(dir=parent)
+  try:
+    _write_index(temp_path, consensuses, descriptors, sources)
+    if os.path.exists(path):
+      shutil.rmtree(path)
+    os.rename(temp_path, path)
+  except:
+    shutil.rmtree(temp_path, ignore_errors=True)
+    raise
+  return ConsensusIndex(path)
+
+class TestConsensusIndex(unittest.TestCase):
+
+  # Three relays with the fingerprints AA..., BB..., CC...
+  RELAYS = [("\xaa" * 20, 300, 1000), ("\xbb" * 20, 200, 100),
+            ("\xcc" * 20, 100, 0)]
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.archives = os.path.join(self.directory, "archives")
+    os.makedirs(self.archives)
+    self.index = os.path.join(self.directory, "index")
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def _write(self, name, text):
+    path = os.path.join(self.archives, name)
+    with open(path, "w") as f:
+      f.write(text)
+    return path
+
+  def _descriptor(self, fingerprint, bandwidth, published):
+    return "router relay 10.0.0.1 9001 0 0\n" \
+           "published %s\n" \
+           "opt fingerprint %s\n" \
+           "bandwidth %d %d %d\n" \
+           "router-signature\n" \
+           "-----BEGIN SIGNATURE-----\nAAAA\n-----END SIGNATURE-----\n" % (
+               published, binascii.hexlify(fingerprint).upper(),
+               bandwidth, bandwidth * 2, bandwidth)
+
+  def _consensus(self, valid_after, weights, micro=False):
+    hour = 60 * 60
+    lines = ["@type network-status-consensus-3 1.0",
+             "network-status-version 3", "vote-status consensus"]
+    for keyword, offset in (("valid-after", 0), ("fresh-until", hour),
+                            ("valid-until", 3 * hour)):
+      lines.append("%s %s" % (keyword, time.strftime(
+          "%Y-%m-%d %H:%M:%S", time.gmtime(valid_after + offset))))
+    for (fingerprint, _, bandwidth), weight in zip(self.RELAYS, weights):
+      digest = hashlib.sha1(self._descriptor(
+          fingerprint, bandwidth, "2013-03-06 00:00:00")).digest()
+      identity = base64.b64encode(fingerprint).rstrip("=")
+      lines.append("r relay %s %s2013-03-06 00:00:00 10.0.0.1 9001 0" % (
+          identity, not micro and
+          base64.b64encode(digest).rstrip("=") + " " or ""))
+      lines.append("s Fast Guard Running Valid")
+      lines.append("w Bandwidth=%d" % weight)
+    lines.append("directory-footer")
+    return "\n".join(lines) + "\n"
+
+  def _descriptors(self):
+    return "@type server-descriptor 1.0\n" + "".join(
+        self._descriptor(fingerprint, bandwidth, "2013-03-06 00:00:00")
+        for fingerprint, _, bandwidth in self.RELAYS if bandwidth)
+
+  def test_ranks(self):
+    self._write("consensus-1", self._consensus(
+        1362528000, [relay[1] for relay in self.RELAYS]))
+    self._write("descriptors", self._descriptors())
+    self._write("README", "not a document\n")
+    index = build_index(self.index, [self.archives], 1)
+    self.assertEqual(len(index), 1)
+    self.assertEqual(index.rank(0, "AA" * 20), 0)
+    self.assertEqual(index.rank(0, "bb" * 20), 1)
+    self.assertEqual(index.rank(0, "AA" * 20, True), 1)
+    self.assertEqual(index.rank(0, "BB" * 20, True), 0)
+    # CC has no descriptor, so it isn't ranked.
+    self.assertEqual(index.rank(0, "CC" * 20), None)
+    self.assertEqual(index.rank(0, "DD" * 20), None)
+    self.assertEqual(index.rank(0, "relay"), None)
+
+  def test_valid_at_launch(self):
+    hour = 60 * 60
+    self._write("consensus-1", self._consensus(1362528000, [3, 2, 1]))
+    self._write("consensus-2", self._consensus(1362528000 + hour, [1, 2, 3],
+                                               micro=True))
+    self._write("descriptors", self._descriptors())
+    index = build_index(self.index, [self.archives], 1)
+    self.assertEqual(index.at(1362528000 - 1), None)
+    self.assertEqual(index.at(1362528000 + hour - 1), 0)
+    self.assertEqual(index.at(1362528000 + hour), 1)
+    self.assertEqual(index.at(1362528000 + 4 * hour - 1), 1)
+    self.assertEqual(index.at(1362528000 + 4 * hour), None)
+    self.assertEqual(index.rank(0, "AA" * 20), 0)
+    # Matched to descriptors by fingerprint.
+    self.assertEqual(index.rank(1, "BB" * 20), 0)
+    self.assertEqual(index.rank(1, "AA" * 20), 1)
+    self.assertEqual(index.rank(1, "CC" * 20), None)
+
+  def test_incremental(self):
+    hour = 60 * 60
+    self._write("descriptors", self._descriptors())
+    self._write("consensus-2", self._consensus(1362528000 + hour, [3, 2, 1]))
+    build_index(self.index, [self.archives], 1)
+    with open(os.path.join(self.index, SOURCES)) as sources_file:
+      self.assertEqual(len(json.load(sources_file)), 2)
+    self._write("consensus-1", self._consensus(1362528000, [1, 2, 3]))
+    index = build_index(self.index, [self.archives], 1)
+    self.assertEqual(list(index.valid_after),
+                     [1362528000, 1362528000 + hour])
+    self.assertEqual(index.rank(0, "CC" * 20), None)
+    self.assertEqual(index.rank(0, "BB" * 20), 0)
+    self.assertEqual(index.rank(1, "AA" * 20), 0)
+    # Changing a file starts over, without the files that are gone.
+    os.remove(os.path.join(self.archives, "consensus-2"))
+    index = build_index(self.index, [self.archives], 1)
+    self.assertEqual(list(index.valid_after), [1362528000])
+
+def main():
+  if len(sys.argv) < 3:
+    print("See script header for usage")
+    sys.exit(1)
+  started = time.time()
+  index = build_index(sys.argv[1], sys.argv[2:])
+  print("Indexed %d consensuses with %d relays in %.1f seconds" % (
+      len(index), len(index.relays), time.time() - started))
+
+if __name__ == "__main__":
+  main()
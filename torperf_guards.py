@@ -0,0 +1,216 @@
+#!/usr/bin/python
+#
+# This module ranks the guards that entrycons.py picks as entry nodes, in
+# the order of one of its speed modes: fast and slow by consensus
+# bandwidth, fastratio and slowratio by consensus bandwidth divided by
+# descriptor bandwidth.  Routers only need the idhex, bw, desc_bw, down,
+# and flags attributes of TorCtl routers, so the ranking can be used and
+# tested without TorCtl.
+#
+# Sort keys are computed once per router and kept in a heap, so that
+# taking the best unused guard is O(log n) instead of a sort of the whole
+# consensus.  A router whose key changes after an NS or NEWDESC event is
+# pushed again, and heap entries with outdated keys are skipped when they
+# come up.
+#
+# Usage:
+#   ./torperf_guards.py [routers] [guards taken]
+# compares the time to take the given number of guards (default 100) from
+# a consensus of synthetic routers (default 7000), updating a tenth of the
+# routers between guards, with the heap and with a sort per guard as
+# entrycons.py used to do.
+###
+
+import sys
+import time
+import heapq
+import random
+import unittest
+
+def ratio(router):
+  if not router.desc_bw:
+    return 0.0
+  return router.bw/float(router.desc_bw)
+
+# Sort keys of the speed modes, smallest first.  Ties are broken by
+# consensus bandwidth and then fingerprint, so that the order doesn't
+# depend on the order in which routers were added.
+SPEED_KEYS = {
+  "fast": lambda r: (-r.bw, r.idhex),
+  "slow": lambda r: (r.bw, r.idhex),
+  "fastratio": lambda r: (-ratio(r), -r.bw, r.idhex),
+  "slowratio": lambda r: (ratio(r), -r.bw, r.idhex),
+}
+
+class GuardRanking:
+  """Unused guards in the order of one speed mode."""
+
+  def __init__(self, speed):
+    self.key = SPEED_KEYS[speed]
+    self.keys = {} # idhex -> current key of unused guards
+    self.heap = []
+    self.used = set()
+
+  def eligible(self, router):
+    return not router.down and "Guard" in router.flags
+
+  def rebuild(self, routers):
+    self.keys = {}
+    for r in routers:
+      if r.idhex not in self.used and self.eligible(r):
+        self.keys[r.idhex] = self.key(r)
+    self._heapify()
+
+  def _heapify(self):
+    self.heap = [(key, idhex) for idhex, key in self.keys.iteritems()]
+    heapq.heapify(self.heap)
+
+  def update(self, idhex, router):
+    """Re-ranks a router after an event, or drops it if router is None."""
+    if router is None or idhex in self.used or not self.eligible(router):
+      self.keys.pop(idhex, None)
+      return
+    key = self.key(router)
+    if self.keys.get(idhex) != key:
+      self.keys[idhex] = key
+      heapq.heappush(self.heap, (key, idhex))
+      if len(self.heap) > 2*len(self.keys) + 64:
+        self._heapify()
+
+  def next_unused(self):
+    """Marks the best unused guard as used and returns its idhex, or None
+    if all guards are used."""
+    while self.heap:
+      key, idhex = heapq.heappop(self.heap)
+      if self.keys.get(idhex) == key:
+        del self.keys[idhex]
+        self.used.add(idhex)
+        return idhex
+    return None
+
+  def reset(self, routers):
+    """Forgets which guards were used, looking them up in routers."""
+    used = list(self.used)
+    self.used.clear()
+    for idhex in used:
+      self.update(idhex, routers.get(idhex))
+
+class Router:
+  """The attributes of a TorCtl router that GuardRanking looks at."""
+
+  def __init__(self, idhex, bw, desc_bw, down=False, flags=("Guard", )):
+    self.idhex = idhex
+    self.bw = bw
+    self.desc_bw = desc_bw
+    self.down = down
+    self.flags = list(flags)
+
+def sorted_guards(routers, speed, used=()):
+  """Unused guards of routers in the order of speed, by sorting them."""
+  ranking = GuardRanking(speed)
+  return [r.idhex for r in sorted(routers, key=ranking.key)
+          if r.idhex not in used and ranking.eligible(r)]
+
+class TestGuardRanking(unittest.TestCase):
+
+  def setUp(self):
+    self.routers = dict((r.idhex, r) for r in [
+        Router("A", 300, 1000),
+        Router("B", 200, 100),
+        Router("C", 200, 400),
+        Router("D", 100, 0),
+        Router("E", 500, 500, down=True),
+        Router("F", 400, 100, flags=("Fast", )),
+        Router("G", 100, 50)])
+
+  def _take_all(self, ranking):
+    taken = []
+    idhex = ranking.next_unused()
+    while idhex is not None:
+      taken.append(idhex)
+      idhex = ranking.next_unused()
+    return taken
+
+  def test_speed_modes(self):
+    expected = {"fast": ["A", "B", "C", "D", "G"],
+                "slow": ["D", "G", "B", "C", "A"],
+                "fastratio": ["B", "G", "C", "A", "D"],
+                "slowratio": ["D", "A", "C", "B", "G"]}
+    self.assertEqual(sorted(expected), sorted(SPEED_KEYS))
+    for speed, order in expected.iteritems():
+      ranking = GuardRanking(speed)
+      ranking.rebuild(self.routers.values())
+      self.assertEqual(sorted_guards(self.routers.values(), speed), order)
+      self.assertEqual(self._take_all(ranking), order)
+
+  def test_update(self):
+    ranking = GuardRanking("fast")
+    ranking.rebuild(self.routers.values())
+    self.assertEqual(ranking.next_unused(), "A")
+    # An NS event raises C above B, and a NEWDESC event for the used A
+    # doesn't bring it back.
+    self.routers["C"].bw = 250
+    ranking.update("C", self.routers["C"])
+    ranking.update("A", self.routers["A"])
+    # G lost its Guard flag, and D dropped out of the consensus.
+    self.routers["G"].flags = []
+    ranking.update("G", self.routers["G"])
+    ranking.update("D", None)
+    self.assertEqual(self._take_all(ranking), ["C", "B"])
+    self.assertEqual(ranking.heap, [])
+
+  def test_stale_entries_are_compacted(self):
+    ranking = GuardRanking("fast")
+    ranking.rebuild(self.routers.values())
+    for bw in range(1000, 1200):
+      self.routers["C"].bw = bw
+      ranking.update("C", self.routers["C"])
+    self.assertTrue(len(ranking.heap) <= 2*len(ranking.keys) + 64)
+    self.assertEqual(self._take_all(ranking), ["C", "A", "B", "D", "G"])
+
+  def test_exhaustion_and_reset(self):
+    ranking = GuardRanking("slow")
+    ranking.rebuild(self.routers.values())
+    self.assertEqual(len(self._take_all(ranking)), 5)
+    self.assertEqual(ranking.next_unused(), None)
+    ranking.rebuild(self.routers.values())
+    self.assertEqual(ranking.next_unused(), None)
+    del self.routers["A"]
+    ranking.reset(self.routers)
+    self.assertEqual(ranking.used, set())
+    self.assertEqual(self._take_all(ranking), ["D", "G", "B", "C"])
+
+def main():
+  routers = int(sys.argv[1]) if len(sys.argv) > 1 else 7000
+  taken = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+  rand = random.Random(1)
+  consensus = [Router("%040X" % i, rand.randint(1, 100000),
+                      rand.randint(0, 100000),
+                      flags=rand.random() < 0.3 and ("Guard", ) or ())
+               for i in range(routers)]
+  updates = [[rand.choice(consensus) for _ in range(routers // 10)]
+             for _ in range(taken)]
+  bandwidths = [r.bw for r in consensus]
+  for speed in sorted(SPEED_KEYS):
+    for method in ("heap", "sort"):
+      for r, bw in zip(consensus, bandwidths):
+        r.bw = bw
+      ranking = GuardRanking(speed)
+      started = time.time()
+      ranking.rebuild(consensus)
+      picked = []
+      for batch in updates:
+        for r in batch:
+          r.bw += 1
+          if method == "heap":
+            ranking.update(r.idhex, r)
+        if method == "heap":
+          picked.append(ranking.next_unused())
+        else:
+          picked.append(sorted_guards(consensus, speed, picked)[0])
+      print("%-9s %-4s %8.3f s for %d guards" % (speed, method,
+                                                 time.time() - started,
+                                                 taken))
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,268 @@
+#!/usr/bin/python
+#
+# This script writes the lines that were appended to Torperf .data or
+# .extradata files since it last ran, and this module provides the reader
+# that remembers how far each file has been read, so that analysis scripts
+# like metrics/filter.py can process new lines only.
+#
+# A checkpoint records the inode, size, and processed offset of a file and
+# the last line that was processed.  Lines are only processed once they
+# end in a newline, so a line that Torperf is still writing is left for
+# the next run.  When the inode changes, the file shrinks, or the last
+# processed line isn't where it was, the file was rewritten, e.g. by
+# truncate-data.py.  Since that keeps the newest lines of the old file,
+# reading resumes after the last processed line if it is still in the
+# rewritten file, and at the beginning otherwise.
+#
+# Files that truncate-data.py or extra_stats.py rotated into segments, see
+# torperf_segments.py, are followed: reading continues in the segment that
+# has the checkpointed inode and goes on with the newer segments and the
+# file itself.  Without a checkpoint, all segments are read.
+#
+# Checkpoints of all files are kept in one JSON file that is replaced
+# atomically.  Callers save them after writing their output, so a crash
+# in between processes some lines twice rather than never.
+#
+# Usage:
+#   ./torperf_ingest.py <checkpoint file> <.data or .extradata file(s)>
+###
+
+import os
+import sys
+import json
+import errno
+import unittest
+import tempfile
+import shutil
+
+from torperf_segments import segment_paths
+
+class Checkpoints:
+  """Checkpoints of any number of files by path, kept in a JSON file."""
+
+  def __init__(self, path):
+    self.path = path
+    try:
+      with open(path) as checkpoints_file:
+        self._checkpoints = json.load(checkpoints_file)
+    except IOError, e:
+      if e.errno != errno.ENOENT:
+        raise
+      self._checkpoints = {}
+
+  def get(self, name):
+    return self._checkpoints.get(os.path.abspath(name))
+
+  def set(self, name, checkpoint):
+    self._checkpoints[os.path.abspath(name)] = checkpoint
+
+  def save(self):
+    temp_path = self.path + ".tmp"
+    with open(temp_path, "w") as checkpoints_file:
+      json.dump(self._checkpoints, checkpoints_file, indent=1,
+                sort_keys=True)
+      checkpoints_file.flush()
+      os.fsync(checkpoints_file.fileno())
+    os.rename(temp_path, self.path)
+
+class IncrementalFile:
+  """The complete lines of an append-only file, and of its segments, that
+  come after a checkpoint.  After iterating over all lines(), checkpoint is
+  the one to save, rotated tells whether reading continued in a segment,
+  rewritten whether the file was rewritten since the old checkpoint, and
+  resumed whether the last processed line was found in the rewritten file.
+  If it wasn't, lines that were appended before the rewrite may never have
+  been processed."""
+
+  def __init__(self, path, checkpoint=None):
+    self.path = path
+    self.checkpoint = checkpoint
+    self.rotated = False
+    self.rewritten = False
+    self.resumed = False
+
+  def _unchanged(self, path):
+    checkpoint = self.checkpoint
+    offset = checkpoint["offset"]
+    last = checkpoint["last"]
+    with open(path, "rb") as f:
+      stat = os.fstat(f.fileno())
+      if stat.st_ino != checkpoint["inode"] or stat.st_size < offset:
+        return False
+      # A new file that is still empty has no last line to compare.
+      if last is None or offset < len(last):
+        return True
+      f.seek(offset - len(last))
+      return f.read(len(last)) == last
+
+  def _locate(self, paths):
+    """The index of the file in paths and the offset to continue at."""
+    for index, path in enumerate(paths):
+      if self._unchanged(path):
+        self.rotated = index < len(paths) - 1
+        return index, self.checkpoint["offset"]
+    self.rewritten = True
+    last = self.checkpoint["last"]
+    if last is not None:
+      for index, path in enumerate(paths):
+        offset = 0
+        with open(path, "rb") as f:
+          for line in f:
+            offset += len(line)
+            if line == last:
+              self.resumed = True
+              return index, offset
+    return 0, 0
+
+  def lines(self):
+    paths = segment_paths(self.path) or [self.path]
+    index, offset = 0, 0
+    last = None
+    if self.checkpoint:
+      last = self.checkpoint["last"]
+      index, offset = self._locate(paths)
+    for path in paths[index:]:
+      # The last line is that of the file the offset is in.
+      if not offset:
+        last = None
+      with open(path, "rb") as f:
+        stat = os.fstat(f.fileno())
+        f.seek(offset)
+        for line in f:
+          if not line.endswith("\n"):
+            break
+          offset += len(line)
+          last = line
+          yield line
+      self.checkpoint = {"inode": stat.st_ino, "size": stat.st_size,
+                         "offset": offset, "last": last}
+      offset = 0
+
+class TestIncrementalFile(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.path = os.path.join(self.directory, "torperf-50kb.data")
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def _append(self, text):
+    with open(self.path, "a") as f:
+      f.write(text)
+
+  def _rewrite(self, text):
+    # Like truncate-data.py, write a new file and rename it over the old.
+    with open(self.path + ".bak", "w") as f:
+      f.write(text)
+    os.rename(self.path + ".bak", self.path)
+
+  def _read(self, checkpoint):
+    incremental = IncrementalFile(self.path, checkpoint)
+    return list(incremental.lines()), incremental
+
+  def test_append(self):
+    self._append("1 a\n2 b\n3 c")
+    lines, incremental = self._read(None)
+    self.assertEqual(lines, ["1 a\n", "2 b\n"])
+    self.assertEqual(incremental.checkpoint["offset"], 8)
+    self.assertEqual(incremental.checkpoint["size"], 11)
+    self._append("\n4 d\n")
+    lines, incremental = self._read(incremental.checkpoint)
+    self.assertEqual(lines, ["3 c\n", "4 d\n"])
+    self.assertFalse(incremental.rewritten)
+    lines, incremental = self._read(incremental.checkpoint)
+    self.assertEqual(lines, [])
+    self.assertEqual(incremental.checkpoint["offset"], 16)
+
+  def test_truncated(self):
+    self._append("1 a\n2 b\n3 c\n")
+    _, incremental = self._read(None)
+    self._append("4 d\n")
+    self._rewrite("2 b\n3 c\n4 d\n5 e\n")
+    lines, incremental = self._read(incremental.checkpoint)
+    self.assertEqual(lines, ["4 d\n", "5 e\n"])
+    self.assertTrue(incremental.rewritten)
+    self.assertTrue(incremental.resumed)
+    self.assertEqual(incremental.checkpoint["offset"], 16)
+    lines, incremental = self._read(incremental.checkpoint)
+    self.assertEqual(lines, [])
+    self.assertFalse(incremental.rewritten)
+
+  def test_truncated_past_checkpoint(self):
+    self._append("1 a\n2 b\n")
+    _, incremental = self._read(None)
+    self._rewrite("7 g\n8 h\n9 i\n")
+    lines, incremental = self._read(incremental.checkpoint)
+    self.assertEqual(lines, ["7 g\n", "8 h\n", "9 i\n"])
+    self.assertTrue(incremental.rewritten)
+    self.assertFalse(incremental.resumed)
+
+  def test_rewritten_in_place(self):
+    self._append("1 a\n2 b\n")
+    _, incremental = self._read(None)
+    with open(self.path, "r+") as f:
+      f.write("5 e\n6 f\n7 g\n")
+    lines, incremental = self._read(incremental.checkpoint)
+    self.assertEqual(lines, ["5 e\n", "6 f\n", "7 g\n"])
+    self.assertTrue(incremental.rewritten)
+
+  def test_rotated(self):
+    self._append("1 a\n")
+    _, incremental = self._read(None)
+    self._append("2 b\n")
+    os.rename(self.path, self.path + ".2013-03-06-000000")
+    self._append("3 c\n")
+    lines, incremental = self._read(incremental.checkpoint)
+    self.assertEqual(lines, ["2 b\n", "3 c\n"])
+    self.assertTrue(incremental.rotated)
+    self.assertFalse(incremental.rewritten)
+    self.assertEqual(self._read(None)[0], ["1 a\n", "2 b\n", "3 c\n"])
+    # Rotated again, and nothing written yet.
+    os.rename(self.path, self.path + ".2013-03-07-000000")
+    lines, incremental = self._read(incremental.checkpoint)
+    self.assertEqual(lines, [])
+    self.assertFalse(incremental.rewritten)
+
+  def test_rotated_to_empty_file(self):
+    # cron's >> creates the new file before anything is written to it.
+    self._append("1 a\n")
+    _, incremental = self._read(None)
+    os.rename(self.path, self.path + ".2013-03-06-000000")
+    self._append("")
+    lines, incremental = self._read(incremental.checkpoint)
+    self.assertEqual(lines, [])
+    self.assertEqual(incremental.checkpoint["offset"], 0)
+    self.assertEqual(incremental.checkpoint["last"], None)
+    self._append("2 b\n")
+    lines, incremental = self._read(incremental.checkpoint)
+    self.assertEqual(lines, ["2 b\n"])
+    self.assertFalse(incremental.rewritten)
+
+  def test_checkpoints(self):
+    self._append("1 a\n")
+    checkpoints = Checkpoints(os.path.join(self.directory, "checkpoints"))
+    self.assertEqual(checkpoints.get(self.path), None)
+    _, incremental = self._read(None)
+    checkpoints.set(self.path, incremental.checkpoint)
+    checkpoints.save()
+    checkpoints = Checkpoints(checkpoints.path)
+    self.assertEqual(checkpoints.get(self.path)["last"], "1 a\n")
+
+def main():
+  if len(sys.argv) < 3:
+    print("See script header for usage")
+    sys.exit(1)
+  checkpoints = Checkpoints(sys.argv[1])
+  for path in sys.argv[2:]:
+    incremental = IncrementalFile(path, checkpoints.get(path))
+    sys.stdout.writelines(incremental.lines())
+    if incremental.rewritten and not incremental.resumed:
+      print >>sys.stderr, "%s was rewritten past the last line read, some " \
+                          "lines may have been missed" % path
+    checkpoints.set(path, incremental.checkpoint)
+  sys.stdout.flush()
+  checkpoints.save()
+
+if __name__ == "__main__":
+  main()
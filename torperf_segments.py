@@ -0,0 +1,327 @@
+#!/usr/bin/python
+#
+# This module rotates Torperf .data and .extradata files into segments
+# instead of truncating them, for truncate-data.py and extra_stats.py.
+#
+# Writers append to the file itself.  Once its first line is a day old,
+# the file is renamed to a segment named after the UTC time of that line,
+# e.g. 50kb.data.2013-03-06-101500, and the next line starts a new file.
+# Segments are deleted as a whole once the segment after them started
+# more than 4 days ago, so that all lines of the past 4 days are kept.
+# Nothing is ever copied, and a write only compares the time to the start
+# times of the file and of its oldest segments, which are kept in memory.
+#
+# Readers get all lines that are kept from segment_lines(path), which reads
+# segment_paths(path) in order, and unsegmented(path) names the file a
+# segment belongs to.  Scripts that take file names drop segments of files
+# they are given, too, with without_segments(paths), so that shell globs
+# like 50kb.data* don't read segments twice.  torperf_ingest.py follows
+# rotated files on its own.
+#
+# Lines can also be buffered and written together once the oldest of them
+# is flush_seconds old, so that busy writers don't make a system call per
+# line.  Only whole lines are written.  fsync says when data is synced to
+# disk: never (leave it to the OS), after every flush, or when a segment
+# or the file is closed.
+###
+
+import os
+import re
+import time
+import calendar
+import threading
+import collections
+import unittest
+import tempfile
+import shutil
+
+SEGMENT_FORMAT = "%Y-%m-%d-%H%M%S"
+SEGMENT_RE = re.compile(r"^\.(\d{4}-\d\d-\d\d-\d{6})$")
+# Also matches segments named after a day only, e.g. 50kb.data.2013-03-05.
+SEGMENT_SUFFIX_RE = re.compile(r"\.\d{4}-\d\d-\d\d(?:-\d{6})?$")
+
+SEGMENT_SECONDS = 24 * 60 * 60
+RETENTION_SECONDS = 4 * 24 * 60 * 60
+
+# Lines buffered at most, no matter how old.
+MAX_BUFFERED = 1000
+
+FSYNC_POLICIES = ("never", "flush", "close")
+
+LAUNCH_RE = re.compile(r"LAUNCH=(\d+)")
+
+def data_timestamp(line):
+  """START of a .data line, or None for an empty line.  Raises ValueError
+  if the line doesn't start with a number."""
+  fields = line.split(None, 1)
+  if not fields:
+    return None
+  return int(fields[0])
+
+def extradata_timestamp(line):
+  """LAUNCH of an .extradata line, or None if it has none."""
+  m = LAUNCH_RE.search(line)
+  if m:
+    return int(m.group(1))
+  return None
+
+def segments(path):
+  """(start, path) of the segments of a file, oldest first."""
+  directory = os.path.dirname(path) or "."
+  prefix = os.path.basename(path)
+  found = []
+  for name in os.listdir(directory):
+    if not name.startswith(prefix):
+      continue
+    m = SEGMENT_RE.match(name[len(prefix):])
+    if m:
+      found.append((calendar.timegm(time.strptime(m.group(1),
+                                                  SEGMENT_FORMAT)),
+                    os.path.join(directory, name)))
+  return sorted(found)
+
+def segment_paths(path):
+  """Paths of the segments of a file and of the file itself, if it
+  exists, in the order their lines were written."""
+  paths = [segment for _, segment in segments(path)]
+  if os.path.exists(path):
+    paths.append(path)
+  return paths
+
+def segment_lines(path):
+  """Lines of the segments of a file and of the file itself, in the order
+  they were written.  A path without segments is read as it is, so that
+  readers fail as before if it doesn't exist."""
+  for segment in segment_paths(path) or [path]:
+    with open(segment) as f:
+      for line in f:
+        yield line
+
+def unsegmented(path):
+  """Path of the file a segment was rotated from, or path itself if it
+  isn't a segment."""
+  return SEGMENT_SUFFIX_RE.sub("", path)
+
+def without_segments(paths):
+  """paths without the segments of other paths in it, which are read
+  together with those."""
+  given = set(paths)
+  kept = []
+  for path in paths:
+    original = unsegmented(path)
+    if original == path or original not in given or \
+       not SEGMENT_RE.match(path[len(original):]):
+      kept.append(path)
+  return kept
+
+class SegmentedFile:
+  """A file that is rotated into segments of segment_seconds, measured
+  from the timestamp of their first line, and whose segments are deleted
+  retention_seconds after the next segment started.  timestamp returns the
+  timestamp of a line in seconds, or None if the line has none.  With
+  segment_seconds of None the file is never rotated.
+
+  Lines are written right away if flush_seconds is 0, and buffered for up
+  to flush_seconds otherwise.  Since nothing is written without a call,
+  callers that buffer call flush() with due_only set regularly.  Methods
+  may be called from different threads."""
+
+  def __init__(self, path, timestamp, segment_seconds=SEGMENT_SECONDS,
+               retention_seconds=RETENTION_SECONDS, flush_seconds=0,
+               fsync="never"):
+    if fsync not in FSYNC_POLICIES:
+      raise ValueError("fsync must be one of %s, not %s" %
+                       (", ".join(FSYNC_POLICIES), fsync))
+    self.path = path
+    self._timestamp = timestamp
+    self.segment_seconds = segment_seconds
+    self.retention_seconds = retention_seconds
+    self.flush_seconds = flush_seconds
+    self.fsync = fsync
+    self._segments = collections.deque()
+    if segment_seconds is not None:
+      self._segments.extend(segments(path))
+    self._file = None
+    self._buffered = []
+    self._buffered_since = None
+    self._lock = threading.Lock()
+    self._started = self._first_timestamp()
+
+  def _first_timestamp(self):
+    if not os.path.exists(self.path):
+      return None
+    with open(self.path) as f:
+      for line in f:
+        started = self._timestamp(line)
+        if started is not None:
+          return started
+    return None
+
+  def _flush(self):
+    if self._buffered:
+      if not self._file:
+        # Unbuffered, so that each flush is one write of whole lines.
+        self._file = open(self.path, "a", 0)
+      self._file.write("".join(self._buffered))
+      self._buffered = []
+      self._buffered_since = None
+      if self.fsync == "flush":
+        os.fsync(self._file.fileno())
+
+  def _close(self):
+    self._flush()
+    if self._file:
+      if self.fsync != "never":
+        os.fsync(self._file.fileno())
+      self._file.close()
+      self._file = None
+
+  def _rotate(self):
+    self._close()
+    started = self._started
+    segment = self.path + "." + time.strftime(SEGMENT_FORMAT,
+                                              time.gmtime(started))
+    while os.path.exists(segment):
+      started += 1
+      segment = self.path + "." + time.strftime(SEGMENT_FORMAT,
+                                                time.gmtime(started))
+    os.rename(self.path, segment)
+    self._segments.append((started, segment))
+    self._started = None
+
+  def maintain(self, now=None):
+    """Rotates the file and deletes expired segments if it's time to."""
+    if now is None:
+      now = time.time()
+    with self._lock:
+      self._maintain(now)
+
+  def _maintain(self, now):
+    if self.segment_seconds is None:
+      return
+    if self._started is not None and \
+       now >= self._started + self.segment_seconds:
+      self._rotate()
+    while self._segments:
+      if len(self._segments) > 1:
+        ended = self._segments[1][0]
+      else:
+        ended = self._started
+      if ended is None or now < ended + self.retention_seconds:
+        break
+      os.remove(self._segments.popleft()[1])
+
+  def write(self, line, now=None):
+    """Appends a line, which must end in a newline."""
+    if now is None:
+      now = time.time()
+    with self._lock:
+      self._maintain(now)
+      if self._started is None:
+        self._started = self._timestamp(line)
+        if self._started is None:
+          self._started = int(now)
+      self._buffered.append(line)
+      if self._buffered_since is None:
+        self._buffered_since = now
+      if not self.flush_seconds or len(self._buffered) >= MAX_BUFFERED or \
+         now >= self._buffered_since + self.flush_seconds:
+        self._flush()
+
+  def flush(self, now=None, due_only=False):
+    """Writes buffered lines, or with due_only only if the oldest of them
+    is flush_seconds old."""
+    if now is None:
+      now = time.time()
+    with self._lock:
+      if not due_only or self._buffered_since is not None and \
+         now >= self._buffered_since + self.flush_seconds:
+        self._flush()
+
+  def close(self):
+    """Writes buffered lines and closes the file."""
+    with self._lock:
+      self._close()
+
+class TestSegmentedFile(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.path = os.path.join(self.directory, "50kb.data")
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def _names(self):
+    return [os.path.basename(path) for path in segment_paths(self.path)]
+
+  def test_rotate_and_expire(self):
+    day = calendar.timegm((2013, 3, 6, 10, 15, 0))
+    segmented = SegmentedFile(self.path, data_timestamp)
+    for hours in range(0, 24 * 7, 6):
+      now = day + hours * 3600
+      segmented.write("%d 0 1 2\n" % now, now)
+    segmented.close()
+    names = self._names()
+    self.assertEqual(names[0], "50kb.data.2013-03-08-101500")
+    self.assertEqual(names[-2:], ["50kb.data.2013-03-11-101500",
+                                  "50kb.data"])
+    lines = list(segment_lines(self.path))
+    self.assertEqual(lines[-1], "%d 0 1 2\n" % (day + 162 * 3600))
+    self.assertEqual(len(lines), 5 * 4)
+
+  def test_restart(self):
+    day = calendar.timegm((2013, 3, 6, 0, 0, 0))
+    with open(self.path, "w") as f:
+      f.write("\n%d 0\n" % day)
+    SegmentedFile(self.path, data_timestamp).maintain(day + 86399)
+    self.assertEqual(self._names(), ["50kb.data"])
+    SegmentedFile(self.path, data_timestamp).maintain(day + 86400)
+    self.assertEqual(self._names(), ["50kb.data.2013-03-06-000000"])
+
+  def test_buffered(self):
+    segmented = SegmentedFile(self.path, data_timestamp, None,
+                              flush_seconds=5, fsync="flush")
+    segmented.write("1 a\n", 100)
+    segmented.write("2 b\n", 104)
+    self.assertFalse(os.path.exists(self.path))
+    segmented.flush(104.5, due_only=True)
+    self.assertFalse(os.path.exists(self.path))
+    segmented.write("3 c\n", 105)
+    self.assertEqual(open(self.path).read(), "1 a\n2 b\n3 c\n")
+    segmented.write("4 d\n", 106)
+    segmented.flush(111, due_only=True)
+    segmented.write("5 e\n", 200000)
+    segmented.close()
+    self.assertEqual(self._names(), ["50kb.data"])
+    self.assertEqual(len(open(self.path).readlines()), 5)
+    for line in range(MAX_BUFFERED):
+      segmented.write("%d x\n" % line, 300000)
+    self.assertEqual(len(open(self.path).readlines()), 5 + MAX_BUFFERED)
+    self.assertRaises(ValueError, SegmentedFile, self.path, data_timestamp,
+                      fsync="sometimes")
+
+  def test_extradata_timestamp(self):
+    self.assertEqual(extradata_timestamp("BUILDTIMEOUT_SET COMPUTED"), None)
+    self.assertEqual(extradata_timestamp("CIRC_ID=7 LAUNCH=1362528000.25 "
+                                         "PATH=$A"), 1362528000)
+
+  def test_segment_lines(self):
+    self.assertRaises(IOError, list, segment_lines(self.path))
+    with open(self.path + ".2013-03-06-101500", "w") as f:
+      f.write("1 a\n")
+    self.assertEqual(list(segment_lines(self.path)), ["1 a\n"])
+    with open(self.path, "w") as f:
+      f.write("2 b\n")
+    self.assertEqual(list(segment_lines(self.path)), ["1 a\n", "2 b\n"])
+
+  def test_without_segments(self):
+    paths = ["50kb.data.2013-03-06-101500", "50kb.data.2013-03-05",
+             "50kb.data", "1mb.data.2013-03-06-101500"]
+    self.assertEqual(without_segments(paths), paths[1:])
+
+  def test_unsegmented(self):
+    for name in ("50kb.data", "50kb.data.2013-03-06-101500",
+                 "50kb.data.2013-03-05"):
+      self.assertEqual(unsegmented(os.path.join("t", name)),
+                       os.path.join("t", "50kb.data"))
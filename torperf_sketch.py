@@ -0,0 +1,419 @@
+#!/usr/bin/python
+#
+# This script adds Torperf .data files to a directory of completion time
+# sketches, one file per day, and prints quantiles from them, and this
+# module provides the sketch.
+#
+# A sketch is a histogram of logarithmically sized buckets: bucket i holds
+# the values in (gamma^(i-1), gamma^i], with gamma = (1 + e) / (1 - e) for
+# a relative error e (default 1%).  Quantiles are estimated from the
+# bucket that holds them and are within e of the true values, no matter
+# how many values were added.  Sketches with the same relative error are
+# merged by adding their bucket counts, so sketches of different files,
+# Torperf hosts, and days can be combined into one.
+#
+# Sketches are kept for completemillis (milliseconds from START to
+# DATACOMPLETE of requests that completed, as in metrics/filter.R) and the
+# milliseconds from START to each DATAPERC timestamp.  They are grouped by
+# guards and file size, taken from the .data file name as in filter.R, by
+# -source (default: this host's name), and by the UTC day of START.  Each
+# day is a JSON file in the sketch directory.  With -state=FILE, only lines
+# appended since the last run are added, see torperf_ingest.py; without
+# it, a file is read together with the segments truncate-data.py rotated it
+# into, and adding a file twice counts its requests twice.  Segments of
+# files that are given too are skipped.
+#
+# Usage:
+#   ./torperf_sketch.py add [-source=NAME] [-state=FILE] <sketch directory>
+#       <guard-filesize.data file(s)>
+#   ./torperf_sketch.py query <sketch directory> <metric> <first day>
+#       <last day> [guards=GUARDS] [filesize=SIZE] [source=NAME]
+#
+# eg: ./torperf_sketch.py add sketches torperf-50kb.data torperf-1mb.data
+# eg: ./torperf_sketch.py query sketches completemillis 2013-03-01
+#       2013-03-31 filesize=50kb
+###
+
+import os
+import sys
+import math
+import time
+import json
+import errno
+import socket
+import calendar
+import unittest
+import tempfile
+import shutil
+
+import numpy
+
+from torperf_archive import TorperfFile, DATA_PERCENTILES, load_data
+from torperf_archive import load_data_lines
+from torperf_ingest import Checkpoints, IncrementalFile
+from torperf_segments import without_segments
+
+METRICS = ["completemillis"] + DATA_PERCENTILES
+QUANTILES = [0.5, 0.9, 0.99]
+
+class LogHistogram:
+  """A mergeable sketch of positive values with relative error e.  Values
+  of 0 or less are counted separately and come out as 0."""
+
+  def __init__(self, relative_error=0.01):
+    self.relative_error = relative_error
+    self._gamma = (1 + relative_error) / (1 - relative_error)
+    self._log_gamma = math.log(self._gamma)
+    self.buckets = {}
+    self.zeros = 0
+    self.count = 0
+    self.total = 0.0
+    self.min = None
+    self.max = None
+
+  def _bucket(self, value):
+    return int(math.ceil(math.log(value) / self._log_gamma))
+
+  def _value(self, bucket):
+    # The value with the same relative error to both ends of the bucket.
+    return 2 * self._gamma ** bucket / (self._gamma + 1)
+
+  def add(self, value, count=1):
+    if value > 0:
+      bucket = self._bucket(value)
+      self.buckets[bucket] = self.buckets.get(bucket, 0) + count
+    else:
+      self.zeros += count
+    self._count(count, value * count, value, value)
+
+  def update(self, values):
+    """Adds a NumPy array of values at once."""
+    values = numpy.asarray(values, dtype=numpy.float64)
+    if not len(values):
+      return
+    positive = values[values > 0]
+    buckets, counts = numpy.unique(
+        numpy.ceil(numpy.log(positive) / self._log_gamma).astype(numpy.int64),
+        return_counts=True)
+    for bucket, count in zip(buckets.tolist(), counts.tolist()):
+      self.buckets[bucket] = self.buckets.get(bucket, 0) + count
+    self.zeros += len(values) - len(positive)
+    self._count(len(values), float(values.sum()), float(values.min()),
+                float(values.max()))
+
+  def _count(self, count, total, low, high):
+    self.count += count
+    self.total += total
+    if self.min is None or low < self.min:
+      self.min = low
+    if self.max is None or high > self.max:
+      self.max = high
+
+  def merge(self, other):
+    if other.relative_error != self.relative_error:
+      raise ValueError("Cannot merge sketches with relative errors %s and %s"
+                       % (self.relative_error, other.relative_error))
+    for bucket, count in other.buckets.iteritems():
+      self.buckets[bucket] = self.buckets.get(bucket, 0) + count
+    self.zeros += other.zeros
+    if other.count:
+      self._count(other.count, other.total, other.min, other.max)
+    return self
+
+  def quantile(self, q):
+    """The value at rank floor(q * (count - 1)) of the sorted values, within
+    the relative error, or None if no values were added."""
+    if not self.count:
+      return None
+    rank = int(q * (self.count - 1))
+    if rank < self.zeros:
+      return 0.0
+    seen = self.zeros
+    for bucket in sorted(self.buckets):
+      seen += self.buckets[bucket]
+      if seen > rank:
+        # Never outside the values that were actually added.
+        return min(max(self._value(bucket), self.min), self.max)
+
+  def mean(self):
+    if not self.count:
+      return None
+    return self.total / self.count
+
+  def to_json(self):
+    buckets = sorted(self.buckets)
+    return {"relative_error": self.relative_error, "zeros": self.zeros,
+            "count": self.count, "total": self.total, "min": self.min,
+            "max": self.max, "buckets": buckets,
+            "counts": [self.buckets[bucket] for bucket in buckets]}
+
+  @classmethod
+  def from_json(cls, sketch):
+    histogram = cls(sketch["relative_error"])
+    histogram.buckets = dict(zip(sketch["buckets"], sketch["counts"]))
+    histogram.zeros = sketch["zeros"]
+    histogram.count = sketch["count"]
+    histogram.total = sketch["total"]
+    histogram.min = sketch["min"]
+    histogram.max = sketch["max"]
+    return histogram
+
+def merge_groups(groups, sketches):
+  """Merges {group: {metric: LogHistogram}} into groups of the same kind."""
+  for group, metrics in sketches.iteritems():
+    merged = groups.setdefault(group, {})
+    for metric, sketch in metrics.iteritems():
+      if metric in merged:
+        merged[metric].merge(sketch)
+      else:
+        merged[metric] = sketch
+
+class SketchStore:
+  """Sketches by day, group, and metric, in one JSON file per day.  Groups
+  are (guards, filesize, source) tuples."""
+
+  def __init__(self, path, relative_error=0.01):
+    self.path = path
+    self.relative_error = relative_error
+    if not os.path.isdir(path):
+      os.makedirs(path)
+
+  def _day_path(self, day):
+    return os.path.join(self.path, day + ".json")
+
+  def load(self, day):
+    """{group: {metric: LogHistogram}} of a day given as YYYY-MM-DD."""
+    try:
+      with open(self._day_path(day)) as day_file:
+        groups = json.load(day_file)
+    except IOError, e:
+      if e.errno != errno.ENOENT:
+        raise
+      return {}
+    return dict([(tuple(group.split("/")),
+                  dict([(str(metric), LogHistogram.from_json(sketch))
+                        for metric, sketch in metrics.iteritems()]))
+                 for group, metrics in groups.iteritems()])
+
+  def add(self, day, sketches):
+    """Merges {group: {metric: LogHistogram}} into the sketches of a day."""
+    groups = self.load(day)
+    merge_groups(groups, sketches)
+    temp_path = self._day_path(day) + ".tmp"
+    with open(temp_path, "w") as day_file:
+      json.dump(dict([("/".join(group),
+                       dict([(metric, sketch.to_json())
+                             for metric, sketch in metrics.iteritems()]))
+                      for group, metrics in groups.iteritems()]),
+                day_file, sort_keys=True)
+    os.rename(temp_path, self._day_path(day))
+
+  def days(self, first, last):
+    """Days from first to last, both YYYY-MM-DD, that have sketches."""
+    return sorted([name[:-len(".json")] for name in os.listdir(self.path)
+                   if name.endswith(".json") and
+                      first <= name[:-len(".json")] <= last])
+
+  def query(self, day, metric, guards=None, filesize=None, source=None):
+    """The merged sketch of a metric of all groups of a day that match the
+    given guards, file size, and source."""
+    merged = LogHistogram(self.relative_error)
+    for group, metrics in self.load(day).iteritems():
+      if guards not in (None, group[0]) or filesize not in (None, group[1]) \
+         or source not in (None, group[2]) or metric not in metrics:
+        continue
+      merged.merge(metrics[metric])
+    return merged
+
+def sketch_columns(columns, filesize, group, relative_error=0.01):
+  """{day: {group: {metric: LogHistogram}}} of .data columns as returned by
+  load_data()."""
+  start = columns["START"]
+  complete = columns["DATACOMPLETE"]
+  days = start // 1000000 // 86400
+  done = (complete // 1000000 > 0) & (columns["READBYTES"] >= filesize)
+  sketches = {}
+  for day in numpy.unique(days).tolist():
+    metrics = {}
+    on_day = days == day
+    for metric in METRICS:
+      if metric == "completemillis":
+        chosen = on_day & done
+        values = complete[chosen] - start[chosen]
+      else:
+        chosen = on_day & (columns[metric] > 0)
+        values = columns[metric][chosen] - start[chosen]
+      if len(values):
+        metrics[metric] = LogHistogram(relative_error)
+        metrics[metric].update(values / 1000.0)
+    if metrics:
+      date = time.strftime("%Y-%m-%d", time.gmtime(day * 86400))
+      sketches[date] = {group: metrics}
+  return sketches
+
+class TestLogHistogram(unittest.TestCase):
+
+  def _check(self, histogram, values):
+    values = sorted(values)
+    for q in (0.0, 0.01, 0.1, 0.25, 0.5, 0.75, 0.9, 0.99, 0.999, 1.0):
+      exact = values[int(q * (len(values) - 1))]
+      estimate = histogram.quantile(q)
+      self.assertTrue(abs(estimate - exact) <= exact *
+                      histogram.relative_error + 1e-9,
+                      "q=%s: %s vs %s" % (q, estimate, exact))
+
+  def test_relative_error(self):
+    random = numpy.random.RandomState(2563)
+    values = random.lognormal(8, 1.5, 20000)
+    for relative_error in (0.01, 0.05):
+      one_by_one = LogHistogram(relative_error)
+      for value in values[:2000]:
+        one_by_one.add(value)
+      self._check(one_by_one, values[:2000])
+      at_once = LogHistogram(relative_error)
+      at_once.update(values)
+      self._check(at_once, values)
+
+  def test_merge(self):
+    random = numpy.random.RandomState(1919)
+    parts = [random.exponential(3000, 5000), random.exponential(60000, 500),
+             numpy.zeros(10)]
+    merged = LogHistogram()
+    for part in parts:
+      histogram = LogHistogram()
+      histogram.update(part)
+      merged.merge(LogHistogram.from_json(
+          json.loads(json.dumps(histogram.to_json()))))
+    whole = LogHistogram()
+    whole.update(numpy.concatenate(parts))
+    self.assertEqual(merged.buckets, whole.buckets)
+    self.assertEqual((merged.count, merged.zeros, merged.min, merged.max),
+                     (5510, 10, 0.0, whole.max))
+    self.assertAlmostEqual(merged.mean(), whole.mean())
+    self._check(merged, numpy.concatenate(parts))
+    self.assertRaises(ValueError, merged.merge, LogHistogram(0.05))
+
+  def test_empty(self):
+    histogram = LogHistogram()
+    histogram.update([])
+    self.assertEqual(histogram.quantile(0.5), None)
+    self.assertEqual(histogram.mean(), None)
+
+class TestSketchStore(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def test_add_and_query(self):
+    day = calendar.timegm((2013, 3, 6, 0, 0, 0)) * 1000000
+    start = numpy.array([day, day + 1000000, day + 86400000000])
+    columns = {"START": start,
+               "DATACOMPLETE": numpy.where(start < day + 86400000000,
+                                           start + [2500000, 4000000, 0], 0),
+               "READBYTES": numpy.array([51200, 51200, 0])}
+    for name in DATA_PERCENTILES:
+      columns[name] = numpy.where(columns["DATACOMPLETE"] > 0, start + 1000,
+                                  0)
+    store = SketchStore(os.path.join(self.directory, "sketches"))
+    for source in ("a", "b"):
+      sketches = sketch_columns(columns, 51200, ("torperf", "50kb", source))
+      self.assertEqual(sorted(sketches), ["2013-03-06"])
+      for date, groups in sketches.iteritems():
+        store.add(date, groups)
+    self.assertEqual(store.days("2013-03-01", "2013-03-31"), ["2013-03-06"])
+    sketch = store.query("2013-03-06", "completemillis", filesize="50kb")
+    self.assertEqual(sketch.count, 4)
+    self.assertAlmostEqual(sketch.quantile(0), 2500, delta=25)
+    self.assertAlmostEqual(sketch.quantile(1), 4000, delta=40)
+    self.assertEqual(store.query("2013-03-06", "DATAPERC50", source="a").max,
+                     1.0)
+    self.assertEqual(store.query("2013-03-06", "completemillis",
+                                 guards="torperffast").count, 0)
+
+  def test_add_files_of_same_group(self):
+    line = " ".join(["1362528000 250000"] + ["0 0"] * 7 +
+                     ["1362528003 999999", "75 51375 0"]) + "\n"
+    paths = []
+    for host in ("hostA", "hostB"):
+      os.makedirs(os.path.join(self.directory, host))
+      paths.append(os.path.join(self.directory, host, "torperf-50kb.data"))
+      with open(paths[-1], "w") as data_file:
+        data_file.write(line)
+    # hostA's file was rotated once, and a glob names the segment, too.
+    paths.append(paths[0] + ".2013-03-06-000000")
+    with open(paths[-1], "w") as segment_file:
+      segment_file.write(line)
+    sketches = os.path.join(self.directory, "sketches")
+    add(["-source=a", sketches] + paths)
+    sketch = SketchStore(sketches).query("2013-03-06", "completemillis")
+    self.assertEqual(sketch.count, 3)
+
+def add(args):
+  source = socket.gethostname()
+  state = None
+  while args and args[0].startswith("-"):
+    if args[0].startswith("-source="):
+      source = args[0][len("-source="):]
+    elif args[0].startswith("-state="):
+      state = args[0][len("-state="):]
+    else:
+      break
+    args = args[1:]
+  if len(args) < 2:
+    print("See script header for usage")
+    sys.exit(1)
+  store = SketchStore(args[0])
+  checkpoints = state and Checkpoints(state)
+  days = {}
+  for path in without_segments(args[1:]):
+    torperf_file = TorperfFile(path)
+    if checkpoints:
+      incremental = IncrementalFile(path, checkpoints.get(path))
+      columns = load_data_lines(incremental.lines())
+      checkpoints.set(path, incremental.checkpoint)
+    else:
+      columns = load_data(path)
+    group = (torperf_file.guard_label, torperf_file.filesize_label, source)
+    for day, groups in sketch_columns(columns, torperf_file.filesize,
+                                      group).iteritems():
+      # Files of other hosts or directories can have the same group.
+      merge_groups(days.setdefault(day, {}), groups)
+  for day, groups in sorted(days.iteritems()):
+    store.add(day, groups)
+  if checkpoints:
+    checkpoints.save()
+  print("Added sketches for %d days" % len(days))
+
+def query(args):
+  if len(args) < 4:
+    print("See script header for usage")
+    sys.exit(1)
+  store = SketchStore(args[0])
+  metric, first, last = args[1:4]
+  filters = dict([arg.split("=", 1) for arg in args[4:]])
+  total = LogHistogram(store.relative_error)
+  print("%-10s %8s %10s %10s %10s" % ("day", "count", "p50", "p90", "p99"))
+  for day in store.days(first, last):
+    sketch = store.query(day, metric, **filters)
+    total.merge(sketch)
+    if sketch.count:
+      print("%-10s %8d %10.0f %10.0f %10.0f" % ((day, sketch.count) +
+            tuple([sketch.quantile(q) for q in QUANTILES])))
+  if total.count:
+    print("%-10s %8d %10.0f %10.0f %10.0f" % (("all", total.count) +
+          tuple([total.quantile(q) for q in QUANTILES])))
+
+def main():
+  if len(sys.argv) < 2 or sys.argv[1] not in ("add", "query"):
+    print("See script header for usage")
+    sys.exit(1)
+  if sys.argv[1] == "add":
+    add(sys.argv[2:])
+  else:
+    query(sys.argv[2:])
+
+if __name__ == "__main__":
+  main()
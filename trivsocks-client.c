@@ -10,6 +10,10 @@
 #include <string.h>
 #include <assert.h>
 #include <signal.h>
+#include <time.h>
+#include <unistd.h>
+#include <fcntl.h>
+#include <poll.h>
 
 #include <netinet/in.h>
 #include <arpa/inet.h>
@@ -21,10 +25,53 @@
 #define RESPONSE_LEN_4 8
 #define RESPONSE_LEN_5 4
 #define HTTP_BUF_LEN 256
-#define HTTP_READ_LEN 16 // Must be <= (HTTP_BUF_LEN - 1)
+#define HTTP_READ_LEN 65536 // Enough to drain the socket buffer per recv()
 
 static void usage(void) __attribute__((noreturn));
 
+// Don't echo the HTTP request and response headers to stderr
+static int quiet = 0;
+// Have the kernel drop the response body instead of copying it to us
+static int discard = 0;
+
+// Wall-clock time minus monotonic time when we took the first timestamp
+static struct timespec clock_offset;
+static int clock_offset_set = 0;
+
+/** Set *<b>tv</b> to the current time, measured with the monotonic clock
+ * so that intervals don't jump when the system clock is adjusted during a
+ * measurement, but anchored to the wall clock once, so that timestamps
+ * are still seconds since the epoch.  Return 0 on success, -1 on error. */
+static int
+get_time(struct timeval *tv)
+{
+  struct timespec now;
+
+  if (!clock_offset_set) {
+    struct timeval wall;
+    if (gettimeofday(&wall, NULL) || clock_gettime(CLOCK_MONOTONIC, &now))
+      return -1;
+    clock_offset.tv_sec = wall.tv_sec - now.tv_sec;
+    clock_offset.tv_nsec = wall.tv_usec * 1000L - now.tv_nsec;
+    clock_offset_set = 1;
+  }
+  if (clock_gettime(CLOCK_MONOTONIC, &now))
+    return -1;
+  now.tv_sec += clock_offset.tv_sec;
+  now.tv_nsec += clock_offset.tv_nsec;
+  while (now.tv_nsec < 0) {
+    now.tv_nsec += 1000000000L;
+    now.tv_sec--;
+  }
+  while (now.tv_nsec >= 1000000000L) {
+    now.tv_nsec -= 1000000000L;
+    now.tv_sec++;
+  }
+  tv->tv_sec = now.tv_sec;
+  tv->tv_usec = now.tv_nsec / 1000;
+  return 0;
+}
+
 
 /** Set *<b>out</b> to a newly allocated SOCKS4a resolve request with
  * <b>username</b> and <b>hostname</b> as provided.  Return the number
@@ -105,7 +152,8 @@ parse_socks4a_connect_response(const char *response, size_t len,
     fprintf(stderr, "Nonzero port in socks response: bad format.\n");
     return -1;
   }
-  fprintf(stderr, "Port number: %u\n", (unsigned)get_uint16(response+2));
+  if (!quiet)
+    fprintf(stderr, "Port number: %u\n", (unsigned)get_uint16(response+2));
   if (status != 90) {
     fprintf(stderr, "Got status response '%u': socks request failed.\n", (unsigned)status);
     return -1;
@@ -162,7 +210,8 @@ parse_socks5_connect_response(const char *response, size_t len, int s,
     return -1;
   }
   port = ntohl(get_uint16(reply_buf));
-  fprintf(stderr,"Port number: %u\n", (unsigned)port);
+  if (!quiet)
+    fprintf(stderr,"Port number: %u\n", (unsigned)port);
   return 0;
 }
 
@@ -188,32 +237,131 @@ do_socks5_negotiate(int s){
     return 0;
 }
 
-int
-do_http_get(int s, const char *path, const char *hostname,
-            size_t expected_bytes, size_t *read_bytes, size_t *write_bytes,
-            struct timeval *datarequesttime,
-            struct timeval *dataresponsetime,
-            struct timeval *datacompletetime,
-            struct timeval *dataperctime) {
-  char buf[HTTP_BUF_LEN];
-  int len; // Length of request, not including \0
-  int perc_logged = -1; // Last logged timestamp for fraction of received bytes
-  char is_first = 1;
+// Timestamps and byte counts of one download, written to .data files by
+// output_status_information()
+struct timings {
+  struct timeval starttime; // Connection process started
+  struct timeval sockettime; // After socket is created
+  struct timeval connecttime; // After socket is connected
+  struct timeval negotiatetime; // After authentication methods are negotiated (SOCKS 5 only)
+  struct timeval requesttime; // After SOCKS request is sent
+  struct timeval responsetime; // After SOCKS response is received
+  struct timeval datarequesttime; // After HTTP request is written
+  struct timeval dataresponsetime; // After first response is received
+  struct timeval datacompletetime; // After payload is complete
+  // After (i + 1) * 10% of expected bytes are received
+  struct timeval dataperctime[9];
+  // Data counters of SOCKS payload
+  size_t read_bytes;
+  size_t write_bytes;
+  // Did we get killed by the bash 'timeout' widget, or run out of time in
+  // batch mode?
+  int didtimeout;
+};
 
-  len = snprintf(buf, HTTP_BUF_LEN, "GET %s HTTP/1.0\r\nPragma: no-cache\r\n"
-                                    "Host: %s\r\n\r\n", path, hostname);
+// What we have seen of an HTTP response so far
+struct response {
+  size_t expected_bytes;
+  int perc_logged; // Last logged timestamp for fraction of received bytes
+  char in_headers; // Still reading the response headers
+  int matched; // Bytes of the blank line after the headers seen so far
+};
+
+/** Write a request for <b>path</b> on <b>hostname</b> to <b>request</b>,
+ * which holds HTTP_BUF_LEN bytes, and prepare <b>response</b> for
+ * reading a reply of <b>expected_bytes</b>.  Return the length of the
+ * request, not including \0, or -1 if it doesn't fit. */
+static int
+build_http_request(char *request, const char *path, const char *hostname,
+                   size_t expected_bytes, struct response *response)
+{
+  int len;
+
+  len = snprintf(request, HTTP_BUF_LEN, "GET %s HTTP/1.0\r\n"
+                 "Pragma: no-cache\r\nHost: %s\r\n\r\n", path, hostname);
 
   // Check for overflow or error
   if (len >= HTTP_BUF_LEN || len < 0)
     return -1;
 
+  if (!quiet)
+    fprintf(stderr, "Request: %s\n", request);
+  response->expected_bytes = expected_bytes;
+  response->perc_logged = -1;
+  response->in_headers = 1;
+  response->matched = 0;
+  return len;
+}
+
+/** Flags for recv()ing the next part of <b>response</b>: once the headers
+ * are over, the body can be discarded by the kernel without copying it. */
+static int
+response_recv_flags(const struct response *response)
+{
+  return discard && !response->in_headers ? MSG_TRUNC : 0;
+}
+
+/** Count <b>len</b> more bytes of <b>response</b>, which are in <b>buf</b>
+ * unless they were discarded, and take timestamps into <b>t</b>.  Only
+ * the headers are echoed.  Return 0 on success, -1 on error. */
+static int
+response_received(struct response *response, struct timings *t,
+                  const char *buf, int len)
+{
+  int i;
+
+  t->read_bytes += len;
+  // Get when start of response was received
+  if (t->read_bytes == (size_t) len) {
+    if (get_time(&t->dataresponsetime)) {
+      perror("getting dataresponsetime");
+      return -1;
+    }
+  }
+  // Get when the next 10% of expected bytes are received; this is a
+  // while loop for cases when we read more than 10% of them in a single
+  // recv() call, including the last one.
+  while (response->expected_bytes && response->perc_logged < 8 &&
+      (t->read_bytes * 10) / response->expected_bytes >
+      response->perc_logged + 1) {
+    if (get_time(&t->dataperctime[++response->perc_logged])) {
+     perror("getting dataperctime");
+     return -1;
+    }
+  }
+  if (response->in_headers) {
+    for (i = 0; i < len && response->in_headers; i++) {
+      if (buf[i] == "\r\n\r\n"[response->matched])
+        response->matched++;
+      else
+        response->matched = buf[i] == '\r';
+      response->in_headers = response->matched < 4;
+    }
+    if (!quiet)
+      fprintf(stderr, "Response: %.*s\n", i, buf);
+  }
+  return 0;
+}
+
+int
+do_http_get(int s, const char *path, const char *hostname,
+            size_t expected_bytes, struct timings *t) {
+  char request[HTTP_BUF_LEN];
+  static char buf[HTTP_READ_LEN];
+  struct response response;
+  int len; // Length of request, not including \0
+
+  len = build_http_request(request, path, hostname, expected_bytes,
+                           &response);
+  if (len < 0)
+    return -1;
+
   // Write the request
-  fprintf(stderr, "Response: %s\n", buf);
-  if (write_all(s, buf, len, 1) != len)
+  if (write_all(s, request, len, 1) != len)
     return -1;
-  *write_bytes = len;
+  t->write_bytes = len;
   // Get when request is sent
-  if (gettimeofday(datarequesttime, NULL)) {
+  if (get_time(&t->datarequesttime)) {
     perror("getting datarequesttime");
     return -1;
   }    
@@ -223,36 +371,23 @@ do_http_get(int s, const char *path, const char *hostname,
   //  return -1;
 
   // Default, in case no data is returned
-  dataresponsetime -> tv_sec = dataresponsetime -> tv_usec = 0;
-
-  // Read the response
-  *read_bytes = 0;
-  while ((len = read_all(s, buf, HTTP_READ_LEN, 1)) > 0) {
-    buf[len] = '\0';
-    fprintf(stderr, "Response: %s\n", buf);
-    *read_bytes += len;
-    // Get when start of response was received
-    if (is_first) {
-      is_first = 0;
-      if (gettimeofday(dataresponsetime, NULL)) {
-        perror("getting dataresponsetime");
-        return -1;
-      }
-    }
-    // Get when the next 10% of expected bytes are received; this is a
-    // while loop for cases when we expect only very few bytes and read
-    // more than 10% of them in a single read_all() call.
-    while (*read_bytes < expected_bytes &&
-        (*read_bytes * 10) / expected_bytes > perc_logged + 1) {
-      if (gettimeofday(&dataperctime[++perc_logged], NULL)) {
-       perror("getting dataperctime");
-       return -1;
-      }
-    }
+  t->dataresponsetime.tv_sec = t->dataresponsetime.tv_usec = 0;
+
+  // Read the response with one recv() per wakeup, rather than read_all(),
+  // which would wait for a full buffer and delay our timestamps.
+  t->read_bytes = 0;
+  for (;;) {
+    len = recv(s, buf, HTTP_READ_LEN, response_recv_flags(&response));
+    if (len < 0 && errno == EINTR)
+      continue;
+    if (len <= 0)
+      break;
+    if (response_received(&response, t, buf, len))
+      return -1;
   }
 
   // Get when response is complete
-  if (gettimeofday(datacompletetime, NULL)) {
+  if (get_time(&t->datacompletetime)) {
     perror("getting datacompletetime");
     return -1;
   }
@@ -261,51 +396,35 @@ do_http_get(int s, const char *path, const char *hostname,
 }
 
 static int
-print_time(struct timeval t) {
-  return printf("%ld %ld ", (long int)t.tv_sec, (long int)t.tv_usec);
+print_time(FILE *out, struct timeval t) {
+  return fprintf(out, "%ld %ld ", (long int)t.tv_sec, (long int)t.tv_usec);
 }
 
-// Timestamps of important events
-struct timeval starttime; // Connection process started
-struct timeval sockettime; // After socket is created
-struct timeval connecttime; // After socket is connected
-struct timeval negotiatetime; // After authentication methods are negotiated (SOCKS 5 only)
-struct timeval requesttime; // After SOCKS request is sent
-struct timeval responsetime; // After SOCKS response is received
-struct timeval datarequesttime; // After HTTP request is written
-struct timeval dataresponsetime; // After first response is received
-struct timeval datacompletetime; // After payload is complete
-// After (i + 1) * 10% of expected bytes are received
-struct timeval dataperctime[9];
-
-// Data counters of SOCKS payload
-size_t read_bytes;
-size_t write_bytes;
-
-// Did we get killed by the bash 'timeout' widget?
-int didtimeout;
+// The download of the single request mode
+static struct timings timings;
 
 static void
-output_status_information(void)
+output_status_information(FILE *out, const struct timings *t)
 {
   int i;
 
-  print_time(starttime);
-  print_time(sockettime);
-  print_time(connecttime);
-  print_time(negotiatetime);
-  print_time(requesttime);
-  print_time(responsetime);
-  print_time(datarequesttime);
-  print_time(dataresponsetime);
-  print_time(datacompletetime);
+  print_time(out, t->starttime);
+  print_time(out, t->sockettime);
+  print_time(out, t->connecttime);
+  print_time(out, t->negotiatetime);
+  print_time(out, t->requesttime);
+  print_time(out, t->responsetime);
+  print_time(out, t->datarequesttime);
+  print_time(out, t->dataresponsetime);
+  print_time(out, t->datacompletetime);
 
-  printf("%lu %lu ", (unsigned long)write_bytes, (unsigned long)read_bytes);
-  printf("%d ", didtimeout);
+  fprintf(out, "%lu %lu ", (unsigned long)t->write_bytes,
+          (unsigned long)t->read_bytes);
+  fprintf(out, "%d ", t->didtimeout);
 
   for (i = 0; i < 9; i++)
-    print_time(dataperctime[i]);
-  printf("\n");
+    print_time(out, t->dataperctime[i]);
+  fprintf(out, "\n");
 }
 
 /** Send a resolve request for <b>hostname</b> to the Tor listening on
@@ -333,7 +452,7 @@ do_connect(const char *hostname, const char *filename, uint32_t sockshost, uint1
   *result_hostname = NULL;
 
   // Get time that connection was started
-  if (gettimeofday(&starttime, NULL)) {
+  if (get_time(&timings.starttime)) {
     perror("getting starttime");
     return -1;
   }
@@ -345,7 +464,7 @@ do_connect(const char *hostname, const char *filename, uint32_t sockshost, uint1
     return -1;
   }
   // Get time that socket was created
-  if (gettimeofday(&sockettime, NULL)) {
+  if (get_time(&timings.sockettime)) {
     perror("getting sockettime");
     return -1;
   }
@@ -360,7 +479,7 @@ do_connect(const char *hostname, const char *filename, uint32_t sockshost, uint1
     return -1;
   }
   // Get time that socket was connected
-  if (gettimeofday(&connecttime, NULL)) {
+  if (get_time(&timings.connecttime)) {
     perror("getting connecttime");
     return -1;
   }
@@ -372,7 +491,7 @@ do_connect(const char *hostname, const char *filename, uint32_t sockshost, uint1
       return retval;
   }  
   // Get time that negotiation was completed
-  if (gettimeofday(&negotiatetime, NULL)) {
+  if (get_time(&timings.negotiatetime)) {
     perror("getting negotiatetime");
     return -1;
   }
@@ -389,7 +508,7 @@ do_connect(const char *hostname, const char *filename, uint32_t sockshost, uint1
   }
   free(req);
   // Get time that request was sent
-  if (gettimeofday(&requesttime, NULL)) {
+  if (get_time(&timings.requesttime)) {
     perror("getting requesttime");
     return -1;
   }
@@ -416,7 +535,7 @@ do_connect(const char *hostname, const char *filename, uint32_t sockshost, uint1
     }
   }
   // Get time that response was received
-  if (gettimeofday(&responsetime, NULL)) {
+  if (get_time(&timings.responsetime)) {
     perror("getting responsetime");
     return -1;
   }
@@ -429,15 +548,13 @@ do_connect(const char *hostname, const char *filename, uint32_t sockshost, uint1
   */
   
   // Request a file using HTTP
-  do_http_get(s, filename, hostname, expected_bytes, &read_bytes, &write_bytes,
-             &datarequesttime, &dataresponsetime, &datacompletetime,
-             dataperctime);
+  do_http_get(s, filename, hostname, expected_bytes, &timings);
 
 
-  didtimeout = 0;
+  timings.didtimeout = 0;
 
   // Output status information
-  output_status_information();
+  output_status_information(stdout, &timings);
 
   return 0;
 }
@@ -446,8 +563,15 @@ do_connect(const char *hostname, const char *filename, uint32_t sockshost, uint1
 static void
 usage(void)
 {
-  puts("Syntax: trivsocks-client hostname [sockshost:socksport] /path/to/file "
-       "expected-bytes");
+  puts("Syntax: trivsocks-client [-4|-5] [-q] [-d] hostname "
+       "[sockshost:socksport] /path/to/file expected-bytes\n"
+       "       trivsocks-client [-4|-5] [-q] [-d] --schedule schedule-file\n"
+       "  -q  don't echo HTTP headers to stderr\n"
+       "  -d  discard the response body in the kernel (MSG_TRUNC)\n"
+       "A schedule file has one line per download stream:\n"
+       "  hostname sockshost:socksport /path/to/file expected-bytes "
+       "interval-seconds\n"
+       "  deadline-seconds output.data [offset-seconds]");
   exit(1);
 }
 
@@ -455,18 +579,473 @@ static void
 termination_handler(int signum)
 {
   fprintf(stderr,"Received a timeout. Exiting.\n");
-  didtimeout = 1;
+  timings.didtimeout = 1;
 
   // Get when response is complete
-  if (gettimeofday(&datacompletetime, NULL)) {
+  if (get_time(&timings.datacompletetime)) {
     perror("getting datacompletetime for timeout");
   }
 
-  output_status_information();
+  output_status_information(stdout, &timings);
 
   exit(1);
 }
 
+/* Batch mode: run the downloads of a schedule file in one process, each
+ * stream of them at its own interval, concurrently in a poll() loop, with
+ * deadlines instead of the SIGINT from 'timeout', and append the results
+ * to each stream's .data file. */
+
+#define MAX_SCHEDULE 256
+#define SOCKS_REPLY_LEN (4 + 1 + 255 + 2) // SOCKS 5 with longest hostname
+
+enum measurement_state {
+  CONNECTING, NEGOTIATING, REQUESTING, HTTP_REQUESTING, HTTP_READING
+};
+
+// A download in progress, which goes through the same steps as
+// do_connect() and do_http_get(), without blocking
+struct measurement {
+  int fd;
+  enum measurement_state state;
+  double deadline;
+  char out[HTTP_BUF_LEN + SOCKS_REPLY_LEN]; // What's left to send
+  size_t out_len, out_sent;
+  char in[SOCKS_REPLY_LEN]; // SOCKS reply so far
+  size_t in_len, in_need;
+  struct response response;
+  struct timings t;
+};
+
+// One line of a schedule file
+struct schedule_entry {
+  char *hostname;
+  uint32_t sockshost;
+  uint16_t socksport;
+  char *path;
+  size_t expected_bytes;
+  long interval; // Seconds between requests
+  long deadline; // Seconds after which a request times out
+  char *output; // .data file to append results to, or - for stdout
+  long offset; // Requests start offset seconds after multiples of interval
+  double next; // When the next request is due
+  int running;
+  struct measurement m;
+};
+
+static volatile sig_atomic_t stopping = 0;
+
+static void
+stop_handler(int signum)
+{
+  stopping = 1;
+}
+
+static double
+now_seconds(void)
+{
+  struct timeval tv;
+  if (get_time(&tv))
+    return 0;
+  return tv.tv_sec + tv.tv_usec / 1e6;
+}
+
+/** Read up to <b>max_entries</b> lines of the form
+ *   hostname sockshost:socksport /path/to/file expected-bytes interval
+ *   deadline output-file [offset]
+ * from <b>filename</b> into <b>entries</b>, ignoring empty lines and
+ * comments starting with #.  Return the number of entries, or -1 on
+ * error. */
+static int
+read_schedule(const char *filename, struct schedule_entry *entries,
+              int max_entries)
+{
+  FILE *f;
+  char line[1024];
+  char *fields[8];
+  int n_entries = 0, n_fields, line_number = 0, ok = 1;
+  struct schedule_entry *e;
+
+  if (!(f = fopen(filename, "r"))) {
+    perror("opening schedule");
+    return -1;
+  }
+  while (fgets(line, sizeof(line), f)) {
+    line_number++;
+    if (strchr(line, '#'))
+      *strchr(line, '#') = '\0';
+    for (n_fields = 0; n_fields < 8 &&
+         (fields[n_fields] = strtok(n_fields ? NULL : line, " \t\r\n"));
+         n_fields++);
+    if (!n_fields)
+      continue;
+    if (n_fields < 7 || (n_fields == 8 && strtok(NULL, " \t\r\n")) ||
+        n_entries == max_entries) {
+      fprintf(stderr, "%s:%d: expected hostname sockshost:socksport path "
+              "expected-bytes interval deadline output-file [offset]\n",
+              filename, line_number);
+      fclose(f);
+      return -1;
+    }
+    e = &entries[n_entries++];
+    memset(e, 0, sizeof(*e));
+    e->hostname = strdup(fields[0]);
+    if (parse_addr_port(0, fields[1], NULL, &e->sockshost, &e->socksport)<0) {
+      fprintf(stderr, "%s:%d: couldn't parse/resolve address %s\n",
+              filename, line_number, fields[1]);
+      fclose(f);
+      return -1;
+    }
+    if (e->socksport == 0)
+      e->socksport = 9050;
+    e->path = strdup(fields[2]);
+    e->expected_bytes = (size_t) parse_long(fields[3], 10, 0, 1024*1024*1024,
+                                            &ok, NULL);
+    if (ok)
+      e->interval = parse_long(fields[4], 10, 1, 7*24*60*60, &ok, NULL);
+    if (ok)
+      e->deadline = parse_long(fields[5], 10, 1, 7*24*60*60, &ok, NULL);
+    e->output = strdup(fields[6]);
+    if (ok && n_fields == 8)
+      e->offset = parse_long(fields[7], 10, 0, e->interval - 1, &ok, NULL);
+    if (!ok) {
+      fprintf(stderr, "%s:%d: bad number\n", filename, line_number);
+      fclose(f);
+      return -1;
+    }
+  }
+  fclose(f);
+  return n_entries;
+}
+
+/** Start a download for <b>e</b>.  Return 0 on success, -1 on error. */
+static int
+start_measurement(struct schedule_entry *e)
+{
+  struct measurement *m = &e->m;
+  struct sockaddr_in socksaddr;
+
+  memset(m, 0, sizeof(*m));
+  if (get_time(&m->t.starttime)) {
+    perror("getting starttime");
+    return -1;
+  }
+  m->deadline = m->t.starttime.tv_sec + m->t.starttime.tv_usec / 1e6 +
+                e->deadline;
+  m->fd = socket(PF_INET,SOCK_STREAM,IPPROTO_TCP);
+  if (m->fd<0) {
+    perror("creating socket");
+    return -1;
+  }
+  if (get_time(&m->t.sockettime)) {
+    perror("getting sockettime");
+    close(m->fd);
+    return -1;
+  }
+  if (fcntl(m->fd, F_SETFL, O_NONBLOCK)) {
+    perror("making socket non-blocking");
+    close(m->fd);
+    return -1;
+  }
+  memset(&socksaddr, 0, sizeof(socksaddr));
+  socksaddr.sin_family = AF_INET;
+  socksaddr.sin_port = htons(e->socksport);
+  socksaddr.sin_addr.s_addr = htonl(e->sockshost);
+  if (connect(m->fd, (struct sockaddr*)&socksaddr, sizeof(socksaddr)) &&
+      errno != EINPROGRESS) {
+    perror("connecting to SOCKS host");
+    close(m->fd);
+    return -1;
+  }
+  // Connected once the socket is writable
+  m->state = CONNECTING;
+  e->running = 1;
+  return 0;
+}
+
+/** Queue <b>len</b> bytes of <b>data</b> to send next. */
+static void
+measurement_send(struct measurement *m, const char *data, size_t len)
+{
+  memcpy(m->out, data, len);
+  m->out_len = len;
+  m->out_sent = 0;
+}
+
+static int
+send_socks_request(struct schedule_entry *e, int version)
+{
+  struct measurement *m = &e->m;
+  char *req = NULL;
+  int len;
+
+  if ((len = build_socks_connect_request(&req, "", e->hostname, 0,
+                                         version))<0) {
+    fprintf(stderr, "error generating SOCKS request: %d\n", len);
+    return -1;
+  }
+  measurement_send(m, req, len);
+  free(req);
+  m->state = REQUESTING;
+  m->in_len = 0;
+  // The shortest SOCKS 5 reply is 10 bytes, the address type is in byte 4
+  m->in_need = version == 4 ? RESPONSE_LEN_4 : 5;
+  return 0;
+}
+
+/** Return 1 if the SOCKS 5 reply so far is complete, 0 if we need to read
+ * more, or -1 on error. */
+static int
+socks5_reply_complete(struct measurement *m)
+{
+  size_t need;
+
+  if (m->in[0] != 5) {
+    fprintf(stderr, "Bad SOCKS5 reply version\n");
+    return -1;
+  }
+  if (m->in[1] != 0) {
+    fprintf(stderr, "Got status response '%u': SOCKS5 request failed\n",
+            (unsigned)m->in[1]);
+    return -1;
+  }
+  if (m->in[3] == 1)
+    need = 4 + 4 + 2;
+  else if (m->in[3] == 3)
+    need = 4 + 1 + (uint8_t)m->in[4] + 2;
+  else if (m->in[3] == 4)
+    need = 4 + 16 + 2;
+  else {
+    fprintf(stderr, "Unknown address type in socks5 response\n");
+    return -1;
+  }
+  if (m->in_len < need) {
+    m->in_need = need;
+    return 0;
+  }
+  return 1;
+}
+
+/** Make progress on the download of <b>e</b> after poll() said its socket
+ * is ready.  Return 1 if the download is complete, 0 if it needs to wait
+ * for the socket again, or -1 if it failed. */
+static int
+measurement_step(struct schedule_entry *e, int version)
+{
+  struct measurement *m = &e->m;
+  static char buf[HTTP_READ_LEN];
+  uint32_t addr;
+  int err = 0, len;
+  socklen_t errlen = sizeof(err);
+
+  if (m->state == CONNECTING) {
+    if (getsockopt(m->fd, SOL_SOCKET, SO_ERROR, &err, &errlen) || err) {
+      fprintf(stderr, "connecting to SOCKS host: %s\n", strerror(err));
+      return -1;
+    }
+    if (get_time(&m->t.connecttime)) {
+      perror("getting connecttime");
+      return -1;
+    }
+    if (version == 5) {
+      measurement_send(m, "\x05\x01\x00", 3);
+      m->state = NEGOTIATING;
+      m->in_len = 0;
+      m->in_need = 2;
+      return 0;
+    }
+    if (get_time(&m->t.negotiatetime)) {
+      perror("getting negotiatetime");
+      return -1;
+    }
+    return send_socks_request(e, version);
+  }
+
+  if (m->out_sent < m->out_len) {
+    len = send(m->fd, m->out + m->out_sent, m->out_len - m->out_sent, 0);
+    if (len < 0 && (errno == EAGAIN || errno == EINTR))
+      return 0;
+    if (len < 0) {
+      perror("sending");
+      return -1;
+    }
+    m->out_sent += len;
+    if (m->out_sent < m->out_len)
+      return 0;
+    if (m->state == REQUESTING) {
+      if (get_time(&m->t.requesttime)) {
+        perror("getting requesttime");
+        return -1;
+      }
+    } else if (m->state == HTTP_REQUESTING) {
+      m->t.write_bytes = m->out_len;
+      if (get_time(&m->t.datarequesttime)) {
+        perror("getting datarequesttime");
+        return -1;
+      }
+      m->state = HTTP_READING;
+    }
+    return 0;
+  }
+
+  if (m->state == HTTP_READING) {
+    len = recv(m->fd, buf, HTTP_READ_LEN, response_recv_flags(&m->response));
+    if (len < 0 && (errno == EAGAIN || errno == EINTR))
+      return 0;
+    if (len > 0)
+      return response_received(&m->response, &m->t, buf, len);
+    // Like do_http_get(), a read error ends the download
+    if (get_time(&m->t.datacompletetime)) {
+      perror("getting datacompletetime");
+      return -1;
+    }
+    return 1;
+  }
+
+  // NEGOTIATING or REQUESTING: read the SOCKS reply
+  len = recv(m->fd, m->in + m->in_len, m->in_need - m->in_len, 0);
+  if (len < 0 && (errno == EAGAIN || errno == EINTR))
+    return 0;
+  if (len <= 0) {
+    fprintf(stderr, "Error reading SOCKS%d response\n", version);
+    return -1;
+  }
+  m->in_len += len;
+  if (m->in_len < m->in_need)
+    return 0;
+  if (m->state == NEGOTIATING) {
+    if (m->in[0] != '\x05' || m->in[1] != '\x00') {
+      fprintf(stderr, "unrecognized SOCKS version or authentication method\n");
+      return -1;
+    }
+    if (get_time(&m->t.negotiatetime)) {
+      perror("getting negotiatetime");
+      return -1;
+    }
+    return send_socks_request(e, version);
+  }
+  if (version == 4) {
+    if (parse_socks4a_connect_response(m->in, m->in_len, &addr)<0)
+      return -1;
+  } else {
+    err = socks5_reply_complete(m);
+    if (err <= 0)
+      return err;
+  }
+  if (get_time(&m->t.responsetime)) {
+    perror("getting responsetime");
+    return -1;
+  }
+  len = build_http_request(m->out, e->path, e->hostname, e->expected_bytes,
+                           &m->response);
+  if (len < 0)
+    return -1;
+  m->out_len = len;
+  m->out_sent = 0;
+  m->state = HTTP_REQUESTING;
+  return 0;
+}
+
+/** Append the results of the download of <b>e</b> to its output file, and
+ * close its socket. */
+static void
+finish_measurement(struct schedule_entry *e)
+{
+  FILE *out;
+
+  if (!strcmp(e->output, "-")) {
+    output_status_information(stdout, &e->m.t);
+    fflush(stdout);
+  } else if ((out = fopen(e->output, "a"))) {
+    output_status_information(out, &e->m.t);
+    fclose(out);
+  } else {
+    perror(e->output);
+  }
+  close(e->m.fd);
+  e->running = 0;
+}
+
+/** Run the downloads in schedule file <b>filename</b> until we get
+ * SIGINT or SIGTERM.  Return 0 when stopped, 1 on error. */
+static int
+run_schedule(const char *filename, int version)
+{
+  static struct schedule_entry entries[MAX_SCHEDULE];
+  struct pollfd fds[MAX_SCHEDULE];
+  struct schedule_entry *polled[MAX_SCHEDULE];
+  int n_entries, n_fds, i, result;
+  double now, wait;
+  long first;
+
+  if ((n_entries = read_schedule(filename, entries, MAX_SCHEDULE)) < 0)
+    return 1;
+  signal(SIGINT, stop_handler);
+  signal(SIGTERM, stop_handler);
+  signal(SIGPIPE, SIG_IGN);
+
+  // Like cron, start at the next multiple of the interval plus offset
+  now = now_seconds();
+  for (i = 0; i < n_entries; i++) {
+    first = (long)now - entries[i].offset;
+    entries[i].next = first - first % entries[i].interval + entries[i].offset;
+    if (entries[i].next < now)
+      entries[i].next += entries[i].interval;
+  }
+
+  while (!stopping) {
+    now = now_seconds();
+    wait = 60;
+    n_fds = 0;
+    for (i = 0; i < n_entries; i++) {
+      struct schedule_entry *e = &entries[i];
+      if (e->running && now >= e->m.deadline) {
+        e->m.t.didtimeout = 1;
+        if (get_time(&e->m.t.datacompletetime))
+          perror("getting datacompletetime for timeout");
+        finish_measurement(e);
+      }
+      if (now >= e->next) {
+        if (e->running)
+          fprintf(stderr, "Skipping request for %s, because the previous "
+                  "one is still running.\n", e->path);
+        else
+          start_measurement(e);
+        while (e->next <= now)
+          e->next += e->interval;
+      }
+      if (e->next - now < wait)
+        wait = e->next - now;
+      if (e->running) {
+        if (e->m.deadline - now < wait)
+          wait = e->m.deadline - now;
+        fds[n_fds].fd = e->m.fd;
+        fds[n_fds].events = e->m.state == CONNECTING ||
+                            e->m.out_sent < e->m.out_len ? POLLOUT : POLLIN;
+        polled[n_fds++] = e;
+      }
+    }
+    if (poll(fds, n_fds, (int)(wait * 1000) + 1) < 0) {
+      if (errno == EINTR)
+        continue;
+      perror("poll");
+      return 1;
+    }
+    for (i = 0; i < n_fds; i++) {
+      if (!fds[i].revents)
+        continue;
+      result = measurement_step(polled[i], version);
+      if (result > 0) {
+        finish_measurement(polled[i]);
+      } else if (result < 0) {
+        close(polled[i]->m.fd);
+        polled[i]->running = 0;
+      }
+    }
+  }
+  return 0;
+}
+
 /** Entry point to tor-resolve */
 int
 main(int argc, char **argv)
@@ -478,7 +1057,7 @@ main(int argc, char **argv)
   int n_args;
   uint32_t result = 0;
   char *result_hostname = NULL;
-  char *hostname = NULL, *filename = NULL;
+  char *hostname = NULL, *filename = NULL, *schedule = NULL;
   size_t expbytes = 0;
 
   signal(SIGINT, termination_handler);
@@ -501,6 +1080,15 @@ main(int argc, char **argv)
       isSocks4 = 0;
     else if (!strcmp("-x", arg[0]))
       isReverse = 1;
+    else if (!strcmp("-q", arg[0]))
+      quiet = 1;
+    else if (!strcmp("-d", arg[0]))
+      discard = 1;
+    else if (!strcmp("--schedule", arg[0]) && n_args > 1) {
+      schedule = arg[1];
+      ++arg;
+      --n_args;
+    }
     else {
       fprintf(stderr, "Unrecognized flag '%s'\n", arg[0]);
       usage();
@@ -514,8 +1102,13 @@ main(int argc, char **argv)
     usage();
   }
 
-  if (n_args == 3) {
-    fprintf(stderr,"defaulting to localhost:9050\n");
+  if (schedule) {
+    if (n_args)
+      usage();
+    return run_schedule(schedule, isSocks4 ? 4 : 5);
+  } else if (n_args == 3) {
+    if (!quiet)
+      fprintf(stderr,"defaulting to localhost:9050\n");
     sockshost = 0x7f000001u; /* localhost */
     socksport = 9050; /* 9050 */
     hostname = arg[0];
@@ -527,7 +1120,8 @@ main(int argc, char **argv)
       return 1;
     }
     if (socksport == 0) {
-      fprintf(stderr,"defaulting to port 9050\n");
+      if (!quiet)
+        fprintf(stderr,"defaulting to port 9050\n");
       socksport = 9050;
     }
     hostname = arg[0];